@@ -1,17 +1,32 @@
 """Controls backup creation and restoring."""
 
 import bz2
+import collections
 import copy
 import errno
+import io
+import itertools
 import logging
 import os
+import shutil
 import stat
+import struct
 import tarfile
+import tempfile
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
 
 import psys
 
+from . import chunking
+from . import index
+from . import journal
+from . import metadata
 from . import utils
 from .core import Error
+from .filters import PathMatcher
 from .storage import Storage
 
 LOG = logging.getLogger(__name__)
@@ -30,8 +45,23 @@ _STATE_CLOSED = "closed"
 _DATA_FILE_NAME = "data.tar"
 """Name of backup data file."""
 
-_METADATA_FILE_NAME = "metadata.bz2"
-"""Name of backup metadata file."""
+_RAW_DATA_FILE_NAME = "raw.tar"
+"""Name of backup uncompressed data file (data of incompressible files)."""
+
+_CHUNK_DATA_FILE_NAME = "chunks.tar"
+"""Name of backup chunk data file."""
+
+_CHUNK_METADATA_FILE_NAME = "chunks.bz2"
+"""Name of backup chunk metadata file (chunk lists of chunked files)."""
+
+_SIGNATURES_FILE_NAME = "signatures.bz2"
+"""
+Name of backup file signatures file (block hashes of big files which are
+used for delta encoding of their following versions).
+"""
+
+_DELTAS_FILE_NAME = "deltas.bz2"
+"""Name of backup deltas file (base file hashes of delta files)."""
 
 
 _ENCODING = "utf-8"
@@ -44,6 +74,53 @@ _FILE_STATUS_EXTERN = "extern"
 _FILE_STATUS_UNIQUE = "unique"
 """Unique file status."""
 
+_FILE_STATUS_CHUNKED = "chunked"
+"""Chunked file status (a unique file which is stored as a list of chunks)."""
+
+_FILE_STATUS_RAW = "raw"
+"""
+Raw file status (a unique file which is stored in the uncompressed data file).
+"""
+
+_FILE_STATUS_DELTA = "delta"
+"""
+Delta file status (a unique file which is stored as a delta against its
+previous version).
+"""
+
+_EXTERN_FILE_STATUSES = ( _FILE_STATUS_EXTERN, _FILE_STATUS_RAW, _FILE_STATUS_CHUNKED, _FILE_STATUS_DELTA )
+"""Statuses of files whose data isn't restored from the backup's data as is."""
+
+
+_SPARSE_HEADER_PREFIX = "GNU.sparse."
+"""Prefix of PAX headers which describe a sparse file."""
+
+_MAX_SPARSE_SIZE = 0o77777777777 - 1024 * 1024
+"""
+Maximum size of a sparse file's data.
+
+tarfile misreads sparse files whose data size doesn't fit into the ustar
+header (with a reserve for the sparse map).
+"""
+
+_MIN_RAW_SIZE = 64 * 1024
+"""Files smaller than this size are always compressed."""
+
+_COMPRESSIBILITY_SAMPLE_SIZE = 64 * 1024
+"""Size of data which is sampled to check whether a file is compressible."""
+
+_MAX_COMPRESSION_RATIO = 0.95
+"""
+Files whose sample doesn't compress better than this ratio are considered
+incompressible.
+"""
+
+_DELTA_HEADER = struct.Struct(">QI")
+"""Header of delta file data: file size and block size."""
+
+_DELTA_BLOCK_HEADER = struct.Struct(">QI")
+"""Header of each changed block in delta file data: block index and size."""
+
 
 
 class Backup:
@@ -72,41 +149,98 @@ class Backup:
         # Backup metadata file
         self.__metadata = None
 
+        # Backup uncompressed data file (created on demand)
+        self.__raw_data = None
+
+        # Backup chunk data and metadata files (created on demand)
+        self.__chunk_data = None
+        self.__chunk_metadata = None
+
         # A set of hashes of all available files in this backup group
-        self.__hashes = set()
+        self.__hashes = utils.HashSet()
+
+        # Additional metadata files (created on demand)
+        self.__extra_metadata = {}
+
+        # A set of hashes of all available chunks in this backup group
+        self.__chunks = utils.HashSet()
+
+        # Signatures of the previous backups' files which can be used as a base
+        # for delta encoding: file hash -> ( delta chain length, block size,
+        # block hashes )
+        self.__signatures = {}
+
+        # A set of sizes of all available files in this backup group (None if
+        # some metadata doesn't contain file sizes)
+        self.__sizes = set()
 
-        # A map of files from the previous backup to their hashes and
-        # fingerprints.
-        self.__prev_files = {}
+        # Memory limit of the tables of paths and fingerprints below and of
+        # the metadata records (they are spilled to disk when it's exceeded).
+        # None if there is no limit, so plain dicts and lists are used.
+        self.__memory_limit = (
+            utils.MemoryLimit(self.__config["memory_limit"]) if self.__config["memory_limit"] else None)
 
+        # A map of files from the previous backups to their hashes,
+        # fingerprints and sizes (each path is resolved to its newest version
+        # in the backup group). Files added to this backup are added to it as
+        # well to write the group index.
+        self.__prev_files = _get_table(self.__memory_limit)
 
-        # A set of all files added to the backup
-        self.__files = set()
+        # A map of fingerprints and sizes of files from the previous backups to
+        # their hashes (to find files which have been moved or renamed)
+        self.__prev_fingerprints = _get_table(self.__memory_limit)
+
+        # Backups the group index will be built from if all metadata has been
+        # successfully loaded
+        self.__index_backups = None
+
+        # Current change journal state
+        self.__journal_state = None
+
+        # Paths changed since the previous backup (None if the change journal
+        # can't be used)
+        self.__changes = None
+
+        # The previous backup's data which unchanged file trees are copied
+        # from
+        self.__prev_data = None
+
+
+        # All files added to the backup (a set)
+        self.__files = _get_table(self.__memory_limit)
 
         # Inodes of hard links added to the backup (to track hard-linked files)
-        self.__hardlink_inodes = {}
+        self.__hardlink_inodes = _get_table(self.__memory_limit)
 
 
         try:
             self.__group, self.__name, path = self.__storage.create_backup(
                 self.__config["max_backups"])
 
-            self.__load_all_backup_metadata(self.__config["trust_modify_time"])
+            # Spill the tables to the backup's directory, because the default
+            # temporary directory may be in memory
+            if self.__memory_limit is not None:
+                self.__memory_limit.directory = path
 
+            self.__load_all_backup_metadata()
+            self.__open_journal()
 
             LOG.debug("Creating backup %s in group %s...", self.__name, self.__group)
 
             try:
-                self.__data = utils.CompressedTarFile(
+                self.__data = utils.MultiVolumeTarFile(
                     os.path.join(path, _DATA_FILE_NAME),
-                    write = self.__config["compression"])
+                    write = self.__config["compression"],
+                    threads = self.__config["compression_threads"],
+                    level = self.__config["compression_level"] or None,
+                    max_volume_size = self.__config["max_volume_size"])
             except Exception as e:
                 raise Error("Unable to create a backup data tar archive in '{}': {}.", path, psys.e(e))
 
-            metadata_path = os.path.join(path, _METADATA_FILE_NAME)
+            metadata_path = os.path.join(path, metadata.BINARY_FILE_NAME)
 
             try:
-                self.__metadata = bz2.BZ2File(metadata_path, mode = "w")
+                self.__metadata = metadata.Writer(metadata_path, self.__memory_limit)
             except Exception as e:
                 raise Error("Unable to create a backup metadata file '{}': {}.",
                     metadata_path, psys.e(e))
@@ -115,8 +249,11 @@ class Backup:
             raise
 
 
-    def add_file(self, path, stat_info, link_target = None, file_obj = None):
-        """Adds a file to the backup."""
+    def add_file(self, path, stat_info, link_target = None, file_obj = None, file_hash = None):
+        """Adds a file to the backup.
+
+        file_hash is the file data's hash if it's already known.
+        """
 
         if self.__state != _STATE_OPENED:
             raise Error("The backup file is closed")
@@ -125,18 +262,16 @@ class Backup:
         if "\0" in path:
             raise Error(r"File names with '\0' aren't supported")
 
-        # Limitation due to using text files for metadata
+        # Volume manifests of data files and the change journal are line-based
         if "\r" in path or "\n" in path:
             raise Error(r"File names with '\r' or '\n' aren't supported")
 
         if path in self.__files:
             raise Error("File is already added to the backup")
 
-        self.__files.add(path)
+        self.__files[path] = None
 
 
-        extern = False
-
         hard_link = (
             self.__config["preserve_hard_links"] and
             stat.S_ISREG(stat_info.st_mode) and stat_info.st_nlink > 1
@@ -153,25 +288,12 @@ class Backup:
             stat_info.st_size
         )
 
-        # Try to deduplicate backed up files
         if has_data:
-            file_obj = utils.HashableFile(file_obj)
-
             fingerprint = _get_file_fingerprint(stat_info)
-            file_hash = self.__deduplicate(path, stat_info, fingerprint, file_obj)
-            extern = file_hash is not None
-
-        # Add the file to the archive
-        tar_info = _get_tar_info(path, stat_info, link_target, extern)
-        self.__data.addfile(tar_info, fileobj = file_obj)
-
-        # Write the file's metadata
-        if has_data:
-            if not extern:
-                file_hash = file_obj.hexdigest()
-                self.__hashes.add(file_hash)
-
-            self.__write_file_metadata(path, file_hash, fingerprint, extern)
+            file_hash, status, offset = self.__add_data(path, stat_info, fingerprint, file_obj, file_hash)
+            self.__write_file_metadata(path, file_hash, stat_info.st_size, fingerprint, status, offset = offset)
+        else:
+            self.__add_member(_get_tar_info(path, stat_info, link_target), file_obj)
 
         if hard_link and link_target is None:
             self.__hardlink_inodes[inode] = path
@@ -199,9 +321,17 @@ class Backup:
         finally:
             self.__state = _STATE_CLOSED
 
+            if self.__memory_limit is not None:
+                self.__memory_limit.close()
+
 
-    def commit(self):
-        """Commits the changes."""
+    def commit(self, complete = True):
+        """Commits the changes.
+
+        complete is False if some files haven't been backed up due to errors,
+        so the following backups can't copy unchanged file trees from this
+        one.
+        """
 
         if self.__state != _STATE_OPENED:
             raise Error("The backup file is closed.")
@@ -209,7 +339,15 @@ class Backup:
         try:
             self.__close()
 
-            self.__storage.commit_backup(self.__group, self.__name)
+            if complete and self.__journal_state is not None:
+                backup_path = self.__storage.backup_path(self.__group, self.__name, temp = True)
+
+                try:
+                    journal.write_state(backup_path, self.__journal_state)
+                except Exception as e:
+                    LOG.error("Failed to save change journal state: %s.", psys.e(e))
+
+            self.__storage.commit_backup(self.__group, self.__name, index = self.__write_index())
             self.__state = _STATE_COMMITTED
 
             self.__storage.rotate_groups(self.__config["max_backup_groups"])
@@ -217,9 +355,71 @@ class Backup:
             self.close()
 
 
+    def is_clean(self, path):
+        """
+        Checks whether the specified file tree hasn't been changed since the
+        previous backup according to the change journal.
+        """
+
+        return self.__changes is not None and self.__changes.is_clean(path)
+
+
+    def need_data(self, path, stat_info):
+        """
+        Checks whether the specified file's data has to be read to add it to
+        the backup.
+
+        May be called from any thread.
+        """
+
+        return stat_info.st_size != 0 and self.__get_unchanged_file_hash(
+            path, _get_file_fingerprint(stat_info), stat_info.st_size) is None
+
+
+    def reuse_tree(self, path):
+        """Adds the specified unchanged file tree to the backup copying it from
+        the previous backup.
+
+        Returns a list of paths that can't be copied and have to be backed up
+        as usual or None if the previous backup doesn't contain the path.
+        """
+
+        if self.__state != _STATE_OPENED:
+            raise Error("The backup file is closed")
+
+        try:
+            tar_info = self.__prev_data.find(path)
+        except Exception as e:
+            LOG.error("Failed to read the previous backup's data: %s. Stop using change journal.", psys.e(e))
+            self.__changes = None
+            return None
+
+        if tar_info is None:
+            return None
+
+        LOG.debug("Copying '%s' from the previous backup...", path)
+
+        unresolved = []
+
+        while tar_info is not None:
+            self.__reuse_member(tar_info, unresolved)
+
+            try:
+                tar_info = self.__prev_data.next(path)
+            except Exception as e:
+                self.__changes = None
+                raise Error("Failed to read the previous backup's data: {}.", psys.e(e))
+
+        return unresolved
+
+
     def __close(self):
         """Closes all opened files."""
 
+        if self.__prev_data is not None:
+            self.__prev_data.close()
+            self.__prev_data = None
+
         try:
             if self.__data is not None:
                 try:
@@ -229,345 +429,1097 @@ class Backup:
                 finally:
                     self.__data = None
         finally:
-            if self.__metadata is not None:
+            try:
+                if self.__metadata is not None:
+                    try:
+                        self.__metadata.close()
+                    except Exception as e:
+                        raise Error("Unable to close backup metadata file: {}.", psys.e(e))
+                    finally:
+                        self.__metadata = None
+            finally:
+                try:
+                    if self.__raw_data is not None:
+                        try:
+                            self.__raw_data.close()
+                        except Exception as e:
+                            raise Error("Unable to close backup uncompressed data file: {}.", psys.e(e))
+                        finally:
+                            self.__raw_data = None
+                finally:
+                    try:
+                        self.__close_chunk_files()
+                    finally:
+                        self.__close_extra_metadata()
+
+
+    def __close_chunk_files(self):
+        """Closes chunk data and metadata files."""
+
+        try:
+            if self.__chunk_data is not None:
+                try:
+                    self.__chunk_data.close()
+                except Exception as e:
+                    raise Error("Unable to close backup chunk data file: {}.", psys.e(e))
+                finally:
+                    self.__chunk_data = None
+        finally:
+            if self.__chunk_metadata is not None:
                 try:
-                    self.__metadata.close()
+                    self.__chunk_metadata.close()
                 except Exception as e:
-                    raise Error("Unable to close backup metadata file: {}.", psys.e(e))
+                    raise Error("Unable to close backup chunk metadata file: {}.", psys.e(e))
                 finally:
-                    self.__metadata = None
+                    self.__chunk_metadata = None
 
 
-    def __deduplicate(self, path, stat_info, fingerprint, file_obj):
-        """Tries to deduplicate the specified file.
+    def __close_extra_metadata(self):
+        """Closes additional metadata files."""
 
-        Returns its hash if deduplication succeeded.
-        """
+        error = None
 
-        # No need to deduplicate empty files
-        if stat_info.st_size == 0:
-            return
+        for file_name, metadata_file in self.__extra_metadata.items():
+            try:
+                metadata_file.close()
+            except Exception as e:
+                error = Error("Unable to close backup metadata file {}: {}.", file_name, psys.e(e))
+
+        self.__extra_metadata.clear()
+
+        if error is not None:
+            raise error
+
+
+    def __add_data(self, path, stat_info, fingerprint, file_obj, file_hash):
+        """Adds a regular file with data to the backup trying to deduplicate it.
+
+        Returns a ( file_hash, status, offset ) tuple where offset is offset of
+        the file's data member or None if its data isn't stored in a member.
+        """
 
         # Check modify time
-        if self.__config["trust_modify_time"]:
-            prev_info = self.__prev_files.get(path)
+        extern_hash = self.__get_unchanged_file_hash(path, fingerprint, stat_info.st_size)
+        delta_base = None if extern_hash is not None else self.__get_delta_base(path, stat_info, file_hash)
+
+        sparse_map = None
+        if extern_hash is None and file_hash is None:
+            sparse_map = utils.get_sparse_map(file_obj, stat_info.st_size)
+
+        if extern_hash is not None:
+            LOG.debug(
+                "File '%s' hasn't been changed. Make it an extern file with %s hash.",
+                path, extern_hash)
+        elif delta_base is not None:
+            return self.__add_delta_data(path, stat_info, file_obj, *delta_base)
+        elif (
+            self.__config["chunking_threshold"] and
+            stat_info.st_size >= self.__config["chunking_threshold"] and
+            ( file_hash is None or file_hash not in self.__hashes )
+        ):
+            return self.__add_chunked_data(path, stat_info, file_obj)
+        elif (
+            ( file_hash is None or file_hash not in self.__hashes ) and
+            self.__is_incompressible(path, stat_info, file_obj)
+        ):
+            return self.__add_raw_data(path, stat_info, file_obj, file_hash, sparse_map)
+        elif file_hash is None and self.__sizes is not None and stat_info.st_size not in self.__sizes:
+            # There are no files of the same size, so it can't be a duplicate
+            LOG.debug("There are no files of %s size in the backup group. Add '%s' as unique.",
+                stat_info.st_size, path)
+            file_obj = _get_hashable_file(file_obj, stat_info, sparse_map)
+        else:
+            if file_hash is None and self.__config["single_pass_dedup"]:
+                if sparse_map is None and stat_info.st_size <= self.__config["spool_size"]:
+                    data = utils.read_file(file_obj, stat_info.st_size)
+                    file_obj, file_hash = io.BytesIO(data), sha256(data).hexdigest()
+                    del data
+                else:
+                    file_obj = _get_hashable_file(file_obj, stat_info, sparse_map)
 
-            if prev_info is not None:
-                prev_hash, prev_fingerprint = prev_info
+                    savepoint = self.__data.savepoint()
+                    if savepoint is None:
+                        return self.__add_spooled_data(path, stat_info, file_obj)
 
-                if fingerprint == prev_fingerprint:
-                    LOG.debug(
-                        "File '%s' hasn't been changed. Make it an extern file with %s hash.",
-                        path, prev_hash)
+                    return self.__add_data_speculatively(path, stat_info, file_obj, savepoint)
 
-                    return prev_hash
+            if file_hash is None:
+                file_obj = _get_hashable_file(file_obj, stat_info, sparse_map)
+                file_hash = self.__hash_file(stat_info, file_obj)
 
-        # Find files with the same hash -->
-        file_size = 0
+            # Find files with the same hash
+            if file_hash in self.__hashes:
+                LOG.debug("Make '%s' an extern file with %s hash.", path, file_hash)
+                extern_hash = file_hash
 
-        while file_size < stat_info.st_size:
-            data = file_obj.read(
-                min(psys.BUFSIZE, stat_info.st_size - file_size))
+        if extern_hash is not None:
+            self.__add_member(_get_tar_info(path, stat_info, extern = True))
+            return extern_hash, _FILE_STATUS_EXTERN, None
 
-            if data:
-                file_size += len(data)
-            elif file_size == stat_info.st_size:
-                break
-            else:
-                raise Error("The file has been truncated during the backup.")
+        signed_file = self.__get_signed_file(stat_info, file_obj)
+        offset = self.__add_member(_get_data_tar_info(path, stat_info, file_obj), signed_file or file_obj)
 
-        file_hash = file_obj.hexdigest()
-        file_obj.reset()
+        if isinstance(file_obj, ( utils.HashableFile, utils.SparseFile )):
+            # Use the hash of the data that has been actually written
+            file_hash = file_obj.hexdigest()
 
-        if file_hash in self.__hashes:
-            LOG.debug("Make '%s' an extern file with %s hash.", path, file_hash)
-            return file_hash
-        # Find files with the same hash <--
+        self.__add_unique_file(file_hash, stat_info.st_size, signed_file)
 
+        return file_hash, _FILE_STATUS_UNIQUE, offset
 
 
-    def __load_all_backup_metadata(self, trust_modify_time):
-        """Loads all metadata from previous backups."""
+    def __add_delta_data(self, path, stat_info, file_obj, base_hash, base_signature):
+        """
+        Adds a big regular file which has been changed since the previous
+        backup storing only its blocks which differ from the previous version.
 
-        try:
-            backups = self.__storage.backups(self.__group, reverse = True)
+        Returns a ( file_hash, status, offset ) tuple.
+        """
 
-            for backup_id, backup in enumerate(backups):
-                self.__load_backup_metadata(backup,
-                    with_prev_files_info = trust_modify_time and not backup_id)
-        except Exception as e:
-            LOG.error("Failed to load metadata from previous backups: %s.", psys.e(e))
+        chain_length, block_size, base_block_hashes = base_signature
+        size = stat_info.st_size
 
+        file_hash = sha256()
+        block_hashes = []
 
-    def __load_backup_metadata(self, name, with_prev_files_info):
-        """Loads the specified backup's metadata."""
+        with tempfile.TemporaryFile() as delta_file:
+            delta_file.write(_DELTA_HEADER.pack(size, block_size))
 
-        def handle_metadata(hash, status, fingerprint, path):
-            if status == _FILE_STATUS_UNIQUE:
-                self.__hashes.add(hash)
+            for offset in range(0, size, block_size):
+                block = utils.read_file(file_obj, min(block_size, size - offset))
+                file_hash.update(block)
 
-            if with_prev_files_info:
-                self.__prev_files.setdefault(path, ( hash, fingerprint ))
+                block_id = len(block_hashes)
+                block_hashes.append(utils.get_block_hash(block))
 
-        _load_metadata(self.__storage.backup_path(self.__group, name), handle_metadata)
+                if block_id >= len(base_block_hashes) or block_hashes[-1] != base_block_hashes[block_id]:
+                    delta_file.write(_DELTA_BLOCK_HEADER.pack(block_id, len(block)))
+                    delta_file.write(block)
 
+            file_hash = file_hash.hexdigest()
 
-    def __write_file_metadata(self, path, file_hash, fingerprint, extern):
-        """Writes the specified file metadata."""
+            if file_hash in self.__hashes:
+                LOG.debug("Make '%s' an extern file with %s hash.", path, file_hash)
+                self.__add_member(_get_tar_info(path, stat_info, extern = True))
+                return file_hash, _FILE_STATUS_EXTERN, None
 
-        metadata = "{hash} {status} {fingerprint} {path}\n".format(
-            hash = file_hash, fingerprint = fingerprint, path = path,
-            status = _FILE_STATUS_EXTERN if extern else _FILE_STATUS_UNIQUE)
+            tar_info = _get_tar_info(path, stat_info)
+            tar_info.size = delta_file.tell()
+            delta_file.seek(0)
 
-        self.__metadata.write(metadata.encode(_ENCODING))
+            LOG.debug("Add '%s' as a delta against %s (%s bytes).", path, base_hash, tar_info.size)
+            offset = self.__add_member(tar_info, delta_file)
 
+        self.__write_extra_metadata(_DELTAS_FILE_NAME, "{} {}\n".format(file_hash, base_hash))
+        self.__add_unique_file(file_hash, size)
+        self.__write_signature(file_hash, chain_length + 1, block_size, block_hashes)
 
+        return file_hash, _FILE_STATUS_DELTA, offset
 
-class Restore:
-    """Controls backup restoring."""
 
-    def __init__(self, backup_path, restore_path = None, in_place = False):
-        # Backup name
-        self.__name = None
+    def __add_chunk(self, chunk_hash, chunk):
+        """Adds a chunk to the backup chunk data file."""
 
-        # Backup group name
-        self.__group = None
+        self.__open_chunk_files()
 
-        # Backup data storage abstraction
-        self.__storage = None
+        tar_info = tarfile.TarInfo(chunk_hash)
+        tar_info.mode = 0o600
+        tar_info.size = len(chunk)
 
-        # Restore path
-        self.__restore_path = restore_path
+        self.__chunk_data.addfile(tar_info, fileobj = io.BytesIO(chunk))
+        self.__chunks.add(chunk_hash)
 
-        # Don't use extra disc space by decompressing backup files
-        self.__in_place = in_place
 
-        # Current object state
-        self.__state = _STATE_OPENED
+    def __add_chunked_data(self, path, stat_info, file_obj):
+        """
+        Adds a big regular file to the backup splitting it into chunks which
+        are deduplicated separately.
 
+        Returns a ( file_hash, status, offset ) tuple.
+        """
 
-        # Data file
-        self.__data = None
+        file_hash = sha256()
+        chunk_hashes = []
+        new_chunks = 0
 
-        # Extern files
-        self.__extern_files = {}
+        for chunk in chunking.iterate_chunks(file_obj, stat_info.st_size, self.__config["chunk_size"]):
+            file_hash.update(chunk)
 
-        # All backups with extern files with cached metadata
-        self.__backups = []
+            chunk_hash = sha256(chunk).hexdigest()
+            chunk_hashes.append(chunk_hash)
 
-        # False if something went wrong during the restore
-        self.__ok = True
+            if chunk_hash not in self.__chunks:
+                self.__add_chunk(chunk_hash, chunk)
+                new_chunks += 1
 
+        file_hash = file_hash.hexdigest()
+        self.__add_member(_get_tar_info(path, stat_info, extern = True))
 
-        try:
-            LOG.info("Restoring backup '%s'...", backup_path)
+        if file_hash in self.__hashes:
+            LOG.debug("Make '%s' an extern file with %s hash.", path, file_hash)
+            return file_hash, _FILE_STATUS_EXTERN, None
 
-            self.__name, self.__group, self.__storage = Storage.create(backup_path)
-            if self.__restore_path is None:
-                self.__restore_path = self.__name
+        LOG.debug("Add '%s' as %s chunks (%s of them are new).", path, len(chunk_hashes), new_chunks)
 
-            try:
-                self.__data = utils.CompressedTarFile(
-                    os.path.join(backup_path, _DATA_FILE_NAME),
-                    decompress = not self.__in_place)
-            except Exception as e:
-                raise Error("Unable to open data of '{}' backup: {}.",
-                    backup_path, psys.e(e))
+        self.__open_chunk_files()
+        self.__chunk_metadata.write("{} {}\n".format(file_hash, " ".join(chunk_hashes)).encode(_ENCODING))
+        self.__add_unique_file(file_hash, stat_info.st_size)
 
-            self.__init_metadata_cache()
-        except:
-            self.close()
-            raise
+        return file_hash, _FILE_STATUS_CHUNKED, None
 
 
-    def __enter__(self):
-        return self
+    def __add_raw_data(self, path, stat_info, file_obj, file_hash, sparse_map):
+        """
+        Adds an incompressible regular file to the backup storing its data in
+        the uncompressed data file.
 
+        The uncompressed data file supports rollback, so the data is always
+        written speculatively and the file is read only once.
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.close()
-        return False
+        Returns a ( file_hash, status, offset ) tuple.
+        """
 
+        raw_data = self.__open_raw_data()
 
-    def close(self):
-        """Closes the object."""
+        if file_hash is None:
+            file_obj = _get_hashable_file(file_obj, stat_info, sparse_map)
 
-        if self.__state == _STATE_CLOSED:
-            return
+        signed_file = self.__get_signed_file(stat_info, file_obj)
+        savepoint = raw_data.savepoint()
 
-        try:
-            for backup in self.__backups:
-                if backup["data"] is not self.__data:
-                    try:
-                        backup["data"].close()
-                    except Exception as e:
-                        LOG.error("Failed to close a data file of '%s' backup: %s.", backup["name"], e)
+        offset = self.__add_member(_get_data_tar_info(path, stat_info, file_obj),
+            signed_file or file_obj, savepoint = savepoint, data = raw_data)
 
-            del self.__backups[:]
+        if file_hash is None:
+            file_hash = file_obj.hexdigest()
 
-            if self.__data is not None:
-                try:
-                    self.__data.close()
-                except Exception as e:
-                    LOG.error("Failed to close a data file of '%s' backup: %s.", self.__name, e)
-                finally:
-                    self.__data = None
+        if file_hash in self.__hashes:
+            LOG.debug("Make '%s' an extern file with %s hash (rolling back its data).", path, file_hash)
+            raw_data.rollback(savepoint)
+            status, offset = _FILE_STATUS_EXTERN, None
+        else:
+            LOG.debug("Add '%s' as incompressible.", path)
+            self.__add_unique_file(file_hash, stat_info.st_size, signed_file)
+            status = _FILE_STATUS_RAW
 
-            self.__extern_files.clear()
-        finally:
-            self.__state = _STATE_CLOSED
+        self.__add_member(_get_tar_info(path, stat_info, extern = True))
 
+        return file_hash, status, offset
 
-    def restore(self, paths_to_restore = None):
-        """Restores the backup.
 
-        Returns True if all files has been successfully restored.
+    def __add_data_speculatively(self, path, stat_info, file_obj, savepoint):
         """
+        Adds a regular file with data to the backup hashing the data while
+        writing it and rolls the data back if the file turns out to be a
+        duplicate. So the file is read only once.
 
-        if self.__state != _STATE_OPENED:
-            raise Error("The backup file is closed.")
+        Returns a ( file_hash, status, offset ) tuple.
+        """
 
+        signed_file = self.__get_signed_file(stat_info, file_obj)
+        offset = self.__add_member(_get_data_tar_info(path, stat_info, file_obj),
+            signed_file or file_obj, savepoint = savepoint)
+        file_hash = file_obj.hexdigest()
 
-        try:
-            os.mkdir(self.__restore_path, 0o700)
-        except Exception as e:
-            raise Error("Unable to create restore directory '{}': {}.",
-                self.__restore_path, psys.e(e))
+        if file_hash not in self.__hashes:
+            self.__add_unique_file(file_hash, stat_info.st_size, signed_file)
+            return file_hash, _FILE_STATUS_UNIQUE, offset
 
+        LOG.debug("Make '%s' an extern file with %s hash (rolling back its data).", path, file_hash)
 
-        files = []
+        self.__data.rollback(savepoint)
+        self.__add_member(_get_tar_info(path, stat_info, extern = True))
 
-        LOG.debug("Loading the backup's data...")
+        return file_hash, _FILE_STATUS_EXTERN, None
 
-        try:
-            for tar_info in self.__data:
-                files.append(tar_info)
-        except Exception as e:
-            LOG.error("Failed to load the backup's data: %s.", psys.e(e))
-            self.__ok = False
-        else:
-            LOG.debug("The backup's data has been successfully loaded")
 
+    def __add_spooled_data(self, path, stat_info, file_obj):
+        """
+        Adds a regular file with data to the backup copying it to a temporary
+        file while hashing it, so the file is read only once even if the
+        backup data file doesn't support rollback (it's compressed).
 
-        directories = []
+        Returns a ( file_hash, status, offset ) tuple.
+        """
 
-        for tar_info in files:
-            path = "/" + tar_info.name
+        tar_info = _get_data_tar_info(path, stat_info, file_obj)
 
-            if paths_to_restore is not None:
-                for path_to_restore in paths_to_restore:
-                    if path == path_to_restore or path.startswith(path_to_restore + os.path.sep):
-                        break
-                else:
-                    continue
+        # Spool to the backup's directory, because the default temporary
+        # directory may be in memory
+        backup_path = self.__storage.backup_path(self.__group, self.__name, temp = True)
 
-            restore_path = os.path.join(self.__restore_path, tar_info.name)
+        with utils.spool_file(file_obj, tar_info.size, backup_path) as spool:
+            file_hash = file_obj.hexdigest()
 
-            LOG.info("Restoring '%s'...", path)
+            if file_hash in self.__hashes:
+                LOG.debug("Make '%s' an extern file with %s hash.", path, file_hash)
+                self.__add_member(_get_tar_info(path, stat_info, extern = True))
+                return file_hash, _FILE_STATUS_EXTERN, None
 
-            try:
-                if tar_info.isdir():
-                    os.makedirs(restore_path, mode = 0o700)
-                    directories.append(tar_info)
-                elif tar_info.islnk():
-                    target_path = os.path.join(self.__restore_path, tar_info.linkname)
+            signed_file = None if isinstance(file_obj, utils.SparseFile) else self.__get_signed_file(stat_info, spool)
+            offset = self.__add_member(tar_info, signed_file or spool)
 
-                    try:
-                        os.link(target_path, restore_path)
-                    except Exception as e:
-                        raise Error("Unable to create a hard link to '{}': {}.", target_path, psys.e(e))
-                else:
-                    extern_hash = self.__extern_files.get(path) if tar_info.isreg() else None
+        self.__add_unique_file(file_hash, stat_info.st_size, signed_file)
 
-                    try:
-                        if extern_hash is None:
-                            try:
-                                self.__data.extract(tar_info,
-                                    path = self.__restore_path, set_attrs = False)
-                            except Exception as e:
-                                raise Error("Unable to extract the file from backup: {}.", psys.e(e))
-                        else:
-                            self.__restore_extern_file(tar_info, extern_hash)
-                    finally:
-                        self.__restore_attributes(tar_info, restore_path)
-            except Exception as e:
-                LOG.error("Failed to restore '%s': %s", path, psys.e(e))
-                self.__ok = False
+        return file_hash, _FILE_STATUS_UNIQUE, offset
 
-        directories.sort(key = lambda tar_info: tar_info.name, reverse = True)
 
-        for tar_info in directories:
-            self.__restore_attributes(tar_info,
-                os.path.join(self.__restore_path, tar_info.name))
+    def __add_unique_file(self, file_hash, size, signed_file = None):
+        """Adds a unique file to the deduplication indexes.
 
-        return self.__ok
+        signed_file is a utils.BlockHashingFile object the file's data has been
+        written through if the file's signature has to be saved.
+        """
 
+        self.__hashes.add(file_hash)
 
+        if self.__sizes is not None:
+            self.__sizes.add(size)
 
-    def __init_metadata_cache(self):
-        """Initializes the backup metadata cache."""
+        if signed_file is not None:
+            self.__write_signature(file_hash, 0,
+                self.__config["delta_block_size"], signed_file.block_hashes())
 
-        def handle_metadata(hash, status, fingerprint, path):
-            if status == _FILE_STATUS_EXTERN:
-                self.__extern_files[path] = hash
 
-        backup_path = self.__storage.backup_path(self.__group, self.__name)
-        self.__ok &= _load_metadata(backup_path, handle_metadata)
+    def __add_member(self, tar_info, file_obj = None, savepoint = None, data = None):
+        """Adds a member to the backup data archive (or the specified one).
 
-        if self.__extern_files:
-            try:
-                backups = self.__storage.backups(self.__group)
-            except Exception as e:
-                LOG.error("Failed to read metadata for backup group %s: %s", self.__group, e)
-            else:
-                extern_hashes = set(self.__extern_files.values())
+        If the archive supports it, rolls back everything written on error, so
+        the archive stays consistent.
 
-                for name in backups:
-                    hashes, paths = self.__load_backup_metadata(
-                        self.__storage.backup_path(self.__group, name))
+        Returns the member's offset.
+        """
 
-                    hashes &= extern_hashes
+        if data is None:
+            data = self.__data
 
-                    if hashes:
-                        backup = self.__load_backup_data(name, hashes, paths)
-                        if backup is not None:
-                            self.__backups.append(backup)
+        if savepoint is None:
+            savepoint = data.savepoint()
 
-                self.__backups.sort(
-                    key = lambda backup: len(backup["files"]), reverse = True)
+        try:
+            return data.addfile(tar_info, fileobj = file_obj)
+        except:
+            if savepoint is not None:
+                try:
+                    data.rollback(savepoint)
+                except Exception as e:
+                    LOG.error("Failed to roll back the backup data archive: %s.", psys.e(e))
 
-                if self.__backups:
-                    LOG.debug("Restoring extern data from the following backups: %s.",
-                        ", ".join(backup["name"] for backup in self.__backups))
+            raise
 
 
-    def __load_backup_data(self, name, hashes, paths):
-        """Loads the specified backup's data."""
+    def __get_delta_base(self, path, stat_info, file_hash):
+        """
+        Returns a ( base_hash, base_signature ) tuple for the previous version
+        of the specified file if the file can be stored as a delta against it.
+        """
 
-        files = {}
-        data = None
-        backup_path = self.__storage.backup_path(self.__group, name)
+        if (
+            not self.__config["delta_threshold"] or
+            stat_info.st_size < self.__config["delta_threshold"] or
+            file_hash in self.__hashes
+        ):
+            return
 
-        LOG.debug("Loading data of '%s' backup...", backup_path)
+        prev_info = self.__prev_files.get(path)
+        if prev_info is None:
+            return
 
-        try:
-            if name == self.__name:
-                data = self.__data
-            else:
-                data = utils.CompressedTarFile(
-                    os.path.join(backup_path, _DATA_FILE_NAME),
-                    decompress = not self.__in_place)
+        base_hash = prev_info[0]
+        base_signature = self.__signatures.get(base_hash)
 
-            for tar_info in data:
-                hash = paths.get("/" + tar_info.name)
-                if hash is not None and hash in hashes:
-                    files[hash] = tar_info
-        except Exception as e:
-            LOG.error("Failed to load data of '%s' backup: %s.", backup_path, psys.e(e))
+        if (
+            base_signature is None or
+            base_signature[0] >= self.__config["max_delta_chain"] or
+            base_signature[1] != self.__config["delta_block_size"]
+        ):
+            return
+
+        return base_hash, base_signature
+
+
+    def __get_signed_file(self, stat_info, file_obj):
+        """
+        Wraps the file object to compute its signature while reading it if the
+        file may be delta encoded in the following backups.
+
+        Returns None if the signature isn't needed.
+        """
+
+        if (
+            self.__config["delta_threshold"] and
+            stat_info.st_size >= self.__config["delta_threshold"] and
+            not isinstance(file_obj, utils.SparseFile)
+        ):
+            return utils.BlockHashingFile(file_obj, self.__config["delta_block_size"])
+
+
+    def __is_incompressible(self, path, stat_info, file_obj):
+        """
+        Checks whether the specified file has to be stored uncompressed: by
+        its extension or by compressibility of its data sample.
+        """
+
+        if self.__config["compression"] == "none" or stat_info.st_size < _MIN_RAW_SIZE:
+            return False
+
+        extension = os.path.splitext(path)[1][1:].lower()
+        if extension and extension in self.__config["incompressible_extensions"]:
+            return True
+
+        if not self.__config["detect_incompressible"]:
+            return False
+
+        sample = file_obj.read(_COMPRESSIBILITY_SAMPLE_SIZE)
+        file_obj.seek(0)
+
+        return len(zlib.compress(sample, 1)) >= len(sample) * _MAX_COMPRESSION_RATIO
+
+
+    def __get_unchanged_file_hash(self, path, fingerprint, size):
+        """
+        Returns hash of the specified file if it hasn't been changed since the
+        previous backup (even if it has been moved or renamed).
+        """
+
+        if self.__config["trust_modify_time"]:
+            prev_info = self.__prev_files.get(path)
+
+            if prev_info is not None:
+                prev_hash, prev_fingerprint, prev_size = prev_info
+
+                if _is_same_file(fingerprint, prev_fingerprint):
+                    return prev_hash
+
+            # An inode may be reused by another file, so moved files are
+            # looked up only by fingerprints with subsecond modify time
+            if _is_precise_fingerprint(fingerprint):
+                return self.__prev_fingerprints.get(( fingerprint, size ))
+
+
+    def __hash_file(self, stat_info, file_obj):
+        """Reads the whole file to get its hash and rewinds it back."""
+
+        size = file_obj.size if isinstance(file_obj, utils.SparseFile) else stat_info.st_size
+        utils.read_file(file_obj, size, discard = True)
+
+        file_hash = file_obj.hexdigest()
+        file_obj.reset()
+
+        return file_hash
+
+
+    def __load_all_backup_metadata(self):
+        """Loads all metadata from previous backups."""
+
+        try:
+            backups = self.__storage.backups(self.__group, reverse = True)
+            group_index = index.load(self.__storage.index_path(self.__group), backups, self.__prev_files)
+
+            if group_index is None:
+                LOG.debug("Building backup group index...")
+                self.__prev_files.clear()
+
+                # Backups are loaded from the newest one, so files missing in
+                # the previous backup (vanished for a while, filtered out
+                # temporarily, etc.) are resolved to their newest known version
+                ok = all([ self.__load_backup_metadata(backup) for backup in backups ])
+            else:
+                self.__hashes, self.__sizes, self.__chunks = group_index
+                ok = True
+
+            for file_hash, fingerprint, size in self.__prev_files.values():
+                if size is not None and _is_precise_fingerprint(fingerprint):
+                    self.__prev_fingerprints.setdefault(( fingerprint, size ), file_hash)
+
+            if ok:
+                self.__index_backups = backups + [ self.__name ]
+
+            if self.__config["delta_threshold"]:
+                self.__load_signatures(backups)
+        except Exception as e:
+            LOG.error("Failed to load metadata from previous backups: %s.", psys.e(e))
+
+
+    def __load_backup_metadata(self, name):
+        """Loads the specified backup's metadata.
+
+        Returns False if some of the metadata hasn't been loaded.
+        """
+
+        def handle_metadata(hash, status, size, fingerprint, path):
+            if status in ( _FILE_STATUS_UNIQUE, _FILE_STATUS_RAW, _FILE_STATUS_CHUNKED, _FILE_STATUS_DELTA ):
+                self.__hashes.add(hash)
+
+                if size is None:
+                    self.__sizes = None
+                elif self.__sizes is not None:
+                    self.__sizes.add(size)
+
+            self.__prev_files.setdefault(path, ( hash, fingerprint, size ))
+
+        def handle_chunk_metadata(file_hash, chunk_hashes):
+            self.__chunks.update(chunk_hashes)
+
+        backup_path = self.__storage.backup_path(self.__group, name)
+
+        return (
+            _load_metadata(backup_path, handle_metadata) &
+            _load_hash_lists(backup_path, _CHUNK_METADATA_FILE_NAME, handle_chunk_metadata)
+        )
+
+
+    def __load_signatures(self, backups):
+        """Loads signatures of the previous backups' files."""
+
+        base_hashes = set(
+            file_hash for file_hash, fingerprint, size in self.__prev_files.values()
+                if size is not None and size >= self.__config["delta_threshold"])
+
+        def handle_signature(file_hash, signature):
+            if file_hash in base_hashes:
+                self.__signatures.setdefault(file_hash,
+                    ( int(signature[0]), int(signature[1]), signature[2:] ))
+
+        if base_hashes:
+            for name in backups:
+                _load_hash_lists(self.__storage.backup_path(self.__group, name),
+                    _SIGNATURES_FILE_NAME, handle_signature)
+
+
+    def __open_chunk_files(self):
+        """Opens chunk data and metadata files if they aren't opened yet."""
+
+        if self.__chunk_data is not None:
+            return
+
+        path = self.__storage.backup_path(self.__group, self.__name, temp = True)
+
+        try:
+            self.__chunk_data = utils.MultiVolumeTarFile(
+                os.path.join(path, _CHUNK_DATA_FILE_NAME),
+                write = self.__config["compression"],
+                threads = self.__config["compression_threads"],
+                level = self.__config["compression_level"] or None,
+                max_volume_size = self.__config["max_volume_size"])
+
+            self.__chunk_metadata = bz2.BZ2File(
+                os.path.join(path, _CHUNK_METADATA_FILE_NAME), mode = "w")
+        except Exception as e:
+            try:
+                self.__close_chunk_files()
+            except Exception as close_error:
+                LOG.error("%s", close_error)
+
+            raise Error("Unable to create backup chunk files in '{}': {}.", path, psys.e(e))
+
+
+    def __open_raw_data(self):
+        """Opens the uncompressed data file if it isn't opened yet."""
+
+        if self.__raw_data is None:
+            path = self.__storage.backup_path(self.__group, self.__name, temp = True)
+
+            try:
+                self.__raw_data = utils.MultiVolumeTarFile(
+                    os.path.join(path, _RAW_DATA_FILE_NAME), write = "none",
+                    max_volume_size = self.__config["max_volume_size"])
+            except Exception as e:
+                raise Error("Unable to create a backup uncompressed data tar archive in '{}': {}.",
+                    path, psys.e(e))
+
+        return self.__raw_data
+
+
+    def __open_journal(self):
+        """Opens the change journal."""
+
+        prev_backup_path = prev_state = None
+
+        try:
+            backups = self.__storage.backups(self.__group, reverse = True)
+        except Exception as e:
+            LOG.error("Failed to get the previous backup: %s.", psys.e(e))
+        else:
+            if backups:
+                prev_backup_path = self.__storage.backup_path(self.__group, backups[0])
+                prev_state = journal.read_state(prev_backup_path)
+
+        journal_obj = journal.Journal(self.__storage.journal_path(), self.__config, prev_state)
+        self.__journal_state = journal_obj.state
+
+        if self.__journal_state is None or prev_state is None or not self.__config["trust_modify_time"]:
+            return
+
+        changes = journal_obj.changes(prev_state)
+        if changes is None:
+            return
+
+        self.__prev_data = _DataCursor(os.path.join(prev_backup_path, _DATA_FILE_NAME))
+        self.__changes = changes
+
+
+    def __reuse_member(self, tar_info, unresolved):
+        """Adds a member of the previous backup to this backup."""
+
+        path = "/" + tar_info.name
+        prev_info = self.__prev_files.get(path) if tar_info.isreg() else None
+
+        if (
+            path in self.__files or
+            tar_info.islnk() and "/" + tar_info.linkname not in self.__files or
+            tar_info.isreg() and tar_info.size and ( prev_info is None or prev_info[2] is None )
+        ):
+            unresolved.append(path)
+            return
+
+        tar_info = copy.copy(tar_info)
+        tar_info.pax_headers = {
+            name: value for name, value in tar_info.pax_headers.items()
+                if name not in tarfile.PAX_FIELDS and not name.startswith(_SPARSE_HEADER_PREFIX) }
+
+        if prev_info is not None:
+            # Files with data become extern
+            tar_info.size = 0
+
+        self.__files[path] = None
+        self.__add_member(tar_info)
+
+        if prev_info is not None:
+            file_hash, fingerprint, size = prev_info
+            self.__write_file_metadata(path, file_hash, size, fingerprint, _FILE_STATUS_EXTERN)
+
+            if self.__config["preserve_hard_links"]:
+                device, inode = fingerprint.split(":")[:2]
+                self.__hardlink_inodes.setdefault(( int(device), int(inode) ), path)
+
+
+    def __write_extra_metadata(self, file_name, line):
+        """Writes a line to the specified additional metadata file."""
+
+        metadata_file = self.__extra_metadata.get(file_name)
+
+        if metadata_file is None:
+            path = os.path.join(self.__storage.backup_path(self.__group, self.__name, temp = True), file_name)
+
+            try:
+                metadata_file = bz2.BZ2File(path, mode = "w")
+            except Exception as e:
+                raise Error("Unable to create a backup metadata file '{}': {}.", path, psys.e(e))
+
+            self.__extra_metadata[file_name] = metadata_file
+
+        metadata_file.write(line.encode(_ENCODING))
+
+
+    def __write_index(self):
+        """Writes the backup group index.
+
+        Returns True if the index has been written.
+        """
+
+        if self.__index_backups is None:
+            return False
+
+        index_path = self.__storage.index_path(self.__group, temp = True)
+
+        try:
+            index.write(index_path, self.__index_backups,
+                self.__hashes, self.__sizes, self.__chunks, self.__prev_files)
+        except Exception as e:
+            LOG.error("Failed to write backup group index '%s': %s.", index_path, psys.e(e))
+
+            try:
+                os.unlink(index_path)
+            except EnvironmentError:
+                pass
+
+            return False
+
+        return True
+
+
+    def __write_signature(self, file_hash, chain_length, block_size, block_hashes):
+        """Writes the specified file's signature."""
+
+        self.__write_extra_metadata(_SIGNATURES_FILE_NAME, "{} {} {} {}\n".format(
+            file_hash, chain_length, block_size, " ".join(block_hashes)))
+
+
+    def __write_file_metadata(self, path, file_hash, size, fingerprint, status, offset = None):
+        """Writes the specified file metadata.
+
+        offset is offset of the file's data member if its data is stored in
+        the backup.
+        """
+
+        self.__metadata.add(file_hash, status, size, fingerprint, path, offset = offset)
+        self.__prev_files[path] = ( file_hash, fingerprint, size )
+
+
+
+class Restore:
+    """Controls backup restoring."""
+
+    def __init__(self, backup_path, restore_path = None, in_place = False, jobs = 1):
+        # Backup name
+        self.__name = None
+
+        # Backup group name
+        self.__group = None
+
+        # Backup data storage abstraction
+        self.__storage = None
+
+        # Restore path
+        self.__restore_path = restore_path
+
+        # Don't use extra disc space by decompressing backup files
+        self.__in_place = in_place
+
+        # Number of threads that restore files
+        self.__jobs = jobs
+
+        # Current object state
+        self.__state = _STATE_OPENED
+
+
+        # Data file path
+        self.__data_path = os.path.join(backup_path, _DATA_FILE_NAME)
+
+        # Data file
+        self.__data = None
+
+        # Extern files: a map of their paths to hashes or the backup's binary
+        # metadata (metadata.Reader) which is looked up instead
+        self.__extern_files = {}
+
+        # All backups with extern files with cached metadata
+        self.__backups = []
+
+        # Chunk lists of chunked files
+        self.__chunked_files = {}
+
+        # Delta file hashes to their base file hashes mapping
+        self.__deltas = {}
+
+        # Chunk hashes to ( data file, member offset ) mapping
+        self.__chunks = {}
+
+        # Opened chunk data files
+        self.__chunk_data = []
+
+        # False if something went wrong during the restore
+        self.__ok = True
+
+
+        try:
+            LOG.info("Restoring backup '%s'...", backup_path)
+
+            self.__name, self.__group, self.__storage = Storage.create(backup_path)
+            if self.__restore_path is None:
+                self.__restore_path = self.__name
+
+            try:
+                self.__data = utils.MultiVolumeTarFile(
+                    self.__data_path, decompress = not self.__in_place)
+            except Exception as e:
+                raise Error("Unable to open data of '{}' backup: {}.",
+                    backup_path, psys.e(e))
+
+            self.__init_metadata_cache()
+        except:
+            self.close()
+            raise
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+
+    def close(self):
+        """Closes the object."""
+
+        if self.__state == _STATE_CLOSED:
+            return
+
+        try:
+            for backup in self.__backups:
+                if backup["data"] is not self.__data:
+                    try:
+                        backup["data"].close()
+                    except Exception as e:
+                        LOG.error("Failed to close a data file of '%s' backup: %s.", backup["name"], e)
+
+            del self.__backups[:]
+
+            for data in self.__chunk_data:
+                try:
+                    data.close()
+                except Exception as e:
+                    LOG.error("Failed to close a chunk data file: %s.", e)
+
+            del self.__chunk_data[:]
+            self.__chunks.clear()
+
+            if self.__data is not None:
+                try:
+                    self.__data.close()
+                except Exception as e:
+                    LOG.error("Failed to close a data file of '%s' backup: %s.", self.__name, e)
+                finally:
+                    self.__data = None
+
+            if isinstance(self.__extern_files, metadata.Reader):
+                self.__extern_files.close()
+
+            self.__extern_files = {}
+        finally:
+            self.__state = _STATE_CLOSED
+
+
+    def restore(self, paths_to_restore = None, globs = None, regexes = None):
+        """Restores the backup.
+
+        If paths to restore or glob patterns or regular expressions are
+        specified, only the matching files are restored (see PathMatcher).
+
+        Returns True if all files has been successfully restored.
+        """
+
+        if self.__state != _STATE_OPENED:
+            raise Error("The backup file is closed.")
+
+        if paths_to_restore is None and not globs and not regexes:
+            matcher = None
+        else:
+            matcher = PathMatcher(paths_to_restore or (), globs or (), regexes or ())
+
+
+        try:
+            os.mkdir(self.__restore_path, 0o700)
+        except Exception as e:
+            raise Error("Unable to create restore directory '{}': {}.",
+                self.__restore_path, psys.e(e))
+
+
+        # The backup's data is read in one pass and its members are restored
+        # as they are read. Files whose data is stored in other files are
+        # restored after it in the order of their data in these files, so each
+        # file is read sequentially too. Only names and attributes of the
+        # deferred files and directories are kept in memory.
+        #
+        # When restoring by a few threads, each thread reads its own part of
+        # the backup's data (if the data has an index) and then data of each
+        # other file is read by its own thread. Parent directories are created
+        # before their contents, hard links are created after their targets
+        # and attributes of directories are restored after all their contents.
+        directories = []
+        extern_files = []
+        hard_links = []
+
+        LOG.debug("Restoring the backup's data...")
+
+        executor = ThreadPoolExecutor(max_workers = self.__jobs) if self.__jobs > 1 else None
+
+        try:
+            members = self.__get_indexed_members(matcher) if executor is not None else None
+
+            if members is None:
+                self.__restore_members(self.__data, self.__iterate_members(matcher),
+                    directories, extern_files, hard_links)
+            else:
+                self.__restore_members_in_parallel(executor, members,
+                    directories, extern_files, hard_links)
+
+            self.__restore_extern_files(extern_files, executor = executor)
+            del extern_files
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        for name, target in hard_links:
+            self.__restore_hard_link(name, target)
+
+        directories.sort(reverse = True)
+
+        for name, attributes in directories:
+            self.__restore_attributes(os.path.join(self.__restore_path, name), attributes)
+
+        return self.__ok
+
+
+
+    def __find_extern_member(self, file_hash):
+        """
+        Finds a member with data of the specified extern file.
+
+        Returns a ( backup_id, member offset ) tuple or None.
+        """
+
+        for backup_id, backup in enumerate(self.__backups):
+            offset = backup["files"].get(file_hash)
+            if offset is not None:
+                return backup_id, offset
+
+
+    def __get_extern_hash(self, path):
+        """Returns hash of the specified file if it's an extern file."""
+
+        if isinstance(self.__extern_files, metadata.Reader):
+            record = self.__extern_files.find(path)
+            return record[0] if record is not None and record[1] in _EXTERN_FILE_STATUSES else None
+
+        return self.__extern_files.get(path)
+
+
+    def __get_indexed_members(self, matcher):
+        """
+        Returns a list of ( offset, name ) tuples of the backup's members which
+        have to be restored sorted by their offsets or None if the backup's data
+        has no index.
+        """
+
+        names = self.__select_members(matcher)
+        if names is None:
+            return None
+
+        index = self.__data.indexed_members(names)
+        if index is None:
+            return None
+
+        return sorted(( offset, name ) for name, offset in index.items())
+
+
+    def __iterate_members(self, matcher):
+        """Iterates over the backup's members which have to be restored."""
+
+        if matcher is None:
+            yield from self.__data
+            return
+
+        names = self.__select_members(matcher)
+
+        if names is not None:
+            # Read only the members being restored in the archive order
+            yield from self.__data.members(names)
+        else:
+            for tar_info in self.__data:
+                if matcher.match("/" + tar_info.name):
+                    yield tar_info
+
+
+    def __select_members(self, matcher):
+        """
+        Returns names of the backup's members which have to be restored or
+        None if the names can't be known without reading the backup's data.
+        """
+
+        names = self.__data.member_names()
+
+        if names is None or matcher is None:
+            return names
+
+        return [ path[1:] for path in matcher.select(sorted("/" + name for name in names)) ]
+
+
+    def __init_metadata_cache(self):
+        """Initializes the backup metadata cache."""
+
+        extern_hashes = utils.HashSet()
+        backup_path = self.__storage.backup_path(self.__group, self.__name)
+        binary_metadata_path = os.path.join(backup_path, metadata.BINARY_FILE_NAME)
+
+        if os.path.exists(binary_metadata_path):
+            try:
+                self.__extern_files = metadata.Reader(binary_metadata_path)
+            except Exception as e:
+                LOG.error("Failed to open backup metadata '%s': %s.", binary_metadata_path, psys.e(e))
+
+        def handle_metadata(hash, status, size, fingerprint, path):
+            if status in _EXTERN_FILE_STATUSES:
+                extern_hashes.add(hash)
+
+                if not isinstance(self.__extern_files, metadata.Reader):
+                    self.__extern_files[path] = hash
+
+        self.__ok &= _load_metadata(backup_path, handle_metadata)
+
+        if extern_hashes:
+            try:
+                backups = self.__storage.backups(self.__group)
+            except Exception as e:
+                LOG.error("Failed to read metadata for backup group %s: %s", self.__group, e)
+            else:
+                self.__load_deltas(backups, extern_hashes)
+
+                for name in backups:
+                    backup_path = self.__storage.backup_path(self.__group, name)
+
+                    for file_name, ( paths, offsets ) in self.__load_backup_metadata(backup_path, extern_hashes):
+                        if paths or offsets:
+                            backup = self.__load_backup_data(name, file_name, paths, offsets)
+                            if backup is not None:
+                                self.__backups.append(backup)
+
+                    self.__load_chunk_metadata(backup_path, extern_hashes)
+
+                if self.__chunked_files:
+                    self.__load_chunks(backups)
+
+                self.__backups.sort(
+                    key = lambda backup: len(backup["files"]), reverse = True)
+
+                if self.__backups:
+                    LOG.debug("Restoring extern data from the following backups: %s.",
+                        ", ".join(backup["name"] for backup in self.__backups))
+
+
+    def __load_backup_data(self, name, file_name, paths, offsets):
+        """Loads the specified backup's data file.
+
+        paths maps paths of the required files whose data member offsets are
+        unknown to their hashes, offsets maps hashes of the other required
+        files to their data member offsets.
+        """
+
+        files = dict(offsets)
+        data = None
+        backup_path = self.__storage.backup_path(self.__group, name)
+
+        LOG.debug("Loading %s of '%s' backup...", file_name, backup_path)
+
+        try:
+            if name == self.__name and file_name == _DATA_FILE_NAME:
+                data = self.__data
+            else:
+                data = utils.MultiVolumeTarFile(os.path.join(backup_path, file_name), decompress = not self.__in_place)
+
+            # Only backups written by the old versions don't have the offsets
+            # in their metadata
+            index = data.indexed_members(path[1:] for path in paths) if paths else None
+
+            if index is not None:
+                for path, hash in paths.items():
+                    offset = index.get(path[1:])
+                    if offset is not None:
+                        files.setdefault(hash, offset)
+            elif paths:
+                for tar_info in data:
+                    hash = paths.get("/" + tar_info.name)
+                    if hash is not None:
+                        files.setdefault(hash, tar_info.offset)
+        except Exception as e:
+            LOG.error("Failed to load data of '%s' backup: %s.", backup_path, psys.e(e))
         else:
             LOG.debug("Data of '%s' backup has been successfully loaded.", backup_path)
 
-        if files:
+        if files and data is not None:
             return {
                 "name":  name,
                 "files": files,
@@ -583,36 +1535,122 @@ class Restore:
             return None
 
 
-    def __load_backup_metadata(self, backup_path):
-        """Loads metadata for the specified backup."""
+    def __load_chunk_metadata(self, backup_path, extern_hashes):
+        """Loads chunk lists of the specified chunked files."""
+
+        def handle_chunk_metadata(file_hash, chunk_hashes):
+            if file_hash in extern_hashes:
+                self.__chunked_files.setdefault(file_hash, chunk_hashes)
+
+        self.__ok &= _load_hash_lists(backup_path, _CHUNK_METADATA_FILE_NAME, handle_chunk_metadata)
+
+
+    def __load_deltas(self, backups, extern_hashes):
+        """
+        Loads base file hashes of delta files and adds the bases to the
+        specified extern hashes.
+        """
+
+        def handle_delta(file_hash, base_hashes):
+            self.__deltas.setdefault(file_hash, base_hashes[0])
+
+        for name in backups:
+            self.__ok &= _load_hash_lists(self.__storage.backup_path(self.__group, name),
+                _DELTAS_FILE_NAME, handle_delta)
+
+        for file_hash in list(extern_hashes):
+            while file_hash in self.__deltas:
+                file_hash = self.__deltas[file_hash]
+                extern_hashes.add(file_hash)
+
+
+    def __load_chunks(self, backups):
+        """Loads chunk data of all backups that contain the required chunks."""
+
+        chunk_hashes = set()
+        for file_chunk_hashes in self.__chunked_files.values():
+            chunk_hashes.update(file_chunk_hashes)
+
+        for name in backups:
+            backup_path = self.__storage.backup_path(self.__group, name)
+            if not os.path.exists(os.path.join(backup_path, _CHUNK_METADATA_FILE_NAME)):
+                continue
+
+            LOG.debug("Loading chunk data of '%s' backup...", backup_path)
+
+            try:
+                data = utils.MultiVolumeTarFile(
+                    os.path.join(backup_path, _CHUNK_DATA_FILE_NAME),
+                    decompress = not self.__in_place)
+            except Exception as e:
+                LOG.error("Failed to open chunk data of '%s' backup: %s.", backup_path, psys.e(e))
+                continue
+
+            self.__chunk_data.append(data)
+
+            try:
+                index = data.indexed_members(chunk_hashes)
+                members = index.items() if index is not None else (
+                    ( tar_info.name, tar_info.offset ) for tar_info in data
+                )
+
+                for name, offset in members:
+                    if name in chunk_hashes:
+                        self.__chunks.setdefault(name, ( data, offset ))
+            except Exception as e:
+                LOG.error("Failed to load chunk data of '%s' backup: %s.", backup_path, psys.e(e))
+
+
+    def __load_backup_metadata(self, backup_path, extern_hashes):
+        """Loads metadata of the specified extern files for the specified backup.
+
+        Returns ( file_name, ( paths, offsets ) ) tuples for the backup's data
+        files (see __load_backup_data()).
+        """
+
+        files = collections.OrderedDict(
+            ( file_name, ( {}, {} ) ) for file_name in ( _DATA_FILE_NAME, _RAW_DATA_FILE_NAME ))
 
-        paths = {}
-        hashes = set()
+        def handle_metadata(hash, status, size, fingerprint, path, offset):
+            if hash not in extern_hashes:
+                return
+
+            if status in ( _FILE_STATUS_UNIQUE, _FILE_STATUS_DELTA ):
+                paths, offsets = files[_DATA_FILE_NAME]
+            elif status == _FILE_STATUS_RAW:
+                paths, offsets = files[_RAW_DATA_FILE_NAME]
+            else:
+                return
 
-        def handle_metadata(hash, status, fingerprint, path):
-            if status == _FILE_STATUS_UNIQUE:
+            if offset is None:
                 paths[path] = hash
-                hashes.add(hash)
+            else:
+                offsets.setdefault(hash, offset)
+
+        _load_metadata(backup_path, handle_metadata, offsets = True)
 
-        _load_metadata(backup_path, handle_metadata)
+        return files.items()
 
-        return hashes, paths
 
+    def __restore_attributes(self, path, attributes):
+        """Restores all attributes of a restored file.
+
+        attributes is a tuple returned by _get_attributes().
+        """
 
-    def __restore_attributes(self, tar_info, path):
-        """Restores all attributes of a restored file."""
+        uname, uid, gname, gid, mode, mtime = attributes
 
         if os.geteuid() == 0:
             try:
                 try:
-                    uid = utils.getpwnam(tar_info.uname)[2]
+                    uid = utils.getpwnam(uname)[2]
                 except KeyError:
-                    uid = tar_info.uid
+                    pass
 
                 try:
-                    gid = utils.getgrnam(tar_info.gname)[2]
+                    gid = utils.getgrnam(gname)[2]
                 except KeyError:
-                    gid = tar_info.gid
+                    pass
 
                 os.lchown(path, uid, gid)
             except Exception as e:
@@ -620,54 +1658,421 @@ class Restore:
                     LOG.error("Failed to set owner of '%s': %s.", path, psys.e(e))
                     self.__ok = False
 
-        if not tar_info.issym():
+        if mode is not None:
             try:
-                os.chmod(path, tar_info.mode)
+                os.chmod(path, mode)
             except Exception as e:
                 if not psys.is_errno(e, errno.ENOENT):
                     LOG.error("Failed to change permissions of '%s': %s.", path, psys.e(e))
                     self.__ok = False
 
             try:
-                os.utime(path, ( tar_info.mtime, tar_info.mtime ))
+                os.utime(path, ( mtime, mtime ))
             except Exception as e:
                 if not psys.is_errno(e, errno.ENOENT):
                     LOG.error("Failed to change access and modification time of '%s': %s.", path, psys.e(e))
                     self.__ok = False
 
 
-    def __restore_extern_file(self, tar_info, file_hash):
-        """Restores the specified extern file."""
+    def __restore_extern(self, name, attributes, extern_hash, source = None):
+        """Restores the specified extern file.
+
+        source is a ( data_file, member offset ) tuple of the file's data
+        member if it's known.
+        """
+
+        restore_path = os.path.join(self.__restore_path, name)
+
+        LOG.info("Restoring '%s'...", "/" + name)
+
+        try:
+            try:
+                if source is None:
+                    self.__restore_extern_file(name, extern_hash)
+                else:
+                    data, offset = source
+                    self.__extract(name, data, data.member(offset))
+            finally:
+                self.__restore_attributes(restore_path, attributes)
+        except Exception as e:
+            LOG.error("Failed to restore '%s': %s", "/" + name, psys.e(e))
+            self.__ok = False
+
+
+    def __restore_hard_link(self, name, target):
+        """Restores the specified hard link."""
+
+        restore_path = os.path.join(self.__restore_path, name)
+        target_path = os.path.join(self.__restore_path, target)
+
+        LOG.info("Restoring '%s'...", "/" + name)
+
+        try:
+            os.link(target_path, restore_path)
+        except Exception as e:
+            LOG.error("Failed to restore '%s': Unable to create a hard link to '%s': %s.",
+                "/" + name, target_path, psys.e(e))
+            self.__ok = False
+
+
+    def __restore_members(self, data, members, directories, extern_files, hard_links):
+        """Restores the specified members of the backup's data.
+
+        Extern files and hard links are appended to extern_files and
+        hard_links to be restored after the backup's data.
+        """
+
+        try:
+            for tar_info in members:
+                extern_hash = self.__get_extern_hash("/" + tar_info.name) if tar_info.isreg() else None
+
+                if tar_info.islnk():
+                    hard_links.append(( tar_info.name, tar_info.linkname ))
+                elif extern_hash is not None:
+                    extern_files.append(( tar_info.name, _get_attributes(tar_info), extern_hash ))
+                else:
+                    self.__restore_member(data, tar_info, directories)
+        except Exception as e:
+            LOG.error("Failed to read the backup's data: %s.", psys.e(e))
+            self.__ok = False
 
-        LOG.debug("Looking up for extern file '%s' with hash %s...",
-            tar_info.name, file_hash)
 
-        for backup in self.__backups:
-            extern_tar_info = backup["files"].get(file_hash)
-            if extern_tar_info is None:
+    def __restore_members_in_parallel(self, executor, members, directories, extern_files, hard_links):
+        """
+        Restores the specified ( offset, name ) members of the backup's data
+        splitting them between the threads.
+        """
+
+        # Create parent directories in advance, so the threads don't race
+        # creating them
+        for name in sorted(set(os.path.dirname(name) for offset, name in members)):
+            if not name:
                 continue
 
-            extern_tar_info = copy.copy(extern_tar_info)
-            extern_tar_info.name = tar_info.name
+            try:
+                os.makedirs(os.path.join(self.__restore_path, name), mode = 0o700, exist_ok = True)
+            except Exception as e:
+                LOG.error("Failed to restore '%s': %s", "/" + name, psys.e(e))
+                self.__ok = False
+
+        part_size = max(1, -(-len(members) // self.__jobs))
+
+        futures = [
+            executor.submit(self.__restore_members_part, members[start:start + part_size],
+                directories, extern_files, hard_links)
+            for start in range(0, len(members), part_size) ]
 
+        for future in futures:
+            future.result()
+
+
+    def __restore_members_part(self, members, directories, extern_files, hard_links):
+        """
+        Restores the specified ( offset, name ) members of the backup's data
+        reading them by its own data file object.
+        """
+
+        try:
+            data = utils.MultiVolumeTarFile(self.__data_path, decompress = not self.__in_place)
+        except Exception as e:
+            LOG.error("Failed to open the backup's data: %s.", psys.e(e))
+            self.__ok = False
+            return
+
+        try:
+            self.__restore_members(data, ( data.member(offset) for offset, name in members ),
+                directories, extern_files, hard_links)
+        finally:
             try:
-                backup["data"].extract(extern_tar_info,
-                    path = self.__restore_path, set_attrs = False)
+                data.close()
             except Exception as e:
-                raise Error("Unable to extract the file from backup: {}.", e)
+                LOG.error("Failed to close the backup's data: %s.", psys.e(e))
+
+
+    def __restore_member(self, data, tar_info, directories):
+        """Restores the specified member of the backup's data.
+
+        Directories' attributes are appended to directories to be restored
+        after their contents.
+        """
+
+        path = "/" + tar_info.name
+        restore_path = os.path.join(self.__restore_path, tar_info.name)
+
+        LOG.info("Restoring '%s'...", path)
+
+        try:
+            if tar_info.isdir():
+                os.makedirs(restore_path, mode = 0o700, exist_ok = True)
+                directories.append(( tar_info.name, _get_attributes(tar_info) ))
+            else:
+                try:
+                    self.__extract(tar_info.name, data, tar_info)
+                finally:
+                    self.__restore_attributes(restore_path, _get_attributes(tar_info))
+        except Exception as e:
+            LOG.error("Failed to restore '%s': %s", path, psys.e(e))
+            self.__ok = False
+
+
+    def __restore_extern_files(self, extern_files, executor = None):
+        """
+        Restores the specified extern files reading each data file
+        sequentially.
+
+        If executor is specified, files from each data file are restored by
+        its own thread.
+        """
+
+        planned = []
+
+        for name, attributes, extern_hash in extern_files:
+            source = None if extern_hash in self.__deltas else self.__find_extern_member(extern_hash)
+
+            if source is None:
+                planned.append(( len(self.__backups), 0, name, attributes, extern_hash, None ))
+            else:
+                backup_id, offset = source
+                planned.append(( backup_id, offset, name, attributes, extern_hash,
+                    ( self.__backups[backup_id]["data"], offset ) ))
+
+        planned.sort(key = lambda item: item[:2])
+
+        # Deltas and chunked files are read from a few data files, so they are
+        # always restored last by this thread
+        futures = []
+        sequential = []
+
+        for backup_id, files in itertools.groupby(planned, key = lambda item: item[0]):
+            if executor is None or backup_id == len(self.__backups):
+                sequential.extend(files)
+            else:
+                futures.append(executor.submit(self.__restore_extern_group, list(files)))
+
+        for future in futures:
+            future.result()
+
+        self.__restore_extern_group(sequential)
+
+
+    def __restore_extern_group(self, files):
+        """Restores the specified planned extern files one by one."""
+
+        for backup_id, offset, name, attributes, extern_hash, source in files:
+            self.__restore_extern(name, attributes, extern_hash, source = source)
+
+
+    def __extract(self, name, data, member):
+        """Extracts the member of the data file as the specified file."""
+
+        if member.name != name:
+            member = copy.copy(member)
+            member.name = name
+
+        try:
+            data.extract(member, path = self.__restore_path, set_attrs = False)
+        except Exception as e:
+            raise Error("Unable to extract the file from backup: {}.", psys.e(e))
+
+
+    def __restore_extern_file(self, name, file_hash):
+        """Restores data of the specified extern file."""
+
+        LOG.debug("Looking up for extern file '%s' with hash %s...", name, file_hash)
+
+        base_hash = self.__deltas.get(file_hash)
+        source = self.__find_extern_member(file_hash)
+
+        if source is not None:
+            data = self.__backups[source[0]]["data"]
+            member = data.member(source[1])
+
+            if base_hash is None:
+                self.__extract(name, data, member)
             else:
-                break
+                self.__restore_extern_file(name, base_hash)
+                self.__apply_delta(name, data, member)
         else:
-            raise Error("Unable to find the file: backup is corrupted.")
+            chunk_hashes = self.__chunked_files.get(file_hash)
+            if chunk_hashes is None:
+                raise Error("Unable to find the file: backup is corrupted.")
+
+            self.__restore_chunked_file(name, chunk_hashes)
+
+
+    def __apply_delta(self, name, data, delta_tar_info):
+        """Applies the specified delta to the restored base file."""
+
+        try:
+            with data.extractfile(delta_tar_info) as delta_file, \
+                 open(os.path.join(self.__restore_path, name), "r+b") as restored_file:
+                size, block_size = _DELTA_HEADER.unpack(utils.read_file(delta_file, _DELTA_HEADER.size))
+
+                while True:
+                    header = delta_file.read(_DELTA_BLOCK_HEADER.size)
+                    if not header:
+                        break
+
+                    block_id, data_size = _DELTA_BLOCK_HEADER.unpack(header)
+                    restored_file.seek(block_id * block_size)
+                    restored_file.write(utils.read_file(delta_file, data_size))
+
+                restored_file.truncate(size)
+        except Exception as e:
+            raise Error("Unable to apply the file's delta: {}.", psys.e(e))
+
+
+    def __restore_chunked_file(self, name, chunk_hashes):
+        """Restores the specified chunked file."""
+
+        chunks = []
+
+        for chunk_hash in chunk_hashes:
+            chunk = self.__chunks.get(chunk_hash)
+            if chunk is None:
+                raise Error("Unable to find a chunk of the file: backup is corrupted.")
+
+            chunks.append(chunk)
+
+        try:
+            with open(os.path.join(self.__restore_path, name), "wb") as restored_file:
+                for data, offset in chunks:
+                    with data.extractfile(data.member(offset)) as chunk_file:
+                        shutil.copyfileobj(chunk_file, restored_file)
+        except Exception as e:
+            raise Error("Unable to restore the file from chunks: {}.", psys.e(e))
+
+
+
+class _DataCursor:
+    """Looks up file trees in a backup data archive.
+
+    File trees are stored in the archive in the directory walking order, so
+    while the trees are looked up in the same order the archive is read
+    sequentially only once. Otherwise it's reopened and read from the start.
+    """
+
+    def __init__(self, path):
+        # Backup data path
+        self.__path = path
+
+        # Backup data file
+        self.__data = None
+
+        # Current member of the archive
+        self.__member = None
+
+        # Key of the last looked up path
+        self.__last_key = None
+
+
+    def close(self):
+        """Closes the object."""
+
+        if self.__data is not None:
+            try:
+                self.__data.close()
+            except Exception as e:
+                LOG.error("Failed to close '%s': %s.", self.__path, psys.e(e))
+            finally:
+                self.__data = None
+
+
+    def find(self, path):
+        """Returns a TarInfo object for the specified path or None."""
+
+        name = path.lstrip("/")
+        key = _get_path_key(name)
+
+        if self.__data is None or key < self.__last_key:
+            self.close()
+            self.__data = utils.MultiVolumeTarFile(self.__path, decompress = False)
+            self.__read()
+
+        self.__last_key = key
 
+        while self.__member is not None and _get_path_key(self.__member.name) < key:
+            self.__read()
+
+        if self.__member is None or self.__member.name != name:
+            return None
+
+        return self.__pop()
+
+
+    def next(self, path):
+        """
+        Returns a TarInfo object for the next member of the file tree which
+        has been looked up by find() or None.
+        """
+
+        prefix = path.lstrip("/")
+        if prefix:
+            prefix += "/"
+
+        if self.__member is None or not self.__member.name.startswith(prefix):
+            return None
+
+        return self.__pop()
+
+
+    def __pop(self):
+        """Returns the current member and reads the next one."""
+
+        member = self.__member
+        self.__read()
+        return member
+
+
+    def __read(self):
+        """Reads the next member."""
+
+        self.__member = self.__data.next()
+
+
+
+def _get_attributes(tar_info):
+    """
+    Returns attributes of a file to restore: a ( uname, uid, gname, gid, mode,
+    mtime ) tuple where mode is None for symbolic links.
+    """
+
+    return (
+        tar_info.uname, tar_info.uid, tar_info.gname, tar_info.gid,
+        None if tar_info.issym() else tar_info.mode, tar_info.mtime )
+
+
+def _get_data_tar_info(path, stat_info, file_obj):
+    """Returns a TarInfo object for the specified file with data."""
+
+    tar_info = _get_tar_info(path, stat_info)
+
+    if isinstance(file_obj, utils.SparseFile):
+        name = tar_info.name
+
+        # Store the file in GNU sparse format 1.0
+        tar_info.name = os.path.join(os.path.dirname(name), "GNUSparseFile.0", os.path.basename(name))
+        tar_info.size = file_obj.size
+        tar_info.pax_headers = {
+            # The real name must follow the fake one
+            "path":                tar_info.name,
+            "GNU.sparse.major":    "1",
+            "GNU.sparse.minor":    "0",
+            "GNU.sparse.name":     name,
+            "GNU.sparse.realsize": str(stat_info.st_size),
+        }
+
+    return tar_info
 
 
 def _get_file_fingerprint(stat_info):
     """Returns fingerprint of a file by its stat() info."""
 
-    return "{device}:{inode}:{mtime}".format(
+    mtime, mtime_ns = divmod(stat_info.st_mtime_ns, 1000000000)
+
+    return "{device}:{inode}:{mtime}.{mtime_ns:09d}".format(
         device = stat_info.st_dev, inode = stat_info.st_ino,
-        mtime = int(stat_info.st_mtime))
+        mtime = mtime, mtime_ns = mtime_ns)
 
 
 def _get_tar_info(path, stat_info, link_target = None, extern = False):
@@ -725,28 +2130,107 @@ def _get_tar_info(path, stat_info, link_target = None, extern = False):
     return tar_info
 
 
-def _load_metadata(backup_path, handle_metadata):
-    """Loads metadata of the specified backup."""
+def _get_hashable_file(file_obj, stat_info, sparse_map):
+    """Wraps the file object to hash its data while reading it."""
+
+    if sparse_map is None or _get_sparse_size(sparse_map) > _MAX_SPARSE_SIZE:
+        return utils.HashableFile(file_obj)
+
+    return utils.SparseFile(file_obj, stat_info.st_size, sparse_map)
 
-    ok = False
 
-    metadata_path = os.path.join(backup_path, _METADATA_FILE_NAME)
+def _get_sparse_size(sparse_map):
+    """Returns size of the data regions of a sparse file."""
 
-    LOG.debug("Loading backup metadata '%s'...", metadata_path)
+    return sum(size for offset, size in sparse_map)
+
+
+def _get_table(memory_limit):
+    """
+    Returns a table which is spilled to disk when the memory limit is exceeded
+    or a plain dict if there is no limit.
+    """
+
+    return {} if memory_limit is None else utils.SpillableDict(memory_limit)
+
+
+def _get_path_key(name):
+    """Returns a key for ordering paths in the directory walking order."""
+
+    return name.split("/")
+
+
+def _is_precise_fingerprint(fingerprint):
+    """
+    Checks whether the fingerprint contains subsecond modify time, so it's
+    unlikely to match a file which has reused the inode of another one.
+    """
+
+    mtime = fingerprint.rpartition(":")[2]
+    return "." in mtime and not mtime.endswith(".000000000")
+
+
+def _is_same_file(fingerprint, prev_fingerprint):
+    """Checks whether the fingerprints belong to the same unchanged file."""
+
+    # Fingerprints written by the old versions don't contain subsecond modify
+    # time
+    if "." not in prev_fingerprint:
+        fingerprint = fingerprint.partition(".")[0]
+
+    return fingerprint == prev_fingerprint
+
+
+def _load_hash_lists(backup_path, file_name, handle_hash_list):
+    """
+    Loads an additional metadata file of the specified backup (chunk lists,
+    signatures, etc.) if it exists.
+
+    Calls handle_hash_list(file_hash, values) for each file.
+    """
+
+    ok = False
+
+    metadata_path = os.path.join(backup_path, file_name)
 
     try:
         with bz2.BZ2File(metadata_path, mode = "r") as metadata_file:
             for line in metadata_file:
-                line = line.rstrip(b"\r\n")
-                if not line:
-                    continue
+                values = line.decode(_ENCODING).split()
+                if values:
+                    handle_hash_list(values[0], values[1:])
+
+        ok = True
+    except Exception as e:
+        if psys.is_errno(e, errno.ENOENT):
+            ok = True
+        else:
+            LOG.error("Failed to load backup metadata '%s': %s.", metadata_path, psys.e(e))
+
+    return ok
+
+
+def _load_metadata(backup_path, handle_metadata, offsets = False):
+    """Loads metadata of the specified backup.
+
+    Calls handle_metadata(hash, status, size, fingerprint, path) for each file.
+    size is None for metadata written by the old versions which didn't store
+    file sizes. If offsets is True, offset of the file's data member (or None)
+    is passed as well.
+    """
 
-                handle_metadata(*line.decode(_ENCODING).split(" ", 3))
+    ok = False
+
+    LOG.debug("Loading backup metadata '%s'...", backup_path)
+
+    try:
+        for record in metadata.read(backup_path, offsets = offsets):
+            handle_metadata(*record)
 
         ok = True
     except Exception as e:
-        LOG.error("Failed to load backup metadata '%s': %s.", metadata_path, psys.e(e))
+        LOG.error("Failed to load backup metadata '%s': %s.", backup_path, psys.e(e))
     else:
-        LOG.debug("Backup metadata '%s' has been successfully loaded.", metadata_path)
+        LOG.debug("Backup metadata '%s' has been successfully loaded.", backup_path)
 
     return ok
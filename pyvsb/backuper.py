@@ -13,7 +13,10 @@ system = psh.Program("sh", "-c", _defer = False)
 
 from .core import Error, LogicalError
 from .backup import Backup
+from .filters import Filter
+from .pipeline import ReadPipeline
 from .storage import Storage
+from .walker import Walker, iterate
 
 LOG = logging.getLogger(__name__)
 
@@ -54,8 +57,9 @@ class Backuper:
         # False if something went wrong during the backup
         self.__ok = True
 
-        # Default open() flags
-        self.__open_flags = os.O_RDONLY | os.O_NOFOLLOW
+        # Default open() flags (O_NONBLOCK protects us from hanging on a FIFO
+        # which suddenly replaced a regular file after directory listing)
+        self.__open_flags = os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK
         if hasattr(os, "O_NOATIME"):
             self.__open_flags |= os.O_NOATIME
 
@@ -68,6 +72,20 @@ class Backuper:
         # Holds backup writing logic
         self.__backup = Backup(config, storage)
 
+        # Lists directories in worker threads
+        self.__walker = None
+
+        # Reads and hashes files in worker threads
+        self.__reader = None
+
+        try:
+            self.__walker = Walker(config["walker_threads"])
+            self.__reader = ReadPipeline(self.__open_file, self.__backup.need_data,
+                config["reader_threads"], config["read_ahead_size"], config["pipeline_depth"])
+        except:
+            self.close()
+            raise
+
         # A list of backup items' top level directories that has been added to
         # the backup
         self.__toplevel_dirs = set()
@@ -94,13 +112,13 @@ class Backuper:
                         LOG.error("Failed to backup '%s': %s.", path, psys.e(e))
                         self.__ok = False
                     else:
-                        self.__ok &= self.__backup_path(path, params.get("filter", []), path)
+                        self.__ok &= self.__backup_path(path, Filter(params.get("filter", [])) or None, path)
 
                     self.__ok &= self.__run_script(params.get("after"))
                 else:
                     self.__ok = False
 
-            self.__backup.commit()
+            self.__backup.commit(complete = self.__ok)
         finally:
             self.__backup.close()
 
@@ -110,7 +128,15 @@ class Backuper:
     def close(self):
         """Closes the object."""
 
-        self.__backup.close()
+        try:
+            try:
+                if self.__reader is not None:
+                    self.__reader.close()
+            finally:
+                if self.__walker is not None:
+                    self.__walker.close()
+        finally:
+            self.__backup.close()
 
 
     def __add_toplevel_dirs(self, path):
@@ -134,51 +160,54 @@ class Backuper:
             self.__backup.add_file(toplevel_dir, stat_info)
 
 
-    def __backup_path(self, path, filters, toplevel):
-        """Backups the specified path."""
+    def __backup_path(self, path, filters, toplevel, entry = None):
+        """Backups the specified path.
+
+        filters is a Filter object or None if all paths have to be backed up.
+        entry is an os.DirEntry object for the path if it's known.
+        """
 
         ok = True
         LOG.info("Backing up '%s'...", path)
 
         try:
-            stat_info = os.lstat(path)
+            if self.__backup.is_clean(path):
+                unresolved = self.__backup.reuse_tree(path)
 
-            if stat.S_ISREG(stat_info.st_mode):
+                if unresolved is not None:
+                    for unresolved_path in unresolved:
+                        self.__backup_path(unresolved_path, filters, toplevel)
+
+                    return ok
+
+            if entry is not None and entry.is_file(follow_symlinks = False):
+                # Regular files are stat()'ed after opening
                 self.__backup_file(path)
             else:
-                if stat.S_ISLNK(stat_info.st_mode):
-                    try:
-                        link_target = os.readlink(path)
-                    except EnvironmentError as e:
-                        if e.errno == errno.EINVAL:
-                            raise FileTypeChangedError()
-                        else:
-                            raise
+                if entry is None:
+                    stat_info = os.lstat(path)
                 else:
-                    link_target = None
-
-                self.__backup.add_file(
-                    path, stat_info, link_target = link_target)
-
-            if stat.S_ISDIR(stat_info.st_mode):
-                prefix = toplevel + os.path.sep
-
-                for filename in os.listdir(path):
-                    file_path = os.path.join(path, filename)
+                    stat_info = entry.stat(follow_symlinks = False)
 
-                    for allow, regex in filters:
-                        if not file_path.startswith(prefix):
-                            raise LogicalError()
-
-                        if regex.search(file_path[len(prefix):]):
-                            if allow:
-                                self.__backup_path(file_path, filters, toplevel)
+                if stat.S_ISREG(stat_info.st_mode):
+                    self.__backup_file(path)
+                else:
+                    if stat.S_ISLNK(stat_info.st_mode):
+                        try:
+                            link_target = os.readlink(path)
+                        except EnvironmentError as e:
+                            if e.errno == errno.EINVAL:
+                                raise FileTypeChangedError()
                             else:
-                                LOG.info("Filtering out '%s'...", file_path)
-
-                            break
+                                raise
                     else:
-                        self.__backup_path(file_path, filters, toplevel)
+                        link_target = None
+
+                    self.__backup.add_file(
+                        path, stat_info, link_target = link_target)
+
+                if stat.S_ISDIR(stat_info.st_mode):
+                    self.__backup_directory(path, filters, toplevel)
         except FileTypeChangedError as e:
             LOG.error("Failed to backup '%s': it has suddenly changed its type during the backup.", path)
             ok = False
@@ -192,9 +221,47 @@ class Backuper:
         return ok
 
 
+    def __backup_directory(self, path, filters, toplevel):
+        """Backups contents of the specified directory."""
+
+        prefix = toplevel + os.path.sep
+        entries = []
+
+        if path != toplevel and not path.startswith(prefix):
+            raise LogicalError()
+
+        # Don't filter paths which can't be matched by any filter
+        if filters is not None and path != toplevel and not filters.matches_under(path[len(prefix):]):
+            filters = None
+
+        for entry in self.__walker.scandir(path):
+            file_path = os.path.join(path, entry.name)
+
+            if filters is not None and filters.match(file_path[len(prefix):]) is False:
+                LOG.info("Filtering out '%s'...", file_path)
+            else:
+                entries.append(( file_path, entry ))
+
+        for file_path, entry in iterate(entries, self.__walker, self.__reader, skip = self.__backup.is_clean):
+            self.__backup_path(file_path, filters, toplevel, entry = entry)
+
+
     def __backup_file(self, path):
         """Backups the specified file."""
 
+        file_obj, stat_info, file_hash = self.__reader.read(path)
+
+        with file_obj:
+            self.__backup.add_file(path, stat_info,
+                file_obj = file_obj, file_hash = file_hash)
+
+
+    def __open_file(self, path):
+        """Opens the specified file.
+
+        Returns a ( file_obj, stat_info ) tuple.
+        """
+
         try:
             try:
                 fd = eintr_retry(os.open)(path, self.__open_flags)
@@ -231,9 +298,15 @@ class Backuper:
 
             raise
 
-        with file_obj:
+        try:
             stat_info = os.fstat(file_obj.fileno())
-            self.__backup.add_file(path, stat_info, file_obj = file_obj)
+            if not stat.S_ISREG(stat_info.st_mode):
+                raise FileTypeChangedError()
+        except:
+            file_obj.close()
+            raise
+
+        return file_obj, stat_info
 
 
     def __run_script(self, script):
@@ -0,0 +1,72 @@
+"""Content-defined chunking of big files.
+
+Files are split into chunks at positions determined by their contents, so
+inserting or removing data in the middle of a file changes only the chunks
+around the modification and all other chunks are deduplicated.
+
+A rolling hash computed byte by byte in Python is too slow for big files, so
+the chunker uses an equivalent which is computed by C code: each byte is
+mapped to a pseudo-random bit and a chunk boundary is placed after each run
+of N one bits (which occurs once in about 2 ^ (N + 1) bytes of random data).
+Like a rolling hash over an N-byte window, the boundaries depend only on the
+preceding N bytes and are resynchronized right after a modification.
+"""
+
+import math
+
+from hashlib import sha256
+
+from .core import Error
+
+
+_ONE_BYTES = frozenset(sorted(range(256),
+    key = lambda byte: sha256(b"pyvsb chunking" + bytes(( byte, ))).digest())[:128])
+"""Pseudo-randomly chosen half of the bytes which are mapped to one bits."""
+
+_BYTE_CLASSES = bytes.maketrans(bytes(range(256)), bytes(
+    int(byte in _ONE_BYTES) for byte in range(256)))
+"""Byte to bit mapping table."""
+
+_READ_SIZE = 1024 * 1024
+"""Size of blocks in which files are read."""
+
+
+def iterate_chunks(file_obj, size, chunk_size):
+    """Splits the file into chunks of chunk_size size on average.
+
+    Yields chunks' data. Chunk sizes are limited by [chunk_size / 4,
+    chunk_size * 4].
+    """
+
+    min_size = max(1, chunk_size // 4)
+    max_size = chunk_size * 4
+
+    # Chunks are at least min_size long, so boundaries have to occur in
+    # about chunk_size - min_size bytes
+    run_length = max(1, int(round(math.log(chunk_size - min_size + 2, 2))) - 1)
+    boundary = b"\1" * run_length
+
+    data = bytearray()
+    classes = bytearray()
+    read_size = 0
+
+    while data or read_size < size:
+        if len(data) < max_size and read_size < size:
+            block = file_obj.read(min(_READ_SIZE, size - read_size))
+            if not block:
+                raise Error("The file has been truncated during the backup.")
+
+            read_size += len(block)
+            data += block
+            classes += block.translate(_BYTE_CLASSES)
+
+            if len(data) < max_size and read_size < size:
+                continue
+
+        pos = classes.find(boundary, max(0, min_size - run_length), max_size)
+        chunk_end = min(len(data), max_size) if pos < 0 else pos + run_length
+
+        yield bytes(data[:chunk_end])
+
+        del data[:chunk_end]
+        del classes[:chunk_end]
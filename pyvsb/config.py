@@ -8,6 +8,7 @@ import re
 from collections import Callable
 
 from .core import Error
+from .utils import CompressedTarFile
 
 
 def get_config(path):
@@ -29,6 +30,30 @@ def get_config(path):
     _get_param(config_obj, config, "trust_modify_time", bool, default = True)
     _get_param(config_obj, config, "preserve_hard_links", bool, default = True)
     _get_param(config_obj, config, "compression", str, validate = _validate_compression, default = "bz2")
+    _get_param(config_obj, config, "compression_level", int, validate = _validate_non_negative_integer, default = 0)
+    _get_param(config_obj, config, "max_volume_size", int, validate = _validate_non_negative_integer, default = 0)
+    _get_param(config_obj, config, "incompressible_extensions", list, validate = _validate_extensions, default = [
+        "7z", "avi", "bz2", "flac", "gif", "gz", "jpeg", "jpg", "m4a", "mkv", "mov", "mp3", "mp4",
+        "ogg", "png", "rar", "tgz", "webm", "webp", "xz", "zip", "zst" ])
+    _get_param(config_obj, config, "detect_incompressible", bool, default = True)
+    _get_param(config_obj, config, "compression_threads", int, validate = _validate_positive_integer, default = os.cpu_count() or 1)
+    _get_param(config_obj, config, "walker_threads", int, validate = _validate_positive_integer, default = 4)
+    _get_param(config_obj, config, "reader_threads", int, validate = _validate_non_negative_integer, default = 4)
+    _get_param(config_obj, config, "read_ahead_size", int, validate = _validate_non_negative_integer, default = 1024 * 1024)
+    _get_param(config_obj, config, "pipeline_depth", int, validate = _validate_positive_integer, default = 64)
+    _get_param(config_obj, config, "single_pass_dedup", bool, default = True)
+    _get_param(config_obj, config, "spool_size", int, validate = _validate_non_negative_integer, default = 32 * 1024 * 1024)
+    _get_param(config_obj, config, "chunking_threshold", int, validate = _validate_non_negative_integer, default = 0)
+    _get_param(config_obj, config, "chunk_size", int, validate = _validate_positive_integer, default = 1024 * 1024)
+    _get_param(config_obj, config, "delta_threshold", int, validate = _validate_non_negative_integer, default = 0)
+    _get_param(config_obj, config, "delta_block_size", int, validate = _validate_positive_integer, default = 64 * 1024)
+    _get_param(config_obj, config, "max_delta_chain", int, validate = _validate_positive_integer, default = 10)
+    _get_param(config_obj, config, "memory_limit", int, validate = _validate_non_negative_integer, default = 0)
+
+    levels = CompressedTarFile.formats()[config["compression"]]
+    if config["compression_level"] and levels is not None and not levels[0] <= config["compression_level"] <= levels[1]:
+        raise Error("Invalid COMPRESSION_LEVEL value: {} compression levels are {}-{}.",
+            config["compression"], *levels)
 
     for handler_name in ( "on_group_created", "on_group_deleted", "on_backup_created" ):
         if hasattr(config_obj, handler_name):
@@ -64,10 +89,20 @@ def _get_param(config_obj, config, name, value_type, default = None, validate =
         raise Error("Invalid {} value: {}", config_name, e)
 
 
+def _validate_extensions(extensions):
+    """Validates a list of file extensions."""
+
+    for extension in extensions:
+        if not isinstance(extension, str) or not extension or "." in extension:
+            raise Error("Invalid file extension: {!r}.", extension)
+
+    return set(extension.lower() for extension in extensions)
+
+
 def _validate_compression(compression):
     """Validates compression."""
 
-    formats = ( "bz2", "gz", "none" )
+    formats = tuple(CompressedTarFile.formats())
 
     if compression not in formats:
         raise Error("Invalid compression format: '{}'. Available formats: {}.",
@@ -137,6 +172,15 @@ def _validate_path(path):
     return os.path.normpath(path)
 
 
+def _validate_non_negative_integer(value):
+    """Checks that the specified value is a non-negative integer."""
+
+    if value < 0:
+        raise Error("Must be a non-negative number.")
+
+    return value
+
+
 def _validate_positive_integer(value):
     """Checks that the specified value is a positive integer."""
 
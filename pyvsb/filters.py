@@ -0,0 +1,360 @@
+"""Backup item filters and restore path matching."""
+
+import bisect
+import fnmatch
+import re
+
+from .core import Error
+
+
+class Filter:
+    """A compiled list of backup item's filters.
+
+    The filters are ( allow, regex ) tuples which are matched against paths
+    relative to the backup item. The first matching filter decides whether the
+    path is allowed.
+
+    Instead of trying all regular expressions one by one for each path:
+    * anchored patterns (^literal-prefix...) are put into a prefix trie, so
+      only the patterns whose literal prefix is a prefix of the path are tried;
+    * all other patterns are combined into one alternation which is tried
+      first, so they are tried one by one only if some of them matches.
+    """
+
+    def __init__(self, filters):
+        # ( allow, regex ) tuples
+        self.__filters = list(filters)
+
+        # A prefix trie of anchored patterns with literal prefixes. Each node
+        # is a dictionary which maps characters to child nodes and None to a
+        # list of indexes of the patterns whose prefix ends at this node.
+        self.__trie = {}
+
+        # Indexes of the patterns which are filtered by the combined regular
+        # expression
+        self.__combined = []
+
+        # Combined regular expression or None
+        self.__combined_regex = None
+
+        # Indexes of the patterns which have to be tried for each path
+        self.__always = []
+
+        combined = []
+
+        for index, ( allow, regex ) in enumerate(self.__filters):
+            prefix = _get_literal_prefix(regex)
+
+            if prefix:
+                node = self.__trie
+                for char in prefix:
+                    node = node.setdefault(char, {})
+
+                node.setdefault(None, []).append(index)
+            elif _is_combinable(regex):
+                combined.append(index)
+            else:
+                self.__always.append(index)
+
+        if combined:
+            try:
+                self.__combined_regex = re.compile("|".join(
+                    "(?:" + self.__filters[index][1].pattern + ")" for index in combined))
+            except Exception:
+                self.__always.extend(combined)
+                self.__always.sort()
+            else:
+                self.__combined = combined
+
+
+    def __bool__(self):
+        return bool(self.__filters)
+
+
+    def match(self, path):
+        """Matches the path against the filters.
+
+        Returns None if no filter matches the path, otherwise returns the
+        matched filter's policy (True if the path is allowed).
+        """
+
+        candidates = self.__get_prefix_candidates(path)[0]
+
+        if self.__combined_regex is not None and self.__combined_regex.search(path):
+            candidates.extend(self.__combined)
+
+        if self.__always:
+            candidates.extend(self.__always)
+
+        if not candidates:
+            return None
+
+        candidates.sort()
+        filters = self.__filters
+
+        for index in candidates:
+            allow, regex = filters[index]
+            if regex.search(path):
+                return allow
+
+        return None
+
+
+    def matches_under(self, directory):
+        """
+        Checks whether any filter may match a path under the specified
+        directory (all paths under the directory are allowed otherwise).
+        """
+
+        if self.__combined or self.__always:
+            return True
+
+        candidates, node = self.__get_prefix_candidates(directory + "/")
+
+        return bool(candidates) or node is not None
+
+
+    def __get_prefix_candidates(self, path):
+        """
+        Returns indexes of the anchored patterns whose prefix is a prefix of
+        the specified path and the trie node for the whole path (None if
+        there is no such node).
+        """
+
+        candidates = []
+        node = self.__trie
+
+        for char in path:
+            node = node.get(char)
+            if node is None:
+                break
+
+            indexes = node.get(None)
+            if indexes is not None:
+                candidates.extend(indexes)
+
+        return candidates, node
+
+
+
+
+class PathMatcher:
+    """Matches paths against paths to restore and restore patterns.
+
+    A path matches if it's one of the paths to restore or is under one of
+    them or if it matches one of the patterns (glob patterns are matched
+    against the whole path and their '*' matches '/' as well, regular
+    expressions are searched in the path).
+
+    Paths to restore are put into a trie of path components, so a path is
+    matched by walking its components instead of comparing it with every
+    path to restore. Sorted path lists (archive indexes) are matched with
+    select() which looks up the subtrees of the paths to restore and of the
+    patterns' literal prefixes by binary search, so paths under the other
+    subtrees aren't checked at all.
+    """
+
+    def __init__(self, paths = (), globs = (), regexes = ()):
+        # A trie of path components. Each node is a dictionary which maps
+        # components to child nodes and None to True if the node is a path to
+        # restore (its children are not stored: its whole subtree matches).
+        self.__trie = {}
+
+        # ( literal prefix, regex ) tuples of the patterns
+        self.__patterns = []
+
+        for path in paths:
+            node = self.__trie
+
+            for component in _get_components(path):
+                if None in node:
+                    break
+
+                node = node.setdefault(component, {})
+            else:
+                node.clear()
+                node[None] = True
+
+        for glob in globs:
+            self.__patterns.append(( _get_glob_prefix(glob), re.compile("^" + fnmatch.translate(glob)) ))
+
+        for pattern in regexes:
+            try:
+                regex = re.compile(pattern)
+            except Exception as e:
+                raise Error("Invalid regular expression '{}': {}.", pattern, e)
+
+            self.__patterns.append(( _get_literal_prefix(regex) or "", regex ))
+
+
+    def __bool__(self):
+        return bool(self.__trie or self.__patterns)
+
+
+    def match(self, path):
+        """Checks whether the path matches."""
+
+        node = self.__trie
+
+        for component in _get_components(path):
+            node = node.get(component)
+            if node is None:
+                break
+
+            if None in node:
+                return True
+
+        for prefix, regex in self.__patterns:
+            if path.startswith(prefix) and regex.search(path):
+                return True
+
+        return False
+
+
+    def select(self, paths):
+        """Returns a set of the matching paths of the sorted list of paths."""
+
+        selected = set()
+
+        for path in self.__paths():
+            selected.update(_get_subtree(paths, path))
+
+        for prefix, regex in self.__patterns:
+            start = bisect.bisect_left(paths, prefix)
+            end = bisect.bisect_left(paths, prefix + "\U0010ffff")
+
+            selected.update(path for path in paths[start:end] if regex.search(path))
+
+        return selected
+
+
+    def __paths(self, node = None, components = ()):
+        """Yields the paths to restore."""
+
+        if node is None:
+            node = self.__trie
+
+        if None in node:
+            yield "/".join(components)
+            return
+
+        for component, child in node.items():
+            yield from self.__paths(child, components + ( component, ))
+
+
+
+_SPECIAL_CHARS = frozenset(".^$*+?{}[]|()")
+"""Special characters of regular expressions."""
+
+_QUANTIFIER_CHARS = frozenset("*?{")
+"""Characters that make the preceding character optional."""
+
+_INCOMPATIBLE_FLAGS = re.IGNORECASE | re.MULTILINE | re.VERBOSE
+"""Flags that make literal prefix extraction impossible."""
+
+_DEFAULT_FLAGS = re.compile("").flags
+"""Default flags of regular expressions."""
+
+
+def _get_literal_prefix(regex):
+    """
+    Returns a literal prefix of an anchored regular expression (a string
+    that all matched strings start with) or None if the regular expression
+    is not anchored.
+    """
+
+    pattern = regex.pattern
+
+    if not isinstance(pattern, str) or regex.flags & _INCOMPATIBLE_FLAGS:
+        return None
+
+    if pattern.startswith("^"):
+        pos = 1
+    elif pattern.startswith(r"\A"):
+        pos = 2
+    else:
+        return None
+
+    # Alternation may make the anchor to apply only to one of the branches.
+    # Don't try to deal with it.
+    escaped = False
+    for char in pattern:
+        if escaped:
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char == "|":
+            return None
+
+    prefix = []
+
+    while pos < len(pattern):
+        char = pattern[pos]
+
+        if char == "\\":
+            if pos + 1 >= len(pattern):
+                break
+
+            char = pattern[pos + 1]
+            if char.isalnum() or char == "_":
+                break
+
+            size = 2
+        elif char in _SPECIAL_CHARS:
+            break
+        else:
+            size = 1
+
+        next_char = pattern[pos + size:pos + size + 1]
+        if next_char and next_char in _QUANTIFIER_CHARS:
+            break
+
+        prefix.append(char)
+        pos += size
+
+        if next_char == "+":
+            break
+
+    return "".join(prefix)
+
+
+def _is_combinable(regex):
+    """
+    Checks whether the regular expression can be combined into one
+    alternation with the other ones.
+    """
+
+    return (
+        isinstance(regex.pattern, str) and
+        # Group numbers are changed in the combined regular expression
+        not regex.groups and
+        # Flags are global for the combined regular expression
+        regex.flags == _DEFAULT_FLAGS
+    )
+
+
+def _get_components(path):
+    """Splits an absolute path into its components."""
+
+    return path.rstrip("/").split("/")
+
+
+def _get_glob_prefix(glob):
+    """Returns a literal prefix of a glob pattern."""
+
+    for pos, char in enumerate(glob):
+        if char in "*?[":
+            return glob[:pos]
+
+    return glob
+
+
+def _get_subtree(paths, path):
+    """Yields the path and paths under it from the sorted list of paths."""
+
+    index = bisect.bisect_left(paths, path)
+    if index < len(paths) and paths[index] == path:
+        yield path
+
+    # "0" is the character that follows "/"
+    yield from paths[bisect.bisect_left(paths, path + "/"):bisect.bisect_left(paths, path + "0")]
@@ -0,0 +1,207 @@
+"""Backup group index.
+
+To deduplicate data and detect unchanged files a backup needs hashes of all
+files and chunks stored in its backup group and the newest versions of all
+files backed up to the group. Instead of reading metadata of every backup in
+the group they are read from the group's index which is written when a backup
+is committed. The index lists the backups it's built from, so if it's missing
+or stale (a backup has been committed without updating the index) it's
+rebuilt from the backups' metadata.
+
+Index file format (all integers are big-endian):
+* header: "pyvsb-index" magic, format version, number of backups, file
+  hashes, file sizes, chunk hashes and files;
+* backup names - a length-prefixed UTF-8 string for each backup;
+* file hashes - an array of binary hashes;
+* file sizes - an array of file sizes (the number of sizes is _UNKNOWN if
+  some metadata doesn't contain file sizes);
+* chunk hashes - an array of binary hashes;
+* files - a ( hash, size, fingerprint length, path length ) record followed
+  by UTF-8 encoded fingerprint and path for each file.
+"""
+
+import errno
+import logging
+import mmap
+import os
+import struct
+
+import psys
+
+from .core import Error
+from .utils import HashSet
+
+LOG = logging.getLogger(__name__)
+
+
+_MAGIC = b"pyvsb-index\0\0\0\0\0"
+"""Index file magic."""
+
+_VERSION = 1
+"""Index format version."""
+
+_ENCODING = "utf-8"
+"""Index encoding."""
+
+_HASH_SIZE = 32
+"""Size of a binary hash."""
+
+_UNKNOWN = 2 ** 64 - 1
+"""Unknown file size or number of file sizes."""
+
+_HEADER = struct.Struct(">16sIQQQQQ")
+"""
+Index file header: magic, version, number of backups, file hashes, file sizes,
+chunk hashes and files.
+"""
+
+_NAME = struct.Struct(">H")
+"""Backup name length."""
+
+_SIZE = struct.Struct(">Q")
+"""File size."""
+
+_FILE = struct.Struct(">{}sQII".format(_HASH_SIZE))
+"""File record: hash, size, fingerprint length, path length."""
+
+
+def load(path, backups, files):
+    """Loads the backup group index.
+
+    Returns a ( hashes, sizes, chunks ) tuple where hashes and chunks are
+    HashSet objects and sizes is None if some metadata doesn't contain file
+    sizes. files is a map which is filled with paths of the files mapped to
+    ( hash, fingerprint, size ) tuples.
+
+    Returns None if the index is missing or isn't built from the specified
+    backups (files may be filled partially if the index is corrupted).
+    """
+
+    try:
+        with open(path, "rb") as index_file, \
+             mmap.mmap(index_file.fileno(), 0, access = mmap.ACCESS_READ) as data:
+            return _parse(data, backups, files)
+    except Exception as e:
+        if not psys.is_errno(e, errno.ENOENT):
+            LOG.error("Failed to load backup group index '%s': %s.", path, psys.e(e))
+
+
+def write(path, backups, hashes, sizes, chunks, files):
+    """Writes the backup group index (see load() for the arguments)."""
+
+    with open(path, "wb") as index_file:
+        index_file.write(_HEADER.pack(
+            _MAGIC, _VERSION, len(backups), len(hashes),
+            _UNKNOWN if sizes is None else len(sizes), len(chunks), len(files)))
+
+        for name in backups:
+            name = name.encode(_ENCODING)
+            index_file.write(_NAME.pack(len(name)) + name)
+
+        for digest in hashes.digests():
+            index_file.write(digest)
+
+        for size in sizes or ():
+            index_file.write(_SIZE.pack(size))
+
+        for digest in chunks.digests():
+            index_file.write(digest)
+
+        for file_path, ( file_hash, fingerprint, size ) in files.items():
+            fingerprint = fingerprint.encode(_ENCODING)
+            file_path = file_path.encode(_ENCODING)
+
+            index_file.write(_FILE.pack(
+                _get_binary_hash(file_hash), _UNKNOWN if size is None else size,
+                len(fingerprint), len(file_path)) + fingerprint + file_path)
+
+        index_file.flush()
+        os.fsync(index_file.fileno())
+
+
+
+def _get_binary_hash(file_hash):
+    """Converts a hash to its binary representation."""
+
+    binary_hash = bytes.fromhex(file_hash)
+
+    if len(binary_hash) != _HASH_SIZE:
+        raise Error("Invalid hash: {}.", file_hash)
+
+    return binary_hash
+
+
+def _parse(data, backups, files):
+    """Parses the index data."""
+
+    if len(data) < _HEADER.size:
+        raise Error("The file is truncated.")
+
+    magic, version, backup_count, hash_count, size_count, chunk_count, file_count = _HEADER.unpack_from(data)
+
+    if magic != _MAGIC:
+        raise Error("It's not a backup group index file.")
+
+    if version != _VERSION:
+        LOG.debug("Ignoring backup group index of unsupported version %s.", version)
+        return None
+
+    offset = _HEADER.size
+    index_backups = []
+
+    for backup_id in range(backup_count):
+        name_size, = _NAME.unpack_from(data, offset)
+        offset += _NAME.size
+
+        index_backups.append(data[offset:offset + name_size].decode(_ENCODING))
+        offset += name_size
+
+    if sorted(index_backups) != sorted(backups):
+        LOG.debug("Backup group index is stale.")
+        return None
+
+    hashes = _read_hashes(data, offset, hash_count)
+    offset += hash_count * _HASH_SIZE
+
+    if size_count == _UNKNOWN:
+        sizes = None
+    else:
+        sizes = set(_SIZE.unpack_from(data, size_offset)[0]
+            for size_offset in range(offset, offset + size_count * _SIZE.size, _SIZE.size))
+        offset += size_count * _SIZE.size
+
+    chunks = _read_hashes(data, offset, chunk_count)
+    offset += chunk_count * _HASH_SIZE
+
+    for file_id in range(file_count):
+        file_hash, size, fingerprint_size, path_size = _FILE.unpack_from(data, offset)
+        offset += _FILE.size
+
+        fingerprint = data[offset:offset + fingerprint_size].decode(_ENCODING)
+        offset += fingerprint_size
+
+        path = data[offset:offset + path_size].decode(_ENCODING)
+        offset += path_size
+
+        files[path] = ( file_hash.hex(), fingerprint, None if size == _UNKNOWN else size )
+
+    if offset != len(data):
+        raise Error("The file is corrupted.")
+
+    return hashes, sizes, chunks
+
+
+def _read_hashes(data, offset, count):
+    """Reads an array of binary hashes."""
+
+    hashes = HashSet(expected_size = count)
+
+    for hash_offset in range(offset, offset + count * _HASH_SIZE, _HASH_SIZE):
+        digest = data[hash_offset:hash_offset + _HASH_SIZE]
+
+        if len(digest) != _HASH_SIZE:
+            raise Error("The file is truncated.")
+
+        hashes.add_digest(digest)
+
+    return hashes
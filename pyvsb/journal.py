@@ -0,0 +1,784 @@
+"""Change journal which allows to skip walking of unchanged file trees.
+
+A watcher (pyvsb --watch) monitors backup items via inotify and appends paths
+of changed files and directories to the journal file in the backup root. Each
+backup stores the journal position it has been started at, so the next backup
+knows which paths have been changed since the previous backup and copies all
+other file trees from the previous backup without touching the filesystem.
+
+Journal file format (one record per line):
+* "pyvsb-journal {watcher id} {base offset}" - a header which is written when
+  all watches are set up;
+* "D {path}" - the file or directory entries have been changed;
+* "R {path}" - the whole file tree has been changed (created or moved);
+* "O" - some events have been lost (inotify queue overflow);
+* "S {token}" - all changes made before the sync request with the specified
+  token have been written.
+
+Journal offsets stored in backups are logical: the base offset is the logical
+offset of the first record after the header. On backup start the backup asks
+the watcher to write all pending changes and waits for its "S" record. Along
+with the sync request the watcher gets the offset the previous backup has been
+started at and drops all records before it, so the journal contains only the
+changes that may be needed by the next backup.
+
+The journal is not trusted (and backup items are walked as usual) if the
+watcher is not running (it holds a lock on the journal file), has been
+restarted since the previous backup or has lost some events.
+
+Please note that inotify doesn't report changes made via mmap() and changes
+of hard-linked files made via paths outside of the backup items.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import logging
+import os
+import select
+import struct
+import time
+
+from hashlib import sha256
+
+import psys
+from psys import eintr_retry
+
+from .core import Error
+
+LOG = logging.getLogger(__name__)
+
+
+_HEADER = "pyvsb-journal"
+"""Journal header prefix."""
+
+_STATE_FILE_NAME = "journal"
+"""Name of a backup's file which contains the journal state."""
+
+_ENCODING = "utf-8"
+"""Journal encoding."""
+
+_FLUSH_INTERVAL = 1
+"""Interval in which the watcher writes changed paths to the journal."""
+
+_SYNC_TIMEOUT = 10 * _FLUSH_INTERVAL
+"""
+Maximum time to wait for the watcher to write the changes that have been made
+before the backup start.
+"""
+
+_SYNC_POLL_INTERVAL = 0.1
+"""Interval in which the backup checks whether the watcher has synced."""
+
+_SYNC_REQUEST_SUFFIX = ".sync"
+"""Suffix of the sync request file name."""
+
+_TEMP_SUFFIX = ".tmp"
+"""Suffix of temporary files which are renamed to the target ones."""
+
+
+_IN_MODIFY = 0x00000002
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_MOVE_SELF = 0x00000800
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ONLYDIR = 0x01000000
+_IN_DONT_FOLLOW = 0x02000000
+_IN_ISDIR = 0x40000000
+
+_WATCH_MASK = (
+    _IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO |
+    _IN_CREATE | _IN_DELETE | _IN_DELETE_SELF | _IN_MOVE_SELF |
+    _IN_ONLYDIR | _IN_DONT_FOLLOW)
+"""Events the watcher is interested in."""
+
+_EVENT_HEADER = struct.Struct("iIII")
+"""struct inotify_event header."""
+
+
+
+class Changes:
+    """Paths changed since the previous backup."""
+
+    def __init__(self, dirty, recursive):
+        # Changed paths and all their parents
+        self.__tainted = set()
+
+        # Paths whose whole trees have been changed
+        self.__recursive = recursive
+
+        for path in dirty | recursive:
+            while path not in self.__tainted:
+                self.__tainted.add(path)
+
+                parent = os.path.dirname(path)
+                if parent == path:
+                    break
+
+                path = parent
+
+
+    def __len__(self):
+        return len(self.__tainted)
+
+
+    def is_clean(self, path):
+        """
+        Checks whether the specified file tree hasn't been changed since the
+        previous backup.
+        """
+
+        if path in self.__tainted:
+            return False
+
+        while True:
+            if path in self.__recursive:
+                return False
+
+            parent = os.path.dirname(path)
+            if parent == path:
+                return True
+
+            path = parent
+
+
+
+class Journal:
+    """Reads the change journal."""
+
+    def __init__(self, path, config, prev_state = None):
+        # Journal path
+        self.__path = path
+
+        # Current journal state or None if the journal can't be used
+        self.state = None
+
+        try:
+            with open(path, "rb") as journal:
+                if not _is_locked(journal):
+                    LOG.debug("Change journal watcher is not running.")
+                    return
+
+                header = journal.readline()
+                if not header.endswith(b"\n"):
+                    LOG.debug("Change journal watcher hasn't set up its watches yet.")
+                    return
+        except EnvironmentError as e:
+            if e.errno != errno.ENOENT:
+                LOG.error("Unable to read change journal '%s': %s.", path, psys.e(e))
+
+            return
+
+        header = _parse_header(header)
+        if header is None:
+            LOG.error("Invalid change journal '%s'.", path)
+            return
+
+        watcher_id = header[0]
+
+        # Records before the previous backup's offset are not needed anymore
+        keep = None
+        if prev_state is not None:
+            prev_watcher_id, prev_offset = prev_state.split(" ")[:2]
+            if prev_watcher_id == watcher_id:
+                keep = int(prev_offset)
+
+        offset = self.__sync(watcher_id, keep)
+        if offset is None:
+            return
+
+        self.state = "{} {} {}".format(watcher_id, offset, _get_config_fingerprint(config))
+
+
+    def changes(self, prev_state):
+        """
+        Returns paths changed since the specified state (a Changes object) or
+        None if the journal can't be trusted.
+        """
+
+        if self.state is None or prev_state is None:
+            return None
+
+        watcher_id, offset, config_fingerprint = self.state.split(" ")
+        prev_watcher_id, prev_offset, prev_config_fingerprint = prev_state.split(" ")
+
+        if prev_watcher_id != watcher_id:
+            LOG.info("Change journal watcher has been restarted since the previous backup.")
+            return None
+
+        if prev_config_fingerprint != config_fingerprint:
+            LOG.info("Backup items have been changed since the previous backup.")
+            return None
+
+        offset, prev_offset = int(offset), int(prev_offset)
+
+        try:
+            with open(self.__path, "rb") as journal:
+                header = _parse_header(journal.readline())
+                if header is None or header[0] != watcher_id:
+                    LOG.info("Change journal watcher has been restarted since the previous backup.")
+                    return None
+
+                base, header_size = header[1:]
+                if not base <= prev_offset <= offset:
+                    LOG.info("Change journal doesn't contain the changes since the previous backup.")
+                    return None
+
+                journal.seek(prev_offset - base + header_size)
+                data = journal.read(offset - prev_offset)
+        except Exception as e:
+            LOG.error("Unable to read change journal '%s': %s.", self.__path, psys.e(e))
+            return None
+
+        dirty = set()
+        recursive = set()
+
+        for line in data.decode(_ENCODING, "surrogateescape").split("\n"):
+            if not line:
+                continue
+
+            record, path = line[:1], line[2:]
+
+            if record == "D":
+                dirty.add(path)
+            elif record == "R":
+                recursive.add(path)
+            elif record == "O":
+                LOG.info("Change journal watcher has lost some events since the previous backup.")
+                return None
+            elif record != "S":
+                LOG.error("Invalid change journal '%s'.", self.__path)
+                return None
+
+        changes = Changes(dirty, recursive)
+        LOG.info("Using change journal: %s paths have been changed since the previous backup.",
+            len(changes))
+
+        return changes
+
+
+    def __sync(self, watcher_id, keep):
+        """
+        Requests the watcher to write all changes that have been made by now
+        and to drop the records before the specified offset.
+
+        Returns the journal offset after the changes or None if the watcher
+        hasn't responded.
+        """
+
+        token = "{}-{}".format(os.getpid(), sha256(os.urandom(16)).hexdigest()[:16])
+        marker = "S {}\n".format(token).encode(_ENCODING)
+
+        try:
+            _write_atomically(self.__path + _SYNC_REQUEST_SUFFIX,
+                "{} {}\n".format(token, "-" if keep is None else keep))
+        except EnvironmentError as e:
+            LOG.error("Unable to send sync request to change journal watcher: %s.", psys.e(e))
+            return None
+
+        # Journal file and the position of the first line that hasn't been
+        # checked yet
+        inode = position = None
+
+        deadline = time.time() + _SYNC_TIMEOUT
+
+        while True:
+            try:
+                with open(self.__path, "rb") as journal:
+                    header = _parse_header(journal.readline())
+                    if header is None or header[0] != watcher_id:
+                        LOG.debug("Change journal watcher has been restarted.")
+                        return None
+
+                    base, header_size = header[1:]
+
+                    # The journal may be compacted by the watcher
+                    journal_inode = os.fstat(journal.fileno()).st_ino
+                    if journal_inode != inode:
+                        inode, position = journal_inode, header_size
+
+                    journal.seek(position)
+                    data = b"\n" + journal.read()
+            except EnvironmentError as e:
+                LOG.error("Unable to read change journal '%s': %s.", self.__path, psys.e(e))
+                return None
+
+            marker_offset = data.find(b"\n" + marker)
+            if marker_offset != -1:
+                return base + position + marker_offset + len(marker) - header_size
+
+            position += data.rfind(b"\n")
+
+            if time.time() >= deadline:
+                LOG.warning("Change journal watcher hasn't responded to sync request.")
+                return None
+
+            time.sleep(_SYNC_POLL_INTERVAL)
+
+
+
+class Watcher:
+    """Watches backup items and writes their changes to the journal."""
+
+    def __init__(self, path, config):
+        # Journal path
+        self.__path = path
+
+        # Backup items
+        self.__items = sorted(config["backup_items"])
+
+        # Journal file
+        self.__journal = None
+
+        # Size of the journal header
+        self.__header_size = 0
+
+        # Logical offsets of the first record and of the journal end
+        self.__base = 0
+        self.__offset = 0
+
+        # Watcher ID
+        self.__id = None
+
+        # The last handled sync request
+        self.__sync_request = None
+
+        # inotify instance
+        self.__inotify = None
+
+        # Watch descriptors to paths mapping
+        self.__watches = {}
+
+        # Changes that are going to be written to the journal
+        self.__dirty = set()
+        self.__recursive = set()
+        self.__overflow = False
+
+
+    def run(self):
+        """Runs the watcher until it's interrupted by KeyboardInterrupt."""
+
+        try:
+            self.__journal = open(self.__path, "ab")
+
+            try:
+                fcntl.flock(self.__journal.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except EnvironmentError as e:
+                if e.errno in ( errno.EAGAIN, errno.EACCES ):
+                    raise Error("Another watcher is already running.")
+                else:
+                    raise
+
+            self.__journal.truncate(0)
+            self.__remove_sync_request()
+            self.__inotify = _Inotify()
+
+            LOG.info("Setting up watches...")
+
+            for path in self.__items:
+                # Watch the parent directory to get events on the backup item
+                # itself
+                self.__watch(os.path.dirname(path))
+                self.__watch_tree(path)
+
+            self.__id = "{}-{}".format(int(time.time()), os.getpid())
+            header = self.__header()
+            self.__journal.write(header)
+            self.__journal.flush()
+            self.__header_size = len(header)
+
+            LOG.info("Watching %s directories.", len(self.__watches))
+
+            flush_time = time.time() + _FLUSH_INTERVAL
+
+            while True:
+                timeout = max(0, flush_time - time.time())
+
+                self.__read_events(timeout)
+
+                if time.time() >= flush_time:
+                    self.__flush()
+                    self.__handle_sync_request()
+                    flush_time = time.time() + _FLUSH_INTERVAL
+        except KeyboardInterrupt:
+            LOG.info("Stopping the watcher...")
+        finally:
+            self.close()
+
+
+    def close(self):
+        """Closes the object."""
+
+        try:
+            if self.__inotify is not None:
+                self.__inotify.close()
+                self.__inotify = None
+        finally:
+            if self.__journal is not None:
+                self.__journal.close()
+                self.__journal = None
+
+
+    def __compact(self, keep):
+        """
+        Drops the journal records before the specified offset (all records if
+        it's None).
+        """
+
+        if keep is None:
+            keep = self.__offset
+
+        if not self.__base < keep <= self.__offset:
+            return
+
+        with open(self.__path, "rb") as journal:
+            journal.seek(keep - self.__base + self.__header_size)
+            data = journal.read()
+
+        temp_path = self.__path + _TEMP_SUFFIX
+        new_journal = open(temp_path, "wb")
+
+        try:
+            # Readers check the lock, so lock the file before it's visible to
+            # them
+            fcntl.flock(new_journal.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+            header = self.__header(keep)
+            new_journal.write(header + data)
+            new_journal.flush()
+
+            os.rename(temp_path, self.__path)
+        except:
+            new_journal.close()
+
+            try:
+                os.unlink(temp_path)
+            except EnvironmentError:
+                pass
+
+            raise
+
+        self.__journal.close()
+        self.__journal = new_journal
+        self.__header_size = len(header)
+        self.__base = keep
+
+
+    def __flush(self):
+        """Writes the accumulated changes to the journal."""
+
+        records = []
+
+        if self.__overflow:
+            records.append("O")
+
+        records.extend("R " + path for path in sorted(self.__recursive))
+        records.extend("D " + path for path in sorted(self.__dirty))
+
+        if records:
+            self.__write("".join(record + "\n" for record in records))
+
+        self.__dirty.clear()
+        self.__recursive.clear()
+        self.__overflow = False
+
+
+    def __handle_sync_request(self):
+        """
+        Handles a sync request from a backup: writes all changes that have
+        been made before the request and drops the journal records which are
+        not needed anymore.
+        """
+
+        try:
+            with open(self.__path + _SYNC_REQUEST_SUFFIX, "r", encoding = _ENCODING) as request_file:
+                request = request_file.read()
+        except EnvironmentError as e:
+            if e.errno != errno.ENOENT:
+                LOG.error("Unable to read sync request: %s.", psys.e(e))
+
+            return
+
+        if request == self.__sync_request:
+            return
+
+        self.__sync_request = request
+
+        try:
+            token, keep = request.split()
+            keep = None if keep == "-" else int(keep)
+        except ValueError:
+            LOG.error("Invalid sync request: %r.", request)
+            return
+
+        self.__read_events(0)
+        self.__flush()
+
+        try:
+            self.__compact(keep)
+        except EnvironmentError as e:
+            LOG.error("Failed to compact the change journal: %s.", psys.e(e))
+
+        self.__write("S {}\n".format(token))
+
+
+    def __handle_event(self, watch, mask, name):
+        """Handles an inotify event."""
+
+        if mask & _IN_Q_OVERFLOW:
+            LOG.warning("inotify queue overflow.")
+            self.__overflow = True
+            return
+
+        path = self.__watches.get(watch)
+        if path is None:
+            return
+
+        if mask & ( _IN_IGNORED | _IN_MOVE_SELF ):
+            # The directory is gone. If it's moved to another backed up
+            # directory, it will be watched again on IN_MOVED_TO event.
+            del self.__watches[watch]
+
+        self.__mark(self.__dirty, path)
+
+        if not name:
+            return
+
+        path = os.path.join(path, name)
+
+        if mask & _IN_ISDIR and mask & ( _IN_CREATE | _IN_MOVED_TO ) and self.__is_backed_up(path):
+            self.__mark(self.__recursive, path)
+            self.__watch_tree(path)
+        else:
+            self.__mark(self.__dirty, path)
+
+
+    def __is_backed_up(self, path):
+        """Checks whether the path belongs to a backup item."""
+
+        return any(path == item or path.startswith(item + os.path.sep) for item in self.__items)
+
+
+    def __header(self, base = None):
+        """Returns the journal header."""
+
+        if base is None:
+            base = self.__base
+
+        return "{} {} {}\n".format(_HEADER, self.__id, base).encode(_ENCODING)
+
+
+    def __mark(self, changes, path):
+        """Marks the path as changed."""
+
+        if "\n" in path:
+            # Can't be written to the journal
+            self.__overflow = True
+        else:
+            changes.add(path)
+
+
+    def __read_events(self, timeout):
+        """Reads and handles all inotify events available within the timeout."""
+
+        while eintr_retry(select.select)([ self.__inotify.fd ], [], [], timeout)[0]:
+            for event in self.__inotify.read():
+                self.__handle_event(*event)
+
+            timeout = 0
+
+
+    def __remove_sync_request(self):
+        """Removes a stale sync request."""
+
+        try:
+            os.unlink(self.__path + _SYNC_REQUEST_SUFFIX)
+        except EnvironmentError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+    def __watch(self, path):
+        """Sets up a watch for the specified directory.
+
+        Returns False if the directory doesn't exist.
+        """
+
+        try:
+            watch = self.__inotify.add_watch(path, _WATCH_MASK)
+        except EnvironmentError as e:
+            if e.errno in ( errno.ENOENT, errno.ENOTDIR ):
+                return False
+
+            raise Error("Unable to watch '{}': {}.", path, psys.e(e))
+
+        self.__watches[watch] = path
+
+        return True
+
+
+    def __watch_tree(self, path):
+        """Sets up watches for the specified directory tree."""
+
+        directories = [ path ]
+
+        while directories:
+            path = directories.pop()
+
+            if not self.__watch(path):
+                continue
+
+            try:
+                with os.scandir(path) as entries:
+                    directories.extend(
+                        entry.path for entry in entries if entry.is_dir(follow_symlinks = False))
+            except EnvironmentError as e:
+                if e.errno not in ( errno.ENOENT, errno.ENOTDIR ):
+                    raise Error("Unable to list '{}': {}.", path, psys.e(e))
+
+
+    def __write(self, data):
+        """Writes the data to the journal."""
+
+        data = data.encode(_ENCODING, "surrogateescape")
+
+        self.__journal.write(data)
+        self.__journal.flush()
+
+        self.__offset += len(data)
+
+
+
+class _Inotify:
+    """A thin wrapper for inotify API."""
+
+    def __init__(self):
+        self.__libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno = True)
+
+        self.fd = self.__libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise Error("Unable to initialize inotify: {}.", os.strerror(ctypes.get_errno()))
+
+
+    def add_watch(self, path, mask):
+        """Adds a watch for the specified path."""
+
+        watch = self.__libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if watch < 0:
+            error = ctypes.get_errno()
+            raise EnvironmentError(error, os.strerror(error))
+
+        return watch
+
+
+    def close(self):
+        """Closes the inotify instance."""
+
+        eintr_retry(os.close)(self.fd)
+
+
+    def read(self):
+        """Reads available events.
+
+        Returns a list of ( watch, mask, name ) tuples.
+        """
+
+        data = eintr_retry(os.read)(self.fd, 1024 * 1024)
+        events = []
+        offset = 0
+
+        while offset < len(data):
+            watch, mask, cookie, size = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+
+            name = os.fsdecode(data[offset:offset + size].rstrip(b"\0"))
+            offset += size
+
+            events.append(( watch, mask, name ))
+
+        return events
+
+
+
+def read_state(backup_path):
+    """Returns the journal state stored in the specified backup."""
+
+    try:
+        with open(os.path.join(backup_path, _STATE_FILE_NAME), "r", encoding = _ENCODING) as state_file:
+            return state_file.read().strip() or None
+    except EnvironmentError as e:
+        if e.errno != errno.ENOENT:
+            LOG.error("Unable to read journal state of '%s' backup: %s.", backup_path, psys.e(e))
+
+        return None
+
+
+def write_state(backup_path, state):
+    """Stores the journal state in the specified backup."""
+
+    with open(os.path.join(backup_path, _STATE_FILE_NAME), "w", encoding = _ENCODING) as state_file:
+        state_file.write(state + "\n")
+
+
+def _get_config_fingerprint(config):
+    """
+    Returns a fingerprint of the configuration parameters that affect the
+    backup contents.
+    """
+
+    items = sorted(
+        ( path, [ ( allow, regex.pattern ) for allow, regex in params.get("filter", []) ] )
+        for path, params in config["backup_items"].items())
+
+    return sha256(repr(( items, config["preserve_hard_links"] )).encode(_ENCODING)).hexdigest()[:16]
+
+
+def _parse_header(header):
+    """
+    Parses the journal header.
+
+    Returns a ( watcher id, base offset, header size ) tuple or None if the
+    header is invalid.
+    """
+
+    if not header.endswith(b"\n"):
+        return None
+
+    fields = header.decode(_ENCODING).rstrip("\n").split(" ")
+    if len(fields) != 3 or fields[0] != _HEADER or not fields[2].isdigit():
+        return None
+
+    return fields[1], int(fields[2]), len(header)
+
+
+def _is_locked(journal):
+    """Checks whether the journal is locked by a running watcher."""
+
+    try:
+        fcntl.flock(journal.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except EnvironmentError as e:
+        if e.errno in ( errno.EAGAIN, errno.EACCES ):
+            return True
+        else:
+            raise
+    else:
+        fcntl.flock(journal.fileno(), fcntl.LOCK_UN)
+        return False
+
+
+def _write_atomically(path, data):
+    """Writes the data to the specified file atomically."""
+
+    temp_path = path + _TEMP_SUFFIX
+
+    with open(temp_path, "w", encoding = _ENCODING) as temp_file:
+        temp_file.write(data)
+
+    os.rename(temp_path, path)
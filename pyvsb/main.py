@@ -4,13 +4,17 @@ from __future__ import print_function # To suppress code checker errors
 
 import argparse
 import os
+import signal
 import sys
 import logging
 
+from pyvsb import metadata
 from pyvsb.backup import Restore
 from pyvsb.backuper import Backuper
 from pyvsb.config import get_config
 from pyvsb.core import Error
+from pyvsb.journal import Watcher
+from pyvsb.storage import Storage
 
 LOG = logging.getLogger(__name__)
 
@@ -50,6 +54,10 @@ def main():
         default = os.path.expanduser("~/.pyvsb.conf"),
         help = "configuration file path (default is ~/.pyvsb.conf)")
 
+    group.add_argument("-w", "--watch", action = "store_true",
+        help = "watch backup items and record their changes to the change journal "
+        "which allows the following backups to skip unchanged directories")
+
 
     group = parser.add_argument_group("Restore")
 
@@ -58,12 +66,32 @@ def main():
 
     group.add_argument("-i", "--in-place", action = "store_true",
         help = "don't use extra disc space by decompressing backup files "
-        "(this option significantly slows down restore process)")
+        "(this option significantly slows down restore of backups without "
+        "an index which were written by the old versions)")
+
+    group.add_argument("-j", "--jobs", metavar = "N", type = int, default = 1,
+        help = "restore files by N threads: source backups are decompressed and restored "
+        "files are written in parallel (default is 1)")
+
+    group.add_argument("-g", "--glob", action = "append", metavar = "PATTERN",
+        dest = "globs", default = [], help = "restore only files matching the glob "
+        "pattern in addition to the paths to restore ('*' matches '/' as well)")
+
+    group.add_argument("--regex", action = "append", metavar = "REGEX",
+        dest = "regexes", default = [], help = "restore only files whose path matches "
+        "the regular expression in addition to the paths to restore")
 
     group.add_argument("paths_to_restore", nargs = "*",
         metavar = "PATH_TO_RESTORE", help = "Path to restore (default is /)")
 
 
+    group = parser.add_argument_group("Maintenance")
+
+    group.add_argument("--convert-metadata", nargs = "+", metavar = "BACKUP_PATH",
+        default = None, help = "convert metadata of the specified backups written by the "
+        "old versions to the binary format which is much faster to load")
+
+
     group = parser.add_argument_group("Optional arguments")
 
     group.add_argument("--cron", action = "store_true",
@@ -82,7 +110,11 @@ def main():
         parser.print_help()
         sys.exit(os.EX_OK)
 
-    if args.restore is None and args.paths_to_restore:
+    if (
+        args.restore is None and ( args.paths_to_restore or args.globs or args.regexes ) or
+        args.restore is not None and args.watch or args.jobs < 1 or
+        args.convert_metadata is not None and ( args.restore is not None or args.watch )
+    ):
         parser.print_help()
         sys.exit(os.EX_USAGE)
 
@@ -91,7 +123,19 @@ def main():
     setup_logging(args.debug, log_level)
 
     try:
-        if args.restore is None:
+        if args.convert_metadata is not None:
+            success = True
+
+            for backup_path in args.convert_metadata:
+                try:
+                    if metadata.convert(os.path.abspath(backup_path)):
+                        LOG.info("Metadata of %s has been converted.", backup_path)
+                    else:
+                        LOG.info("Metadata of %s is already in binary format.", backup_path)
+                except Exception as e:
+                    LOG.error("Failed to convert metadata of %s: %s", backup_path, e)
+                    success = False
+        elif args.restore is None:
             try:
                 try:
                     config = get_config(args.config)
@@ -99,16 +143,23 @@ def main():
                     raise Error("Error while reading configuration file {}: {}",
                         args.config, e)
 
-                with Backuper(config) as backuper:
-                    success = backuper.backup()
+                if args.watch:
+                    # Stop the watcher gracefully on SIGTERM
+                    signal.signal(signal.SIGTERM, signal.default_int_handler)
+                    Watcher(Storage(config["backup_root"]).journal_path(), config).run()
+                    success = True
+                else:
+                    with Backuper(config) as backuper:
+                        success = backuper.backup()
             except Exception as e:
-                raise Error("Backup failed: {}", e)
+                raise Error("{} failed: {}", "Watcher" if args.watch else "Backup", e)
         else:
             try:
                 paths_to_restore = [ os.path.abspath(path) for path in args.paths_to_restore ]
 
-                with Restore(os.path.abspath(args.restore), in_place = args.in_place) as restorer:
-                    success = restorer.restore(paths_to_restore or None)
+                with Restore(os.path.abspath(args.restore), in_place = args.in_place, jobs = args.jobs) as restorer:
+                    success = restorer.restore(paths_to_restore or None,
+                        globs = args.globs, regexes = args.regexes)
             except Exception as e:
                 raise Error("Restore failed: {}", e)
     except Exception as e:
@@ -0,0 +1,453 @@
+"""Backup metadata files.
+
+Backup metadata holds a ( hash, status, size, fingerprint, path ) record for
+each regular file with data. It's stored in metadata.bin file of the
+following binary format (all integers are big-endian):
+* header: "pyvsb-metadata" magic, format version, number of statuses and
+  files and offsets of the tables below;
+* status table - string table of unique statuses which are referenced by file
+  records by their indexes;
+* fingerprint table - string table of file fingerprints (in the file record
+  order; fingerprints are unique per file, so they aren't deduplicated);
+* file table - fixed-width file records: binary hash, size, status index and
+  offset of the file's data member in the backup's data file (raw.tar for
+  incompressible files) if the data is stored in this backup (records are
+  sorted by path);
+* path table - string table of file paths (in the file record order).
+
+A string table is an array of ( count + 1 ) boundary offsets of the strings
+followed by the UTF-8 encoded strings. The file isn't compressed, so it's
+read via mmap() without parsing, and files are looked up by path with a binary
+search. Data of the files is read from the backup's data file by the member
+offsets without reading its index or scanning the archive.
+
+Backups written by the old versions store the metadata in metadata.bz2 text
+file (a "{hash} {status} {size} {fingerprint} {path}" line for each file where
+size is absent in the oldest format) which is read as well and can be
+converted to the binary format (pyvsb --convert-metadata).
+"""
+
+import bz2
+import errno
+import logging
+import mmap
+import os
+import struct
+
+import psys
+
+from . import utils
+from .core import Error
+
+LOG = logging.getLogger(__name__)
+
+
+BINARY_FILE_NAME = "metadata.bin"
+"""Name of binary backup metadata file."""
+
+TEXT_FILE_NAME = "metadata.bz2"
+"""Name of legacy text backup metadata file."""
+
+
+_MAGIC = b"pyvsb-metadata\0\0"
+"""Binary metadata file magic."""
+
+_VERSION = 1
+"""Binary metadata format version."""
+
+_ENCODING = "utf-8"
+"""Metadata encoding."""
+
+_HASH_SIZE = 32
+"""Size of a binary file hash."""
+
+_UNKNOWN = 2 ** 64 - 1
+"""
+Size of files from the legacy metadata which doesn't contain file sizes or
+offset of a file whose data isn't stored in a member of the backup.
+"""
+
+_HEADER = struct.Struct(">16sIIQQQQ")
+"""
+Binary metadata file header: magic, version, number of statuses, number of
+files, fingerprint table offset, file table offset, path table offset.
+"""
+
+_FILE = struct.Struct(">{}sQBQ".format(_HASH_SIZE))
+"""File record: hash, size, status index, data member offset."""
+
+_OFFSET = struct.Struct(">Q")
+"""String table offset."""
+
+
+
+class Reader:
+    """Binary metadata file reader."""
+
+    def __init__(self, path):
+        # Metadata file
+        self.__file = None
+
+        # Memory-mapped file contents
+        self.__map = None
+
+        try:
+            self.__file = open(path, "rb")
+            self.__map = mmap.mmap(self.__file.fileno(), 0, access = mmap.ACCESS_READ)
+
+            if self.__map.size() < _HEADER.size:
+                raise Error("The file is truncated.")
+
+            (
+                magic, version, status_count, self.__count,
+                self.__fingerprints_offset, self.__files_offset, paths_offset
+            ) = _HEADER.unpack_from(self.__map)
+
+            if magic != _MAGIC:
+                raise Error("It's not a binary metadata file.")
+
+            if version != _VERSION:
+                raise Error("Unsupported metadata format version: {}.", version)
+
+            self.__paths_offset = paths_offset
+
+            if (
+                _get_string_table_end(self.__map, self.__fingerprints_offset, self.__count) > self.__files_offset or
+                self.__files_offset + self.__count * _FILE.size > paths_offset or
+                _get_string_table_end(self.__map, paths_offset, self.__count) != self.__map.size()
+            ):
+                raise Error("The file is corrupted.")
+
+            # Statuses are decoded once, so all records share the same string
+            # objects.
+            self.__statuses = _read_string_table(self.__map, _HEADER.size, status_count)
+        except:
+            self.close()
+            raise
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+    def __iter__(self):
+        return self.records()
+
+
+    def __len__(self):
+        return self.__count
+
+
+    def close(self):
+        """Closes the file."""
+
+        if self.__map is not None:
+            self.__map.close()
+            self.__map = None
+
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+
+    def records(self, offsets = False):
+        """
+        Yields a ( hash, status, size, fingerprint, path ) tuple for each file.
+
+        If offsets is True, the tuples are extended by offset of the file's
+        data member (None if the data isn't stored in the backup).
+        """
+
+        for index in range(self.__count):
+            yield self.__record(index, offsets = offsets)
+
+
+    def find(self, path):
+        """
+        Returns a ( hash, status, size, fingerprint, path ) tuple for the
+        specified path or None if there is no such file.
+        """
+
+        key = path.encode(_ENCODING)
+        low, high = 0, self.__count
+
+        while low < high:
+            middle = ( low + high ) // 2
+
+            if self.__path(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low < self.__count and self.__path(low) == key:
+            return self.__record(low)
+
+
+    def __path(self, index):
+        """Returns the specified file's encoded path."""
+
+        return _get_string(self.__map, self.__paths_offset, self.__count, index)
+
+
+    def __record(self, index, offsets = False):
+        """Returns the specified file's record."""
+
+        hash, size, status, offset = _FILE.unpack_from(
+            self.__map, self.__files_offset + index * _FILE.size)
+
+        record = (
+            hash.hex(), self.__statuses[status], None if size == _UNKNOWN else size,
+            _get_string(self.__map, self.__fingerprints_offset, self.__count, index).decode(_ENCODING),
+            self.__path(index).decode(_ENCODING))
+
+        if offsets:
+            record += ( None if offset == _UNKNOWN else offset, )
+
+        return record
+
+
+
+class Writer:
+    """Binary metadata file writer.
+
+    The file is written on close(), because the records have to be sorted.
+    The records are spilled to disk when the memory limit is exceeded.
+    """
+
+    def __init__(self, path, memory_limit = None):
+        # Metadata file
+        self.__file = open(path, "wb")
+
+        # ( path, hash, size, fingerprint, status index, offset ) records (a
+        # plain list if there is no memory limit)
+        self.__records = [] if memory_limit is None else utils.SpillableList(memory_limit)
+
+        # Interned statuses: value -> index
+        self.__statuses = {}
+
+        # Total size of the encoded fingerprints and paths
+        self.__fingerprints_size = 0
+        self.__paths_size = 0
+
+
+    def add(self, hash, status, size, fingerprint, path, offset = None):
+        """Adds the specified file's record.
+
+        offset is offset of the file's data member if the data is stored in
+        the backup.
+        """
+
+        if self.__file is None:
+            raise Error("The metadata file is closed.")
+
+        try:
+            hash = bytes.fromhex(hash)
+        except ValueError:
+            hash = b""
+
+        if len(hash) != _HASH_SIZE:
+            raise Error("Invalid file hash.")
+
+        path = path.encode(_ENCODING)
+        fingerprint = fingerprint.encode(_ENCODING)
+
+        self.__records.append(( path, hash, _UNKNOWN if size is None else size, fingerprint,
+            self.__statuses.setdefault(status, len(self.__statuses)),
+            _UNKNOWN if offset is None else offset ))
+
+        self.__fingerprints_size += len(fingerprint)
+        self.__paths_size += len(path)
+
+
+    def close(self):
+        """Writes the metadata and closes the file."""
+
+        if self.__file is None:
+            return
+
+        try:
+            count = len(self.__records)
+            statuses = _get_string_table(self.__statuses)
+
+            fingerprints_offset = _HEADER.size + len(statuses)
+            files_offset = fingerprints_offset + ( count + 1 ) * _OFFSET.size + self.__fingerprints_size
+            paths_offset = files_offset + count * _FILE.size
+
+            self.__file.write(_HEADER.pack(
+                _MAGIC, _VERSION, len(self.__statuses), count,
+                fingerprints_offset, files_offset, paths_offset))
+            self.__file.write(statuses)
+
+            _write_string_table(self.__file, lambda: ( record[3] for record in self.__sorted_records() ))
+
+            for path, hash, size, fingerprint, status, offset in self.__sorted_records():
+                self.__file.write(_FILE.pack(hash, size, status, offset))
+
+            _write_string_table(self.__file, lambda: ( record[0] for record in self.__sorted_records() ))
+        finally:
+            if isinstance(self.__records, utils.SpillableList):
+                self.__records.close()
+
+            self.__records = None
+
+            try:
+                self.__file.close()
+            finally:
+                self.__file = None
+
+
+    def __sorted_records(self):
+        """Iterates over the records sorted by path."""
+
+        if isinstance(self.__records, utils.SpillableList):
+            return self.__records.sorted()
+
+        self.__records.sort()
+
+        return iter(self.__records)
+
+
+
+def convert(backup_path):
+    """Converts legacy text metadata of the specified backup to binary format.
+
+    Returns False if the backup's metadata is already in binary format.
+    """
+
+    text_path = os.path.join(backup_path, TEXT_FILE_NAME)
+    binary_path = os.path.join(backup_path, BINARY_FILE_NAME)
+
+    if os.path.exists(binary_path):
+        return False
+
+    temp_path = binary_path + ".tmp"
+
+    try:
+        writer = Writer(temp_path)
+
+        try:
+            for record in _read_text(text_path):
+                writer.add(*record)
+        finally:
+            writer.close()
+
+        with open(temp_path, "rb") as metadata_file:
+            os.fsync(metadata_file.fileno())
+
+        os.rename(temp_path, binary_path)
+    except:
+        try:
+            os.unlink(temp_path)
+        except Exception as e:
+            if not psys.is_errno(e, errno.ENOENT):
+                LOG.error("Failed to delete '%s': %s.", temp_path, psys.e(e))
+
+        raise
+
+    os.unlink(text_path)
+
+    return True
+
+
+def read(backup_path, offsets = False):
+    """Reads metadata of the specified backup.
+
+    Yields a ( hash, status, size, fingerprint, path ) tuple for each file.
+    size is None for metadata written by the old versions which didn't store
+    file sizes. If offsets is True, the tuples are extended by offset of the
+    file's data member (see Reader.records()).
+    """
+
+    binary_path = os.path.join(backup_path, BINARY_FILE_NAME)
+
+    if os.path.exists(binary_path):
+        with Reader(binary_path) as reader:
+            yield from reader.records(offsets = offsets)
+    else:
+        for record in _read_text(os.path.join(backup_path, TEXT_FILE_NAME)):
+            yield record + ( None, ) if offsets else record
+
+
+
+def _get_string(buffer, offset, count, index):
+    """Returns the specified string from a string table."""
+
+    start, = _OFFSET.unpack_from(buffer, offset + index * _OFFSET.size)
+    end, = _OFFSET.unpack_from(buffer, offset + ( index + 1 ) * _OFFSET.size)
+    data_offset = offset + ( count + 1 ) * _OFFSET.size
+
+    return buffer[data_offset + start:data_offset + end]
+
+
+def _get_string_table(strings):
+    """Returns a string table for the specified strings."""
+
+    strings = [ string if isinstance(string, bytes) else string.encode(_ENCODING) for string in strings ]
+
+    offsets = [ 0 ]
+    for string in strings:
+        offsets.append(offsets[-1] + len(string))
+
+    return b"".join(_OFFSET.pack(offset) for offset in offsets) + b"".join(strings)
+
+
+def _get_string_table_end(buffer, offset, count):
+    """Returns end offset of a string table."""
+
+    size, = _OFFSET.unpack_from(buffer, offset + count * _OFFSET.size)
+
+    return offset + ( count + 1 ) * _OFFSET.size + size
+
+
+def _parse_text(line):
+    """Parses a text metadata line.
+
+    Returns a ( hash, status, size, fingerprint, path ) tuple.
+    """
+
+    hash, status, size, other = line.split(" ", 3)
+
+    # Fingerprints always contain ':' and sizes never do
+    if ":" in size:
+        return ( hash, status, None, size, other )
+
+    fingerprint, path = other.split(" ", 1)
+
+    return hash, status, int(size), fingerprint, path
+
+
+def _read_string_table(buffer, offset, count):
+    """Reads all strings of a string table."""
+
+    return [ _get_string(buffer, offset, count, index).decode(_ENCODING) for index in range(count) ]
+
+
+def _read_text(path):
+    """Reads a legacy text metadata file."""
+
+    with bz2.BZ2File(path, mode = "r") as metadata_file:
+        for line in metadata_file:
+            line = line.rstrip(b"\r\n")
+            if line:
+                yield _parse_text(line.decode(_ENCODING))
+
+
+def _write_string_table(file, get_strings):
+    """Writes a string table for the strings returned by get_strings().
+
+    get_strings() is called twice, so the strings aren't kept in memory.
+    """
+
+    offset = 0
+    file.write(_OFFSET.pack(offset))
+
+    for string in get_strings():
+        offset += len(string)
+        file.write(_OFFSET.pack(offset))
+
+    for string in get_strings():
+        file.write(string)
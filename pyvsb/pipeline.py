@@ -0,0 +1,308 @@
+"""Pipelined reading of backed up files."""
+
+import io
+import logging
+import queue
+import threading
+
+from hashlib import sha256
+
+import psys
+
+from . import utils
+
+LOG = logging.getLogger(__name__)
+
+
+class ReadPipeline:
+    """Reads and hashes files in advance.
+
+    The pipeline consists of the following stages connected by bounded
+    queues:
+    * reader threads open files and read their contents into memory;
+    * a hasher thread hashes the read data.
+
+    The consumer takes the files in the order it needs them and writes them to
+    the backup: the tar stream has to be written sequentially, so there is no
+    separate writer stage, and the parallel compressor of the backup data
+    file stands in for it.
+
+    Depths of the stage queues are sampled once per consumed file and their
+    average and maximum are reported on close() to show which stage is the
+    bottleneck.
+
+    Only files which are not bigger than max_size are read into memory. The
+    other ones are just opened and fstat()'ed by the reader threads and are
+    read by the consumer as usual.
+    """
+
+    def __init__(self, open_file, need_data, readers, max_size, depth):
+        # Opens a file returning a ( file_obj, stat_info ) tuple
+        self.__open_file = open_file
+
+        # Checks whether the file data has to be read by its path and stat()
+        # info
+        self.__need_data = need_data
+
+        # Maximum size of a file that is read into memory
+        self.__max_size = max_size
+
+        # Maximum number of files that are processed by the pipeline at the
+        # same time
+        self.__depth = depth
+
+        # How many not yet processed files are scheduled for reading in each
+        # directory which is being traversed
+        self.lookahead = readers * 2
+
+        # Files that are processed by the pipeline
+        self.__jobs = {}
+
+        # Stage queues
+        self.__read_queue = queue.Queue(depth)
+        self.__hash_queue = queue.Queue(depth)
+
+        # Protects the pipeline's state shared between the threads
+        self.__lock = threading.Lock()
+
+        # Pipeline threads
+        self.__readers = []
+        self.__hasher = None
+
+        # Statistics on the stage queue depths: stage -> [ sum, maximum ]
+        self.__stats = { stage: [ 0, 0 ] for stage in _STAGES }
+        self.__samples = 0
+
+        try:
+            for reader_id in range(readers):
+                reader = threading.Thread(target = self.__reader,
+                    name = "Reader #{}".format(reader_id), daemon = True)
+                reader.start()
+                self.__readers.append(reader)
+
+            if self.__readers:
+                self.__hasher = threading.Thread(
+                    target = self.__hash, name = "Hasher", daemon = True)
+                self.__hasher.start()
+        except:
+            self.close()
+            raise
+
+
+    def accepts(self, entry):
+        """Checks whether the pipeline prefetches the specified entry."""
+
+        return bool(self.__readers) and entry.is_file(follow_symlinks = False)
+
+
+    def close(self):
+        """Closes the object."""
+
+        with self.__lock:
+            for job in self.__jobs.values():
+                job.cancelled = True
+
+        for reader in self.__readers:
+            self.__read_queue.put(None)
+
+        for reader in self.__readers:
+            psys.join_thread(reader)
+
+        if self.__hasher is not None:
+            self.__hash_queue.put(None)
+            psys.join_thread(self.__hasher)
+            self.__hasher = None
+
+        del self.__readers[:]
+
+        for job in self.__jobs.values():
+            job.close()
+
+        self.__jobs.clear()
+
+        if self.__samples:
+            LOG.info("Read pipeline queue depth (average/maximum): %s.", ", ".join(
+                "{} {:.1f}/{}".format(stage, self.__stats[stage][0] / self.__samples, self.__stats[stage][1])
+                for stage in _STAGES))
+
+            self.__samples = 0
+
+
+    def forget(self, path):
+        """Forgets the specified file if it hasn't been consumed."""
+
+        job = self.__jobs.pop(path, None)
+
+        if job is not None:
+            with self.__lock:
+                job.cancelled = True
+
+            job.done.wait()
+            job.close()
+
+
+    def read(self, path):
+        """Returns a ( file_obj, stat_info, file_hash ) tuple for the specified file.
+
+        file_hash is not None if the file has been read and hashed by the
+        pipeline.
+        """
+
+        job = self.__jobs.pop(path, None)
+
+        if job is None:
+            return self.__read(path, pipelined = False)[:2] + ( None, )
+
+        self.__sample()
+        job.done.wait()
+
+        if job.error is not None:
+            raise job.error
+
+        return job.file_obj, job.stat_info, job.file_hash
+
+
+    def schedule(self, path):
+        """Schedules reading of the specified file."""
+
+        if path in self.__jobs:
+            return True
+
+        if len(self.__jobs) >= self.__depth:
+            return False
+
+        job = self.__jobs[path] = _Job(path)
+        self.__read_queue.put_nowait(job)
+
+        return True
+
+
+    def __finish(self, job):
+        """Marks the job as finished."""
+
+        with self.__lock:
+            job.done.set()
+
+
+    def __hash(self):
+        """Hasher thread."""
+
+        while True:
+            job = self.__hash_queue.get()
+            if job is None:
+                break
+
+            try:
+                if not job.cancelled:
+                    job.file_hash = sha256(job.data).hexdigest()
+                    job.file_obj = io.BytesIO(job.data)
+            except BaseException as e:
+                job.error = e
+            finally:
+                job.data = None
+                self.__finish(job)
+
+
+    def __read(self, path, pipelined = True):
+        """Opens the specified file and reads its data if it's needed.
+
+        Returns a ( file_obj, stat_info, data ) tuple where file_obj is None
+        if the file's data has been read.
+        """
+
+        file_obj, stat_info = self.__open_file(path)
+
+        try:
+            if (
+                not pipelined or stat_info.st_size > self.__max_size or
+                not self.__need_data(path, stat_info)
+            ):
+                return file_obj, stat_info, None
+
+            with file_obj:
+                data = utils.read_file(file_obj, stat_info.st_size)
+
+            return None, stat_info, data
+        except:
+            file_obj.close()
+            raise
+
+
+    def __reader(self):
+        """Reader thread."""
+
+        while True:
+            job = self.__read_queue.get()
+            if job is None:
+                break
+
+            try:
+                if not job.cancelled:
+                    job.file_obj, job.stat_info, job.data = self.__read(job.path)
+            except BaseException as e:
+                job.error = e
+            else:
+                if job.data is not None:
+                    self.__hash_queue.put(job)
+                    continue
+
+            self.__finish(job)
+
+
+    def __sample(self):
+        """Samples the stage queue depths."""
+
+        for stage, stage_queue in ( ( "read", self.__read_queue ), ( "hash", self.__hash_queue ) ):
+            depth = stage_queue.qsize()
+            stats = self.__stats[stage]
+            stats[0] += depth
+            stats[1] = max(stats[1], depth)
+
+        self.__samples += 1
+
+
+
+class _Job:
+    """Represents a file processed by the pipeline."""
+
+    def __init__(self, path):
+        # File path
+        self.path = path
+
+        # Opened file object
+        self.file_obj = None
+
+        # File's stat() info
+        self.stat_info = None
+
+        # File's data read by the reader stage
+        self.data = None
+
+        # File's data hash
+        self.file_hash = None
+
+        # An error occurred during processing the file
+        self.error = None
+
+        # Set when the consumer doesn't need the file anymore
+        self.cancelled = False
+
+        # Set when the file is processed
+        self.done = threading.Event()
+
+
+    def close(self):
+        """Closes the file."""
+
+        if self.file_obj is not None:
+            try:
+                self.file_obj.close()
+            except Exception as e:
+                LOG.error("Unable to close '%s': %s.", self.path, psys.e(e))
+            finally:
+                self.file_obj = None
+
+
+
+_STAGES = ( "read", "hash" )
+"""Pipeline stages whose queue depths are reported."""
@@ -28,6 +28,13 @@ _BACKUP_NAME_RE = re.compile(r"^\d{4}\.\d{2}\.\d{2}-\d{2}:\d{2}:\d{2}$")
 """Backup name regular expression."""
 
 
+_JOURNAL_FILE_NAME = ".journal"
+"""Name of the change journal file."""
+
+_INDEX_FILE_NAME = ".index"
+"""Name of the backup group index file."""
+
+
 
 class Storage:
     """Backup data storage abstraction."""
@@ -87,8 +94,13 @@ class Storage:
                     path, psys.e(excinfo[1])))
 
 
-    def commit_backup(self, group, name):
-        """Commits written backup data."""
+    def commit_backup(self, group, name, index = False):
+        """Commits written backup data.
+
+        If index is True, the group's index is atomically replaced with the
+        new one written to the temporary index path after the backup is
+        committed.
+        """
 
         cur_path = self.backup_path(group, name, temp = True)
         new_path = self.backup_path(group, name)
@@ -96,9 +108,24 @@ class Storage:
         try:
             os.rename(cur_path, new_path)
         except Exception as e:
+            if index:
+                self.__remove_index(group)
+
             raise Error("Unable to rename backup data directory '{}' to '{}': {}.",
                 cur_path, new_path, psys.e(e))
 
+        if index:
+            cur_index_path = self.index_path(group, temp = True)
+            new_index_path = self.index_path(group)
+
+            try:
+                os.rename(cur_index_path, new_index_path)
+            except Exception as e:
+                # The old index is stale now, so it will be rebuilt
+                LOG.error("Unable to rename backup group index '%s' to '%s': %s.",
+                    cur_index_path, new_index_path, psys.e(e))
+                self.__remove_index(group)
+
         self.__on_backup_created(group, name, new_path)
 
 
@@ -154,6 +181,19 @@ class Storage:
         return os.path.join(self.__backup_root, group)
 
 
+    def index_path(self, group, temp = False):
+        """Returns a path to the specified group's index."""
+
+        return os.path.join(self.group_path(group),
+            _INDEX_FILE_NAME + ".tmp" if temp else _INDEX_FILE_NAME)
+
+
+    def journal_path(self):
+        """Returns a path to the change journal."""
+
+        return os.path.join(self.__backup_root, _JOURNAL_FILE_NAME)
+
+
     def rotate_groups(self, max_backup_groups):
         """Rotates backup groups."""
 
@@ -220,6 +260,18 @@ class Storage:
                 self.__backup_root, psys.e(e))
 
 
+    def __remove_index(self, group):
+        """Removes the specified group's temporary index."""
+
+        index_path = self.index_path(group, temp = True)
+
+        try:
+            os.unlink(index_path)
+        except EnvironmentError as e:
+            if e.errno != errno.ENOENT:
+                LOG.error("Failed to remove '%s': %s.", index_path, psys.e(e))
+
+
     def __on_backup_created(self, logger, *args):
         """An empty backup creation handler."""
 
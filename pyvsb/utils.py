@@ -1,46 +1,162 @@
 """Various utils."""
 
+import bisect
 import bz2
+import collections
+import copy
 import errno
 import grp
+import functools
 import gzip
+import heapq
 import logging
+import lzma
+import marshal
+import os
 import pwd
 import shutil
+import sqlite3
+import sys
 import tarfile
 import tempfile
+import threading
 
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import sha256
 
 import psys
 
+try:
+    from compression import zstd
+except ImportError:
+    zstd = None
+
+from .core import Error
+
 LOG = logging.getLogger(__name__)
 
 
+_READ_SIZE = 64 * 1024
+"""Size of blocks in which files are read."""
+
+_ZEROS = bytes(1024 * 1024)
+"""A block of zeros for hashing file holes."""
+
+_COMPRESSION_BLOCK_SIZE = 4 * 1024 * 1024
+"""Size of blocks which are compressed independently in parallel."""
+
+_INDEX_SUFFIX = ".index"
+"""
+Suffix of index files of compressed tar files (offsets of compressed frames
+and archive members).
+"""
+
+_INDEX_ENCODING = "utf-8"
+"""Encoding of index and manifest files."""
+
+_MANIFEST_SUFFIX = ".volumes"
+"""
+Suffix of manifest files of multi-volume tar files (a list of volumes and
+paths they hold).
+"""
+
+_VOLUME_OFFSET = 1 << 48
+"""
+Members of multi-volume tar files have offsets of volume_id * _VOLUME_OFFSET +
+offset_in_the_volume, so the offsets are ordered in the archive order.
+"""
+
+
+_HASH_SIZE = 32
+"""Size of a binary SHA-256 hash."""
+
+_EMPTY_HASH = bytes(_HASH_SIZE)
+"""Empty hash table slot."""
+
+_HASH_SET_MIN_CAPACITY = 1024
+"""Minimum capacity of a HashSet table."""
+
+_HASH_SET_MAX_LOAD = 0.7
+"""Maximum load factor of a HashSet table."""
+
+_BLOOM_FILTER_BITS = 8
+"""Number of Bloom filter bits per HashSet table slot."""
+
+_BLOOM_FILTER_HASHES = 4
+"""Number of Bloom filter hash functions."""
+
+
+_SPILL_CACHE_SIZE = 64 * 1024
+"""Number of recently used items of a spilled SpillableDict kept in memory."""
+
+_SPILL_BATCH_SIZE = 1000
+"""Number of items read from a spilled SpillableDict at a time."""
+
+_DICT_ITEM_OVERHEAD = 48
+"""Approximate memory usage of a dict item besides its key and value."""
+
+_LIST_ITEM_OVERHEAD = 8
+"""Approximate memory usage of a list item besides its value."""
+
+
 _DB_ENTRIES_CACHE = {}
 """A DB entries cache."""
 
+_MISSING = object()
+"""A missing value marker."""
+
 
 class CompressedTarFile:
     """A wrapper for a compressed tar file."""
 
-    __formats = {
-        "bz2": {
+    __formats = collections.OrderedDict((
+        ( "bz2", {
             "extension":    ".bz2",
             "mode":         ":bz2",
+            "compress":     bz2.compress,
+            "decompress":   bz2.decompress,
             "decompressor": bz2.BZ2File,
-        },
-        "gz": {
+            "level_arg":    "compresslevel",
+            "levels":       ( 1, 9, 9 ),
+        }),
+        ( "gz", {
             "extension":    ".gz",
             "mode":         ":gz",
+            "compress":     gzip.compress,
+            "decompress":   gzip.decompress,
             "decompressor": gzip.GzipFile,
-        },
-        "none": {
+            "level_arg":    "compresslevel",
+            "levels":       ( 1, 9, 9 ),
+        }),
+        ( "xz", {
+            "extension":    ".xz",
+            "mode":         ":xz",
+            "compress":     lzma.compress,
+            "decompress":   lzma.decompress,
+            "decompressor": lzma.LZMAFile,
+            "level_arg":    "preset",
+            "levels":       ( 0, 9, 6 ),
+        }),
+    ) + ((
+        ( "zstd", {
+            "extension":    ".zst",
+            "mode":         ":zst",
+            "compress":     zstd.compress,
+            "decompress":   zstd.decompress,
+            "decompressor": zstd.ZstdFile,
+            "level_arg":    "level",
+            "levels":       ( 1, 22, 3 ),
+        }),
+    ) if zstd is not None else ()) + (
+        ( "none", {
             "extension": "",
             "mode":      "",
-        },
-    }
-    """Available file formats."""
+        }),
+    ))
+    """
+    Available file formats (compression levels are specified as ( min, max,
+    default ) tuples).
+    """
 
 
     __file = None
@@ -49,14 +165,35 @@ class CompressedTarFile:
     __temp_file = None
     """A temporary file."""
 
+    __compressor = None
+    """Parallel compressor the tar file is written to."""
+
+    __framed_file = None
+    """Compressed frames the tar file is read from."""
+
+    __index = None
+    """
+    A map of archive member names to their offsets (for archives which are
+    written or read by frames).
+    """
+
+    __seekable = False
+    """True if the file is opened for writing and supports rollback."""
 
-    def __init__(self, path, write = None, decompress = True):
+
+    def __init__(self, path, write = None, decompress = True, threads = 1, level = None):
         try:
             if write is None:
                 for file_format in self.__formats.values():
                     cur_path = path + file_format["extension"]
 
                     try:
+                        if "decompress" in file_format and os.path.exists(cur_path + _INDEX_SUFFIX):
+                            # Random access is available, so there is no need
+                            # to decompress the whole archive
+                            self.__open_frames(cur_path, file_format)
+                            break
+
                         if decompress and "decompressor" in file_format:
                             with file_format["decompressor"](cur_path) as compressed_file:
                                 self.__decompress(cur_path, compressed_file)
@@ -72,10 +209,23 @@ class CompressedTarFile:
                     raise error
             else:
                 file_format = self.__formats[write]
+                path += file_format["extension"]
+
+                options = {}
+                if "levels" in file_format:
+                    options[file_format["level_arg"]] = file_format["levels"][2] if level is None else level
+
+                if "compress" in file_format:
+                    self.__compressor = ParallelCompressor(path,
+                        functools.partial(file_format["compress"], **options), threads)
+                    self.__file = tarfile.open(
+                        fileobj = self.__compressor, mode = "w", format = tarfile.PAX_FORMAT)
+                    self.__index = collections.OrderedDict()
+                else:
+                    self.__file = tarfile.open(
+                        path, "w" + file_format["mode"], format = tarfile.PAX_FORMAT, **options)
 
-                self.__file = tarfile.open(
-                    path + file_format["extension"], "w" + file_format["mode"],
-                    format = tarfile.PAX_FORMAT)
+                self.__seekable = not file_format["mode"]
         except:
             self.close()
             raise
@@ -89,15 +239,127 @@ class CompressedTarFile:
         return iter(self.__file)
 
 
+    def addfile(self, tar_info, fileobj = None):
+        """Adds a member to the archive.
+
+        Returns the member's offset (see member()).
+        """
+
+        offset = self.__file.offset
+
+        if self.__index is not None:
+            self.__index[tar_info.pax_headers.get("GNU.sparse.name", tar_info.name)] = offset
+
+        self.__file.addfile(tar_info, fileobj = fileobj)
+
+        return offset
+
+
+    @classmethod
+    def formats(cls):
+        """
+        Returns a map of available compression formats to their ( min, max )
+        compression levels (None if the format has no compression levels).
+        """
+
+        return collections.OrderedDict(
+            ( name, file_format["levels"][:2] if "levels" in file_format else None )
+            for name, file_format in cls.__formats.items())
+
+
     def close(self):
         """Closes the file."""
 
         try:
-            if self.__file is not None:
-                self.__file.close()
+            try:
+                if self.__file is not None:
+                    self.__file.close()
+            finally:
+                if self.__compressor is not None:
+                    self.__compressor.close()
+                    self.__write_index()
         finally:
-            if self.__temp_file is not None:
-                self.__temp_file.close()
+            try:
+                if self.__framed_file is not None:
+                    self.__framed_file.close()
+            finally:
+                if self.__temp_file is not None:
+                    self.__temp_file.close()
+
+
+    def indexed_members(self):
+        """
+        Returns a map of archive member names to their offsets or None if the
+        archive has no index.
+        """
+
+        return self.__index
+
+
+    def member(self, offset):
+        """Reads a member at the specified offset."""
+
+        # Keep the current position if the archive is being iterated
+        iter_offset = self.__file.offset
+
+        try:
+            self.__file.fileobj.seek(offset)
+            return self.__file.tarinfo.fromtarfile(self.__file)
+        finally:
+            self.__file.offset = iter_offset
+
+
+    def rollback(self, savepoint):
+        """Rolls the archive back to the specified savepoint."""
+
+        offset, members = savepoint
+
+        self.__file.fileobj.seek(offset)
+        self.__file.fileobj.truncate()
+        self.__file.offset = offset
+        del self.__file.members[members:]
+
+
+    def savepoint(self):
+        """
+        Returns a savepoint which the archive may be rolled back to or None if
+        the archive doesn't support rollback.
+        """
+
+        if not self.__seekable:
+            return None
+
+        return self.__file.offset, len(self.__file.members)
+
+
+    def __open_frames(self, path, file_format):
+        """Opens an archive which has been written by independent frames."""
+
+        frames = []
+        self.__index = collections.OrderedDict()
+
+        with bz2.BZ2File(path + _INDEX_SUFFIX) as index_file:
+            for line in index_file:
+                record_type, offset, value = line.decode(_INDEX_ENCODING).rstrip("\n").split(" ", 2)
+
+                if record_type == "F":
+                    frames.append(( int(offset), int(value) ))
+                else:
+                    self.__index[value] = int(offset)
+
+        self.__framed_file = FramedFile(path, frames, file_format["decompress"])
+        self.__file = tarfile.open(fileobj = self.__framed_file, mode = "r:")
+
+
+    def __write_index(self):
+        """Writes offsets of the archive's frames and members."""
+
+        with bz2.BZ2File(self.__compressor.path + _INDEX_SUFFIX, mode = "w") as index_file:
+            for offset, compressed_offset in self.__compressor.frames:
+                index_file.write("F {} {}\n".format(offset, compressed_offset).encode(_INDEX_ENCODING))
+
+            for name, offset in self.__index.items():
+                index_file.write("M {} {}\n".format(offset, name).encode(_INDEX_ENCODING))
 
 
     def __decompress(self, path, compressed_file):
@@ -129,93 +391,1517 @@ class CompressedTarFile:
 
 
 
-class HashableFile():
-    """A wrapper for a file object that hashes all read data."""
+class MultiVolumeTarFile:
+    """A wrapper for a tar file which may be split into size-bounded volumes.
 
-    def __init__(self, file):
-        self.__file = file
-        self.__hash = sha256()
+    If max_volume_size is 0, the archive is written as a single
+    CompressedTarFile. Otherwise a new volume is started each time the
+    current volume's uncompressed size exceeds max_volume_size and a manifest
+    is written to list the volumes and the members they hold. Volumes are
+    opened on demand on reading, so when only some members are needed only
+    the volumes that hold them are opened.
+    """
 
+    def __init__(self, path, write = None, decompress = True, threads = 1, level = None, max_volume_size = 0):
+        # Archive path
+        self.__path = path
 
-    def hexdigest(self):
-        """Returns read data hash."""
+        # Volume writing options
+        self.__write = write
+        self.__threads = threads
+        self.__level = level
+        self.__max_volume_size = max_volume_size
 
-        return self.__hash.hexdigest()
+        # Don't use extra disc space by decompressing the volumes
+        self.__decompress = decompress
 
+        # Volume objects (None for not opened ones)
+        self.__volumes = []
 
-    def read(self, *args, **kwargs):
-        """Reads data from the file and hashes the returning value."""
+        # The volume which is being read by next()
+        self.__next_volume = 0
 
-        data = self.__file.read(*args, **kwargs)
-        self.__hash.update(data)
-        return data
+        # Members of the volumes for the manifest
+        self.__manifest = None
 
+        # True if the archive is split into volumes
+        self.__split = False
 
-    def reset(self):
-        """Resets the file position."""
+        # Member names to ids of the volumes that hold them (from the
+        # manifest)
+        self.__member_volumes = {}
 
-        self.__file.seek(0)
-        self.__hash = sha256()
+        if write is None:
+            manifest_path = path + _MANIFEST_SUFFIX
+            self.__split = os.path.exists(manifest_path)
 
+            if self.__split:
+                with bz2.BZ2File(manifest_path) as manifest_file:
+                    for line in manifest_file:
+                        record_type, value = line.decode(_INDEX_ENCODING).rstrip("\n").split(" ", 1)
 
+                        if record_type == "V":
+                            self.__volumes.append(None)
+                        else:
+                            self.__member_volumes[value] = len(self.__volumes) - 1
+            else:
+                self.__volumes.append(CompressedTarFile(path, decompress = decompress))
+        else:
+            if max_volume_size:
+                self.__manifest = []
+                self.__split = True
 
-def getgrgid(gid):
-    """Cached grp.getgrgid()."""
+            self.__open_volume()
 
-    return _get_gr_entries()[2][gid]
 
+    def __iter__(self):
+        for volume_id in range(len(self.__volumes)):
+            for tar_info in self.__volume(volume_id):
+                yield _get_virtual_tar_info(tar_info, volume_id)
 
-def getgrnam(name):
-    """Cached grp.getgrnam()."""
 
-    return _get_gr_entries()[0][name]
+    def addfile(self, tar_info, fileobj = None):
+        """Adds a member to the archive.
 
+        Returns the member's offset (see member()).
+        """
 
-def getpwuid(uid):
-    """Cached pwd.getpwuid()."""
+        self.__rollover()
+        offset = self.__volumes[-1].addfile(tar_info, fileobj = fileobj)
 
-    return _get_pwd_entries()[2][uid]
+        if self.__manifest is not None:
+            self.__manifest[-1].append(tar_info.pax_headers.get("GNU.sparse.name", tar_info.name))
 
+        return ( len(self.__volumes) - 1 ) * _VOLUME_OFFSET + offset
 
-def getpwnam(name):
-    """Cached pwd.getpwnam()."""
 
-    return _get_pwd_entries()[0][name]
+    def close(self):
+        """Closes the archive."""
 
+        try:
+            for volume in self.__volumes:
+                if volume is not None:
+                    volume.close()
+        finally:
+            self.__volumes = []
 
-def _get_db_entries(name, func):
-    """Returns cached DB entries.
+        if self.__manifest is not None:
+            with bz2.BZ2File(self.__path + _MANIFEST_SUFFIX, mode = "w") as manifest_file:
+                for volume_id, names in enumerate(self.__manifest):
+                    manifest_file.write("V {}\n".format(os.path.basename(
+                        self.__volume_path(volume_id))).encode(_INDEX_ENCODING))
 
-    grp and pwd modules reread /etc/group and /etc/passwd files on each method
-    call.
+                    for name in names:
+                        manifest_file.write("M {}\n".format(name).encode(_INDEX_ENCODING))
+
+            self.__manifest = None
+
+
+    def extract(self, member, *args, **kwargs):
+        """Extracts the member."""
+
+        volume_id, member = _get_volume_tar_info(member)
+        return self.__volume(volume_id).extract(member, *args, **kwargs)
+
+
+    def extractfile(self, member):
+        """Returns a file object for the member's data."""
+
+        volume_id, member = _get_volume_tar_info(member)
+        return self.__volume(volume_id).extractfile(member)
+
+
+    def indexed_members(self, names = None):
+        """
+        Returns a map of archive member names to their offsets or None if the
+        archive has no index.
+
+        If names are specified, returns only the specified members opening
+        only the volumes that hold them.
+        """
+
+        members = collections.OrderedDict()
+
+        for volume_id, volume_names in self.__get_volumes(names):
+            index = self.__volume(volume_id).indexed_members()
+            if index is None:
+                return None
+
+            for name in index if volume_names is None else volume_names:
+                offset = index.get(name)
+                if offset is not None:
+                    members[name] = volume_id * _VOLUME_OFFSET + offset
+
+        return members
+
+
+    def member_names(self):
+        """
+        Returns names of the archive's members known without reading the
+        archive (from the manifest or the index) or None if they are unknown.
+        """
+
+        if self.__split:
+            return self.__member_volumes.keys()
+
+        index = self.__volume(0).indexed_members()
+        return None if index is None else index.keys()
+
+
+    def members(self, names):
+        """
+        Yields the members with the specified names in the archive order
+        opening only the volumes that hold them.
+        """
+
+        names = set(names)
+        index = self.indexed_members(names)
+
+        if index is not None:
+            for offset in sorted(index.values()):
+                yield self.member(offset)
+            return
+
+        for volume_id, volume_names in self.__get_volumes(names):
+            for tar_info in self.__volume(volume_id):
+                if tar_info.name in names:
+                    yield _get_virtual_tar_info(tar_info, volume_id)
+
+
+    def member(self, offset):
+        """Reads a member at the specified offset."""
+
+        volume_id, offset = divmod(offset, _VOLUME_OFFSET)
+        return _get_virtual_tar_info(self.__volume(volume_id).member(offset), volume_id)
+
+
+    def next(self):
+        """Reads the next member of the archive without caching it."""
+
+        while self.__next_volume < len(self.__volumes):
+            volume = self.__volume(self.__next_volume)
+
+            tar_info = volume.next()
+            del volume.members[:]
+
+            if tar_info is not None:
+                return _get_virtual_tar_info(tar_info, self.__next_volume)
+
+            self.__next_volume += 1
+
+
+    def rollback(self, savepoint):
+        """Rolls the archive back to the specified savepoint."""
+
+        volume_id, members, savepoint = savepoint
+
+        if volume_id != len(self.__volumes) - 1:
+            raise Error("Unable to roll back to a closed volume.")
+
+        self.__volumes[-1].rollback(savepoint)
+
+        if self.__manifest is not None:
+            del self.__manifest[-1][members:]
+
+
+    def savepoint(self):
+        """
+        Returns a savepoint which the archive may be rolled back to or None if
+        the archive doesn't support rollback.
+        """
+
+        self.__rollover()
+
+        savepoint = self.__volumes[-1].savepoint()
+        if savepoint is None:
+            return None
+
+        members = len(self.__manifest[-1]) if self.__manifest is not None else None
+
+        return len(self.__volumes) - 1, members, savepoint
+
+
+    def __get_volumes(self, names):
+        """
+        Returns ( volume_id, names ) tuples for the volumes that hold the
+        specified members (all volumes if names is None).
+        """
+
+        if names is None:
+            return [ ( volume_id, None ) for volume_id in range(len(self.__volumes)) ]
+
+        if not self.__split:
+            return [ ( 0, names ) ]
+
+        volumes = collections.defaultdict(list)
+
+        for name in names:
+            volume_id = self.__member_volumes.get(name)
+            if volume_id is not None:
+                volumes[volume_id].append(name)
+
+        return sorted(volumes.items())
+
+
+    def __open_volume(self):
+        """Starts a new volume."""
+
+        volume_id = len(self.__volumes)
+
+        self.__volumes.append(CompressedTarFile(self.__volume_path(volume_id),
+            write = self.__write, threads = self.__threads, level = self.__level))
+
+        if self.__manifest is not None:
+            self.__manifest.append([])
+
+
+    def __rollover(self):
+        """Starts a new volume if the current one is full."""
+
+        if self.__max_volume_size and self.__volumes[-1].offset >= self.__max_volume_size:
+            volume = self.__volumes[-1]
+            self.__volumes[-1] = None
+            volume.close()
+
+            self.__open_volume()
+
+
+    def __volume(self, volume_id):
+        """Returns the specified volume opening it if needed."""
+
+        volume = self.__volumes[volume_id]
+
+        if volume is None:
+            volume = self.__volumes[volume_id] = CompressedTarFile(
+                self.__volume_path(volume_id), decompress = self.__decompress)
+
+        return volume
+
+
+    def __volume_path(self, volume_id):
+        """Returns path of the specified volume."""
+
+        if not self.__split:
+            return self.__path
+
+        base, extension = os.path.splitext(self.__path)
+        return "{}.{:03d}{}".format(base, volume_id, extension)
+
+
+
+class ParallelCompressor:
     """
+    A file object which splits written data into blocks and compresses them
+    independently in parallel (like pbzip2 and pigz do).
 
-    cache = _DB_ENTRIES_CACHE.get(name)
+    The compressed blocks are written one after another as separate streams,
+    so the file can be decompressed by the standard tools.
+    """
 
-    if cache is None:
-        id_cache = {}
-        name_cache = {}
+    def __init__(self, path, compress, threads):
+        # Path to the compressed file
+        self.path = path
 
-        cache = {
-            2: id_cache,
-            0: name_cache,
-        }
+        # Offsets of the compressed blocks in the uncompressed and compressed
+        # data
+        self.frames = []
 
-        for entry in func():
-            id_cache[entry[2]] = name_cache[entry[0]] = entry
+        # Compressing function
+        self.__compress = compress
 
-        _DB_ENTRIES_CACHE[name] = cache
+        # Not yet compressed data
+        self.__buffer = bytearray()
 
-    return cache
+        # Size of all written data
+        self.__size = 0
 
+        # Size of all compressed data
+        self.__compressed_size = 0
 
-def _get_gr_entries():
-    """Returns cached grp database entries."""
+        # Blocks being compressed
+        self.__blocks = collections.deque()
 
-    return _get_db_entries("grp", grp.getgrall)
+        # Maximum number of blocks being compressed at the same time
+        self.__max_blocks = threads * 2
 
+        # Compressing threads
+        self.__executor = None
 
-def _get_pwd_entries():
-    """Returns cached pwd database entries."""
+        # The compressed file
+        self.__file = open(path, "wb")
 
-    return _get_db_entries("pwd", pwd.getpwall)
+        try:
+            self.__executor = ThreadPoolExecutor(max_workers = threads)
+        except:
+            self.__file.close()
+            raise
+
+
+    def close(self):
+        """Compresses the remaining data and closes the file."""
+
+        if self.__file is None:
+            return
+
+        try:
+            if self.__buffer:
+                self.__compress_block()
+
+            while self.__blocks:
+                self.__write_block()
+        finally:
+            try:
+                self.__executor.shutdown()
+            finally:
+                self.__file.close()
+                self.__file = None
+
+
+    def tell(self):
+        """Returns the current position in the uncompressed data."""
+
+        return self.__size
+
+
+    def write(self, data):
+        """Writes data to the file."""
+
+        self.__buffer += data
+        self.__size += len(data)
+
+        if len(self.__buffer) >= _COMPRESSION_BLOCK_SIZE:
+            self.__compress_block()
+
+        return len(data)
+
+
+    def __compress_block(self):
+        """Schedules the buffered data for compressing."""
+
+        self.__blocks.append(( self.__size - len(self.__buffer),
+            self.__executor.submit(self.__compress, bytes(self.__buffer)) ))
+        del self.__buffer[:]
+
+        while len(self.__blocks) > self.__max_blocks:
+            self.__write_block()
+
+
+    def __write_block(self):
+        """Waits for the first block to be compressed and writes it."""
+
+        offset, block = self.__blocks.popleft()
+        block = block.result()
+
+        self.__file.write(block)
+        self.frames.append(( offset, self.__compressed_size ))
+        self.__compressed_size += len(block)
+
+
+
+class FramedFile:
+    """
+    A read-only file object for a file written by ParallelCompressor which
+    decompresses only the frames being read.
+    """
+
+    def __init__(self, path, frames, decompress):
+        # Decompressing function
+        self.__decompress = decompress
+
+        # Offsets of the frames in the uncompressed data
+        self.__offsets = [ offset for offset, compressed_offset in frames ]
+
+        # Offsets of the frames in the compressed file
+        self.__compressed_offsets = [ compressed_offset for offset, compressed_offset in frames ]
+
+        # Current position
+        self.__pos = 0
+
+        # The last read frame
+        self.__frame_id = None
+        self.__frame = b""
+
+        # The compressed file
+        self.__file = open(path, "rb")
+
+        try:
+            self.__compressed_offsets.append(self.__file.seek(0, os.SEEK_END))
+        except:
+            self.__file.close()
+            raise
+
+
+    def close(self):
+        """Closes the file."""
+
+        self.__file.close()
+
+
+    def read(self, size = -1):
+        """Reads data from the file."""
+
+        blocks = []
+
+        while size and self.__offsets:
+            frame_id = max(0, bisect.bisect_right(self.__offsets, self.__pos) - 1)
+            frame_pos = self.__pos - self.__offsets[frame_id]
+
+            frame = self.__read_frame(frame_id)
+            data = frame[frame_pos:] if size < 0 else frame[frame_pos:frame_pos + size]
+
+            if not data:
+                if frame_id + 1 >= len(self.__offsets):
+                    break
+
+                # Skip to the next frame
+                self.__pos = max(self.__pos, self.__offsets[frame_id + 1])
+                continue
+
+            blocks.append(data)
+            self.__pos += len(data)
+
+            if size > 0:
+                size -= len(data)
+
+        return b"".join(blocks)
+
+
+    def seek(self, offset, whence = os.SEEK_SET):
+        """Changes the current position."""
+
+        if whence == os.SEEK_CUR:
+            offset += self.__pos
+        elif whence != os.SEEK_SET:
+            raise Error("Unsupported seek mode.")
+
+        self.__pos = offset
+        return self.__pos
+
+
+    def tell(self):
+        """Returns the current position."""
+
+        return self.__pos
+
+
+    def __read_frame(self, frame_id):
+        """Returns data of the specified frame."""
+
+        if frame_id != self.__frame_id:
+            self.__frame = b""
+            self.__file.seek(self.__compressed_offsets[frame_id])
+
+            self.__frame = self.__decompress(read_file(self.__file,
+                self.__compressed_offsets[frame_id + 1] - self.__compressed_offsets[frame_id]))
+            self.__frame_id = frame_id
+
+        return self.__frame
+
+
+
+class HashSet:
+    """A compact set of SHA-256 hashes.
+
+    Hashes are stored as 32-byte digests in an open-addressing hash table (a
+    single bytearray with linear probing) instead of 64-character hex strings
+    which take several times more memory. Hashes are uniformly distributed, so
+    their bytes are used as the hash table and Bloom filter hash functions.
+
+    The set accepts and returns hex hashes like a set of strings, so it can be
+    used instead of it. An optional Bloom filter in front of the table speeds
+    up lookups of missing hashes.
+    """
+
+    def __init__(self, hashes = (), bloom_filter = False, expected_size = 0):
+        # Number of hashes in the set
+        self.__size = 0
+
+        # Number of the hash table slots (a power of 2)
+        self.__capacity = _HASH_SET_MIN_CAPACITY
+        while expected_size > self.__capacity * _HASH_SET_MAX_LOAD:
+            self.__capacity *= 2
+
+        # Hash table
+        self.__table = bytearray(self.__capacity * _HASH_SIZE)
+
+        # Whether the set contains the hash which is used as an empty slot
+        # marker
+        self.__has_empty_hash = False
+
+        # Bloom filter (or None if it's disabled)
+        self.__bloom_filter = bytearray(self.__capacity * _BLOOM_FILTER_BITS // 8) if bloom_filter else None
+
+        self.update(hashes)
+
+
+    def __contains__(self, hash):
+        try:
+            digest = bytes.fromhex(hash)
+        except (TypeError, ValueError):
+            return False
+
+        return len(digest) == _HASH_SIZE and self.contains_digest(digest)
+
+
+    def __eq__(self, other):
+        if isinstance(other, HashSet):
+            return len(self) == len(other) and all(other.contains_digest(digest) for digest in self.digests())
+
+        if isinstance(other, ( set, frozenset )):
+            return len(self) == len(other) and all(hash in self for hash in other)
+
+        return NotImplemented
+
+
+    def __iter__(self):
+        for digest in self.digests():
+            yield digest.hex()
+
+
+    def __len__(self):
+        return self.__size
+
+
+    def add(self, hash):
+        """Adds a hex hash to the set."""
+
+        digest = bytes.fromhex(hash)
+
+        if len(digest) != _HASH_SIZE:
+            raise Error("Invalid hash: {}.", hash)
+
+        self.add_digest(digest)
+
+
+    def add_digest(self, digest):
+        """Adds a binary hash to the set."""
+
+        if digest == _EMPTY_HASH:
+            if not self.__has_empty_hash:
+                self.__has_empty_hash = True
+                self.__size += 1
+
+            return
+
+        offset, found = self.__find(digest)
+        if found:
+            return
+
+        self.__table[offset:offset + _HASH_SIZE] = digest
+        self.__size += 1
+
+        if self.__bloom_filter is not None:
+            self.__add_to_bloom_filter(digest)
+
+        if self.__size > self.__capacity * _HASH_SET_MAX_LOAD:
+            self.__resize(self.__capacity * 2)
+
+
+    def contains_digest(self, digest):
+        """Checks whether the set contains the specified binary hash."""
+
+        if digest == _EMPTY_HASH:
+            return self.__has_empty_hash
+
+        if self.__bloom_filter is not None:
+            bloom_filter = self.__bloom_filter
+
+            for bit in self.__get_bloom_filter_bits(digest):
+                if not bloom_filter[bit >> 3] & ( 1 << ( bit & 7 )):
+                    return False
+
+        return self.__find(digest)[1]
+
+
+    def digests(self):
+        """Iterates over binary hashes of the set."""
+
+        if self.__has_empty_hash:
+            yield _EMPTY_HASH
+
+        table = self.__table
+
+        for offset in range(0, len(table), _HASH_SIZE):
+            digest = bytes(table[offset:offset + _HASH_SIZE])
+            if digest != _EMPTY_HASH:
+                yield digest
+
+
+    def memory_usage(self):
+        """Returns the number of bytes used by the set."""
+
+        return sys.getsizeof(self.__table) + (
+            0 if self.__bloom_filter is None else sys.getsizeof(self.__bloom_filter))
+
+
+    def update(self, hashes):
+        """Adds the specified hex hashes to the set."""
+
+        for hash in hashes:
+            self.add(hash)
+
+
+    def __add_to_bloom_filter(self, digest):
+        """Adds the specified hash to the Bloom filter."""
+
+        bloom_filter = self.__bloom_filter
+
+        for bit in self.__get_bloom_filter_bits(digest):
+            bloom_filter[bit >> 3] |= 1 << ( bit & 7 )
+
+
+    def __get_bloom_filter_bits(self, digest):
+        """
+        Returns Bloom filter bits of the specified hash (its bytes which
+        aren't used by the hash table are used as the hash functions).
+        """
+
+        mask = len(self.__bloom_filter) * 8 - 1
+        value = int.from_bytes(digest[8:8 + _BLOOM_FILTER_HASHES * 4], "big")
+
+        return [ ( value >> ( hash_id * 32 )) & mask for hash_id in range(_BLOOM_FILTER_HASHES) ]
+
+
+    def __find(self, digest):
+        """
+        Looks up the specified hash in the table.
+
+        Returns an ( offset, found ) tuple where offset is the offset of the
+        hash's slot or of the empty slot where it has to be stored.
+        """
+
+        table = self.__table
+        mask = self.__capacity - 1
+        index = int.from_bytes(digest[:8], "big") & mask
+
+        while True:
+            offset = index * _HASH_SIZE
+
+            if table.startswith(digest, offset):
+                return offset, True
+
+            if table.startswith(_EMPTY_HASH, offset):
+                return offset, False
+
+            index = ( index + 1 ) & mask
+
+
+    def __resize(self, capacity):
+        """Rebuilds the table with the specified capacity."""
+
+        old_table = self.__table
+
+        self.__capacity = capacity
+        self.__table = bytearray(capacity * _HASH_SIZE)
+
+        if self.__bloom_filter is not None:
+            self.__bloom_filter = bytearray(capacity * _BLOOM_FILTER_BITS // 8)
+
+        for old_offset in range(0, len(old_table), _HASH_SIZE):
+            digest = bytes(old_table[old_offset:old_offset + _HASH_SIZE])
+            if digest == _EMPTY_HASH:
+                continue
+
+            offset = self.__find(digest)[0]
+            self.__table[offset:offset + _HASH_SIZE] = digest
+
+            if self.__bloom_filter is not None:
+                self.__add_to_bloom_filter(digest)
+
+
+
+class HashableFile():
+    """A wrapper for a file object that hashes all read data."""
+
+    def __init__(self, file):
+        self.__file = file
+        self.__hash = sha256()
+
+
+    def hexdigest(self):
+        """Returns read data hash."""
+
+        return self.__hash.hexdigest()
+
+
+    def read(self, *args, **kwargs):
+        """Reads data from the file and hashes the returning value."""
+
+        data = self.__file.read(*args, **kwargs)
+        self.__hash.update(data)
+        return data
+
+
+    def reset(self):
+        """Resets the file position."""
+
+        self.__file.seek(0)
+        self.__hash = sha256()
+
+
+
+class SparseFile():
+    """
+    A wrapper for a sparse file that reads it in GNU sparse format 1.0 (a
+    sparse map followed by the file's data regions) and hashes the file's
+    logical contents (with holes filled with zeros).
+    """
+
+    def __init__(self, file, size, sparse_map):
+        self.__file = file
+        self.__real_size = size
+        self.__sparse_map = sparse_map
+
+        sparse_map = "".join(
+            "{}\n".format(number) for region in [ ( len(sparse_map), ) ] + sparse_map
+                for number in region).encode()
+        self.__header = sparse_map + bytes(-len(sparse_map) % tarfile.BLOCKSIZE)
+
+        # Size of the data in sparse format
+        self.size = len(self.__header) + sum(size for offset, size in self.__sparse_map)
+
+        self.reset()
+
+
+    def hexdigest(self):
+        """Returns read data hash."""
+
+        return self.__hash.hexdigest()
+
+
+    def read(self, size = -1):
+        """Reads data in sparse format."""
+
+        if size < 0:
+            size = self.size - self.__pos
+
+        chunks = []
+
+        while size > 0 and self.__pos < self.size:
+            if self.__pos < len(self.__header):
+                data = self.__header[self.__pos:self.__pos + size]
+            else:
+                if self.__region_left == 0:
+                    offset, self.__region_left = self.__sparse_map[self.__region]
+                    self.__region += 1
+
+                    _hash_zeros(self.__hash, offset - self.__file_pos)
+                    self.__file.seek(offset)
+                    self.__file_pos = offset
+
+                data = self.__file.read(min(size, self.__region_left))
+                if not data:
+                    break
+
+                self.__hash.update(data)
+                self.__region_left -= len(data)
+                self.__file_pos += len(data)
+
+            chunks.append(data)
+            self.__pos += len(data)
+            size -= len(data)
+
+        if self.__pos == self.size and self.__file_pos < self.__real_size:
+            _hash_zeros(self.__hash, self.__real_size - self.__file_pos)
+            self.__file_pos = self.__real_size
+
+        return b"".join(chunks)
+
+
+    def reset(self):
+        """Resets the file position."""
+
+        self.__file.seek(0)
+        self.__hash = sha256()
+
+        # Position in the data in sparse format
+        self.__pos = 0
+
+        # Position in the file
+        self.__file_pos = 0
+
+        # Current data region
+        self.__region = 0
+        self.__region_left = 0
+
+
+
+class BlockHashingFile():
+    """A wrapper for a file object that hashes each block of read data."""
+
+    def __init__(self, file, block_size):
+        self.__file = file
+        self.__block_size = block_size
+        self.__hashes = []
+        self.__block = bytearray()
+
+
+    def block_hashes(self):
+        """Returns hashes of the read data blocks."""
+
+        if self.__block:
+            self.__hashes.append(get_block_hash(self.__block))
+            del self.__block[:]
+
+        return self.__hashes
+
+
+    def read(self, *args, **kwargs):
+        """Reads data from the file and hashes the returning value."""
+
+        data = self.__file.read(*args, **kwargs)
+        offset = 0
+
+        while offset < len(data):
+            size = min(self.__block_size - len(self.__block), len(data) - offset)
+            self.__block += data[offset:offset + size]
+            offset += size
+
+            if len(self.__block) == self.__block_size:
+                self.__hashes.append(get_block_hash(self.__block))
+                del self.__block[:]
+
+        return data
+
+
+
+class MemoryLimit:
+    """
+    A memory limit shared by SpillableDict and SpillableList objects: when
+    their total memory usage exceeds it, the biggest of them are spilled to
+    disk.
+    """
+
+    def __init__(self, limit, directory = None):
+        # Memory limit (0 means no limit)
+        self.__limit = limit
+
+        # Approximate memory usage of all in-memory dicts
+        self.__usage = 0
+
+        # All dicts and lists that share the limit
+        self.__dicts = []
+
+        # Directory for spilled dicts' databases (the default temporary
+        # directory if None)
+        self.directory = directory
+
+
+    def close(self):
+        """Closes all the dicts releasing their data."""
+
+        for spillable_dict in self.__dicts:
+            spillable_dict.close()
+
+        del self.__dicts[:]
+        self.__usage = 0
+
+
+    def _account(self, spillable_dict, delta):
+        """Accounts a change of memory usage of the specified dict."""
+
+        self.__usage += delta
+
+        if spillable_dict not in self.__dicts:
+            self.__dicts.append(spillable_dict)
+
+        while self.__limit and self.__usage > self.__limit:
+            biggest_dict = max(self.__dicts, key = lambda spillable_dict: spillable_dict.memory_usage())
+            usage = biggest_dict.memory_usage()
+
+            if not usage:
+                break
+
+            biggest_dict.spill(self.directory)
+            self.__usage -= usage
+
+
+
+class SpillableDict:
+    """
+    A dict which moves its items to an SQLite database in a temporary file when
+    memory usage of all dicts sharing its memory limit exceeds it. A spilled
+    dict keeps an LRU cache of recently used items in memory.
+
+    Keys and values must be marshallable and keys must have a stable repr().
+    Only the methods that are used by PyVSB are implemented. Lookups may be
+    done from any thread.
+    """
+
+    def __init__(self, memory_limit = None):
+        # Memory limit the dict shares with other dicts
+        self.__memory_limit = memory_limit
+
+        # Items or an LRU cache of items if the dict is spilled
+        self.__items = {}
+
+        # Approximate memory usage of the in-memory items
+        self.__memory_usage = 0
+
+        # Database the items are spilled to
+        self.__db = None
+
+        # Number of items in the spilled dict
+        self.__size = 0
+
+        self.__lock = threading.RLock()
+
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+
+        if value is _MISSING:
+            raise KeyError(key)
+
+        return value
+
+
+    def __iter__(self):
+        for key, value in self.items():
+            yield key
+
+
+    def __len__(self):
+        return len(self.__items) if self.__db is None else self.__size
+
+
+    def __setitem__(self, key, value):
+        self.__set(key, value)
+
+
+    def clear(self):
+        """Removes all items."""
+
+        with self.__lock:
+            delta = -self.__memory_usage
+            self.__memory_usage = 0
+
+            if self.__db is None:
+                self.__items.clear()
+            else:
+                self.__db.execute("DELETE FROM items")
+                self.__items.clear()
+                self.__size = 0
+
+        if delta and self.__memory_limit is not None:
+            self.__memory_limit._account(self, delta)
+
+
+    def close(self):
+        """Closes the dict releasing its data."""
+
+        with self.__lock:
+            self.__items = {}
+            self.__memory_usage = 0
+            self.__size = 0
+
+            if self.__db is not None:
+                self.__db.close()
+                self.__db = None
+
+
+    def get(self, key, default = None):
+        """Returns value of the specified key."""
+
+        with self.__lock:
+            if self.__db is None:
+                return self.__items.get(key, default)
+
+            value = self.__items.get(key, _MISSING)
+
+            if value is _MISSING:
+                row = self.__db.execute("SELECT item FROM items WHERE key = ?", ( repr(key), )).fetchone()
+                if row is None:
+                    return default
+
+                key, value = marshal.loads(row[0])
+                self.__cache(key, value)
+            else:
+                self.__items.move_to_end(key)
+
+            return value
+
+
+    def items(self):
+        """Iterates over the items.
+
+        The dict may be modified during iteration, but it's not guaranteed
+        whether the new items will be returned.
+        """
+
+        with self.__lock:
+            if self.__db is None:
+                keys = list(self.__items)
+                rows = None
+            else:
+                rows = self.__db.execute("SELECT item FROM items")
+
+        if rows is None:
+            for key in keys:
+                value = self.get(key, _MISSING)
+                if value is not _MISSING:
+                    yield key, value
+        else:
+            while True:
+                with self.__lock:
+                    batch = rows.fetchmany(_SPILL_BATCH_SIZE)
+
+                if not batch:
+                    break
+
+                for row in batch:
+                    yield marshal.loads(row[0])
+
+
+    def memory_usage(self):
+        """Returns approximate memory usage of the in-memory items."""
+
+        return self.__memory_usage
+
+
+    def setdefault(self, key, value):
+        """Returns value of the specified key setting it if it's missing."""
+
+        return self.__set(key, value, replace = False)
+
+
+    def spill(self, directory = None):
+        """Moves the items to disk."""
+
+        with self.__lock:
+            if self.__db is not None:
+                return
+
+            LOG.debug("Spilling %s items to disk...", len(self.__items))
+
+            fd, path = tempfile.mkstemp(prefix = ".spill-", dir = directory)
+
+            try:
+                os.close(fd)
+
+                db = sqlite3.connect(path, check_same_thread = False)
+
+                try:
+                    db.execute("PRAGMA journal_mode = OFF")
+                    db.execute("PRAGMA synchronous = OFF")
+                    db.execute("CREATE TABLE items (key TEXT PRIMARY KEY, item BLOB)")
+                    db.executemany("INSERT INTO items VALUES (?, ?)", (
+                        ( repr(key), marshal.dumps(( key, value )) ) for key, value in self.__items.items() ))
+                except:
+                    db.close()
+                    raise
+            finally:
+                # The database is opened, so it's deleted when it's closed
+                os.unlink(path)
+
+            self.__db = db
+            self.__size = len(self.__items)
+            self.__items = collections.OrderedDict()
+            self.__memory_usage = 0
+
+
+    def values(self):
+        """Iterates over the values."""
+
+        for key, value in self.items():
+            yield value
+
+
+    def __cache(self, key, value):
+        """Adds the specified item to the LRU cache."""
+
+        self.__items[key] = value
+        self.__items.move_to_end(key)
+
+        if len(self.__items) > _SPILL_CACHE_SIZE:
+            self.__items.popitem(last = False)
+
+
+    def __set(self, key, value, replace = True):
+        """Sets the specified item.
+
+        If replace is False, doesn't change the existing value.
+
+        Returns the item's value.
+        """
+
+        delta = 0
+
+        with self.__lock:
+            if self.__db is None:
+                old_value = self.__items.get(key, _MISSING)
+
+                if old_value is _MISSING:
+                    delta = _get_object_size(key) + _get_object_size(value) + _DICT_ITEM_OVERHEAD
+                elif replace:
+                    delta = _get_object_size(value) - _get_object_size(old_value)
+                else:
+                    return old_value
+
+                self.__items[key] = value
+                self.__memory_usage += delta
+            else:
+                item = marshal.dumps(( key, value ))
+
+                if self.__db.execute("INSERT OR IGNORE INTO items VALUES (?, ?)", ( repr(key), item )).rowcount:
+                    self.__size += 1
+                elif replace:
+                    self.__db.execute("UPDATE items SET item = ? WHERE key = ?", ( item, repr(key) ))
+                else:
+                    return self.get(key)
+
+                self.__cache(key, value)
+
+        if delta and self.__memory_limit is not None:
+            self.__memory_limit._account(self, delta)
+
+        return value
+
+
+
+class SpillableList:
+    """
+    A list whose items are read in sorted order. When memory usage of all
+    objects sharing its memory limit exceeds it, the in-memory items are
+    sorted and moved to a temporary file, and the sorted runs are merged on
+    reading.
+
+    Items must be marshallable.
+    """
+
+    def __init__(self, memory_limit = None):
+        # Memory limit the list shares with other objects
+        self.__memory_limit = memory_limit
+
+        # In-memory items
+        self.__items = []
+
+        # Approximate memory usage of the in-memory items
+        self.__memory_usage = 0
+
+        # Temporary files with sorted runs of the spilled items
+        self.__runs = []
+
+        # Number of the spilled items
+        self.__spilled = 0
+
+        self.__lock = threading.RLock()
+
+
+    def __len__(self):
+        return len(self.__items) + self.__spilled
+
+
+    def append(self, item):
+        """Adds the specified item."""
+
+        delta = _get_object_size(item) + _LIST_ITEM_OVERHEAD
+
+        with self.__lock:
+            self.__items.append(item)
+            self.__memory_usage += delta
+
+        if self.__memory_limit is not None:
+            self.__memory_limit._account(self, delta)
+
+
+    def close(self):
+        """Closes the list releasing its data."""
+
+        with self.__lock:
+            self.__items = []
+            self.__memory_usage = 0
+            self.__spilled = 0
+
+            runs, self.__runs = self.__runs, []
+
+            for run in runs:
+                run.close()
+
+
+    def memory_usage(self):
+        """Returns approximate memory usage of the in-memory items."""
+
+        return self.__memory_usage
+
+
+    def sorted(self):
+        """Iterates over the items in sorted order.
+
+        The list mustn't be modified during iteration.
+        """
+
+        with self.__lock:
+            self.__items.sort()
+
+            if not self.__runs:
+                return iter(self.__items)
+
+            return heapq.merge(self.__items, *( _read_run(run) for run in self.__runs ))
+
+
+    def spill(self, directory = None):
+        """Moves the in-memory items to disk."""
+
+        with self.__lock:
+            if not self.__items:
+                return
+
+            LOG.debug("Spilling %s items to disk...", len(self.__items))
+
+            # The file is deleted when it's closed
+            run = tempfile.TemporaryFile(prefix = ".spill-", dir = directory)
+
+            try:
+                self.__items.sort()
+
+                for item in self.__items:
+                    marshal.dump(item, run)
+
+                run.flush()
+            except:
+                run.close()
+                raise
+
+            self.__runs.append(run)
+            self.__spilled += len(self.__items)
+            self.__items = []
+            self.__memory_usage = 0
+
+
+
+def get_block_hash(data):
+    """Returns a hash of a file's data block."""
+
+    return sha256(data).hexdigest()[:32]
+
+
+def get_sparse_map(file_obj, size):
+    """
+    Returns a list of ( offset, size ) tuples of the file's data regions or
+    None if the file has no holes.
+    """
+
+    try:
+        fd = file_obj.fileno()
+        stat_info = os.fstat(fd)
+    except Exception:
+        return None
+
+    # The file has no holes if all its blocks are allocated
+    if stat_info.st_blocks * 512 >= size or not hasattr(os, "SEEK_DATA"):
+        return None
+
+    sparse_map = []
+    offset = 0
+
+    try:
+        while offset < size:
+            try:
+                offset = os.lseek(fd, offset, os.SEEK_DATA)
+            except EnvironmentError as e:
+                if e.errno == errno.ENXIO:
+                    break
+                else:
+                    raise
+
+            if offset >= size:
+                break
+
+            end = min(os.lseek(fd, offset, os.SEEK_HOLE), size)
+            sparse_map.append(( offset, end - offset ))
+            offset = end
+    except EnvironmentError as e:
+        # The filesystem doesn't support SEEK_DATA/SEEK_HOLE
+        if e.errno == errno.EINVAL:
+            return None
+        else:
+            raise
+    finally:
+        os.lseek(fd, 0, os.SEEK_SET)
+
+    if sparse_map == [ ( 0, size ) ]:
+        return None
+
+    # A trailing hole is described by an empty region at the end of the file
+    # (GNU tar doesn't extend the file to its real size otherwise)
+    if not sparse_map or sum(sparse_map[-1]) != size:
+        sparse_map.append(( size, 0 ))
+
+    return sparse_map
+
+
+def read_file(file_obj, size, discard = False):
+    """Reads exactly size bytes from the file.
+
+    If discard is True, the data is not returned (the file is just read through
+    which is useful for file objects that process the data while reading it).
+    """
+
+    if not discard:
+        data = file_obj.read(size)
+        if len(data) != size:
+            raise Error("The file has been truncated during the backup.")
+
+        return data
+
+    read_size = 0
+
+    while read_size < size:
+        data = file_obj.read(min(_READ_SIZE, size - read_size))
+        if not data:
+            raise Error("The file has been truncated during the backup.")
+
+        read_size += len(data)
+
+
+def spool_file(file_obj, size, directory = None):
+    """
+    Copies exactly size bytes of the file to a temporary file (which is
+    deleted when it's closed) and returns it rewound.
+    """
+
+    spool = tempfile.TemporaryFile(prefix = ".spool-", dir = directory)
+
+    try:
+        read_size = 0
+
+        while read_size < size:
+            data = file_obj.read(min(_READ_SIZE, size - read_size))
+            if not data:
+                raise Error("The file has been truncated during the backup.")
+
+            spool.write(data)
+            read_size += len(data)
+
+        spool.seek(0)
+    except:
+        spool.close()
+        raise
+
+    return spool
+
+
+def getgrgid(gid):
+    """Cached grp.getgrgid()."""
+
+    return _get_gr_entries()[2][gid]
+
+
+def getgrnam(name):
+    """Cached grp.getgrnam()."""
+
+    return _get_gr_entries()[0][name]
+
+
+def getpwuid(uid):
+    """Cached pwd.getpwuid()."""
+
+    return _get_pwd_entries()[2][uid]
+
+
+def getpwnam(name):
+    """Cached pwd.getpwnam()."""
+
+    return _get_pwd_entries()[0][name]
+
+
+def _hash_zeros(hash, size):
+    """Hashes the specified number of zero bytes."""
+
+    while size > 0:
+        hash.update(_ZEROS if size >= len(_ZEROS) else _ZEROS[:size])
+        size -= len(_ZEROS)
+
+
+def _get_object_size(obj):
+    """Returns approximate memory usage of the specified object."""
+
+    size = sys.getsizeof(obj)
+
+    if type(obj) is tuple:
+        size += sum(sys.getsizeof(item) for item in obj)
+
+    return size
+
+
+def _read_run(run):
+    """Iterates over items of a sorted run of a spilled SpillableList."""
+
+    run.seek(0)
+
+    while True:
+        try:
+            yield marshal.load(run)
+        except EOFError:
+            break
+
+
+def _get_db_entries(name, func):
+    """Returns cached DB entries.
+
+    grp and pwd modules reread /etc/group and /etc/passwd files on each method
+    call.
+    """
+
+    cache = _DB_ENTRIES_CACHE.get(name)
+
+    if cache is None:
+        id_cache = {}
+        name_cache = {}
+
+        cache = {
+            2: id_cache,
+            0: name_cache,
+        }
+
+        for entry in func():
+            id_cache[entry[2]] = name_cache[entry[0]] = entry
+
+        _DB_ENTRIES_CACHE[name] = cache
+
+    return cache
+
+
+def _get_gr_entries():
+    """Returns cached grp database entries."""
+
+    return _get_db_entries("grp", grp.getgrall)
+
+
+def _get_pwd_entries():
+    """Returns cached pwd database entries."""
+
+    return _get_db_entries("pwd", pwd.getpwall)
+
+
+def _get_virtual_tar_info(tar_info, volume_id):
+    """Converts a volume member's offsets to the multi-volume archive ones."""
+
+    if volume_id:
+        tar_info = copy.copy(tar_info)
+        tar_info.offset += volume_id * _VOLUME_OFFSET
+        tar_info.offset_data += volume_id * _VOLUME_OFFSET
+
+    return tar_info
+
+
+def _get_volume_tar_info(tar_info):
+    """
+    Converts a multi-volume archive member's offsets to the volume ones.
+
+    Returns a ( volume_id, tar_info ) tuple.
+    """
+
+    volume_id = tar_info.offset // _VOLUME_OFFSET
+
+    if volume_id:
+        tar_info = copy.copy(tar_info)
+        tar_info.offset -= volume_id * _VOLUME_OFFSET
+        tar_info.offset_data -= volume_id * _VOLUME_OFFSET
+
+    return volume_id, tar_info
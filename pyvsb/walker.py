@@ -0,0 +1,188 @@
+"""Parallel directory walking."""
+
+import logging
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
+LOG = logging.getLogger(__name__)
+
+
+class Walker:
+    """Lists directories in a pool of worker threads.
+
+    The walker doesn't decide in which order the directories are traversed:
+    its consumer requests directory listings in the order it needs them, and
+    the walker lists (and stats entries of) a few next directories of the
+    currently processed one in advance in its worker threads.
+
+    Directory entries are always returned sorted by their names, so the
+    resulting stream of entries is deterministic regardless of the number of
+    worker threads.
+    """
+
+    def __init__(self, threads, lookahead = None):
+        # Worker threads
+        self.__executor = None
+
+        # How many not yet processed directories are listed in advance in
+        # each directory which is being traversed
+        self.lookahead = threads * 2 if lookahead is None else lookahead
+
+        # Directory listings that are scheduled to be obtained by the worker
+        # threads
+        self.__scheduled = {}
+
+        if threads > 1:
+            self.__executor = ThreadPoolExecutor(max_workers = threads)
+
+
+    def close(self):
+        """Closes the object."""
+
+        if self.__executor is not None:
+            for future in self.__scheduled.values():
+                future.cancel()
+
+            self.__scheduled.clear()
+
+            self.__executor.shutdown()
+            self.__executor = None
+
+
+    def scandir(self, path):
+        """
+        Returns a list of the specified directory's entries (os.DirEntry
+        objects) sorted by their names.
+        """
+
+        future = self.__scheduled.pop(path, None)
+        if future is None:
+            return _scandir(path)
+        else:
+            return future.result()
+
+
+    def accepts(self, entry):
+        """Checks whether the walker prefetches the specified entry."""
+
+        return self.__executor is not None and entry.is_dir(follow_symlinks = False)
+
+
+    def forget(self, path):
+        """Forgets the directory listing scheduled for the specified path."""
+
+        future = self.__scheduled.pop(path, None)
+        if future is not None:
+            future.cancel()
+
+
+    def schedule(self, path):
+        """Schedules listing of the specified directory."""
+
+        if path not in self.__scheduled:
+            self.__scheduled[path] = self.__executor.submit(_scandir, path)
+
+        return True
+
+
+
+def iterate(entries, *prefetchers, skip = None):
+    """
+    Iterates over the specified ( path, os.DirEntry ) list scheduling
+    prefetching of the entries that are going to be processed soon.
+
+    skip(path) checks whether the entry's data won't be needed, so it doesn't
+    have to be prefetched.
+
+    A prefetcher is an object with the following interface:
+    * lookahead - how many accepted entries to prefetch ahead of the current
+      one;
+    * accepts(entry) - checks whether the entry has to be prefetched;
+    * schedule(path) - schedules prefetching (returns False if the prefetcher
+      can't accept it right now);
+    * forget(path) - forgets the prefetched data if it hasn't been consumed.
+    """
+
+    lookaheads = [
+        _Lookahead(prefetcher, [
+            path for path, entry in entries
+                if prefetcher.accepts(entry) and ( skip is None or not skip(path) ) ])
+        for prefetcher in prefetchers ]
+
+    lookaheads = [ lookahead for lookahead in lookaheads if lookahead.paths ]
+
+    for path, entry in entries:
+        for lookahead in lookaheads:
+            lookahead.schedule(path)
+
+        try:
+            yield path, entry
+        finally:
+            # The consumer may not use the prefetched data (for example, due
+            # to an error)
+            for lookahead in lookaheads:
+                lookahead.prefetcher.forget(path)
+
+
+
+class _Lookahead:
+    """Schedules prefetching of entries for a prefetcher."""
+
+    def __init__(self, prefetcher, paths):
+        # The prefetcher
+        self.prefetcher = prefetcher
+
+        # Paths that are accepted by the prefetcher
+        self.paths = paths
+
+        # Number of paths that has been already processed
+        self.__passed = 0
+
+        # Number of paths that has been scheduled for prefetching
+        self.__scheduled = 0
+
+
+    def schedule(self, path):
+        """Schedules prefetching of the paths that are going to be processed soon."""
+
+        paths = self.paths
+
+        while self.__scheduled < min(len(paths), self.__passed + self.prefetcher.lookahead):
+            if not self.prefetcher.schedule(paths[self.__scheduled]):
+                break
+
+            self.__scheduled += 1
+
+        if self.__passed < len(paths) and paths[self.__passed] == path:
+            self.__passed += 1
+
+            # The path may be skipped by the prefetcher
+            self.__scheduled = max(self.__scheduled, self.__passed)
+
+
+
+def _scandir(path):
+    """Lists the specified directory.
+
+    Entries that are not regular files are lstat()'ed here, so the caller gets
+    their cached stat() info. Regular files are identified by d_type and are
+    not stat()'ed at all: their stat() info is obtained by fstat() after
+    opening.
+    """
+
+    with os.scandir(path) as iterator:
+        entries = list(iterator)
+
+    for entry in entries:
+        try:
+            if not entry.is_file(follow_symlinks = False):
+                entry.stat(follow_symlinks = False)
+        except EnvironmentError:
+            # The caller will get the error by itself
+            pass
+
+    entries.sort(key = lambda entry: entry.name)
+
+    return entries
+
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+"""Benchmarks of performance-critical parts of PyVSB.
+
+Usage: PYTHONPATH=. python3 tests/benchmark.py [BENCHMARK...]
+"""
+
+import hashlib
+import random
+import re
+import sys
+import time
+import tracemalloc
+
+from pyvsb.filters import Filter, PathMatcher
+from pyvsb.utils import HashSet
+
+
+def benchmark_filters(path_count = 1000000, rule_count = 300):
+    """Compares the compiled filter engine with trying filters one by one."""
+
+    rand = random.Random(0)
+
+    def name():
+        return "".join(rand.choice("abcdefghijklmnopqrstuvwxyz._-") for i in range(rand.randint(3, 10)))
+
+    directories = [ name() for i in range(200) ]
+
+    filters = []
+
+    for rule_id in range(rule_count):
+        allow = rand.random() < 0.1
+
+        if rule_id % 10:
+            pattern = "^" + re.escape(rand.choice(directories) + "/" + name()) + ( "$" if rule_id % 2 else "" )
+        else:
+            pattern = re.escape("." + name()) + "$"
+
+        filters.append(( allow, re.compile(pattern) ))
+
+    paths = [
+        "/".join(rand.choice(directories) if level < 2 else name() for level in range(rand.randint(1, 6)))
+        for i in range(path_count) ]
+
+    def loop():
+        results = []
+
+        for path in paths:
+            for allow, regex in filters:
+                if regex.search(path):
+                    results.append(allow)
+                    break
+            else:
+                results.append(None)
+
+        return results
+
+    def engine():
+        compiled = Filter(filters)
+        return [ compiled.match(path) for path in paths ]
+
+    _report("filters ({} paths, {} rules)".format(path_count, rule_count), [
+        ( "one by one", loop ),
+        ( "compiled",   engine ),
+    ])
+
+
+def benchmark_hash_sets(hash_count = 1000000, lookup_count = 1000000):
+    """Compares memory usage and lookup rate of hash containers."""
+
+    hashes = [ hashlib.sha256(str(hash_id).encode()).digest() for hash_id in range(hash_count) ]
+
+    # Half of the looked up hashes are missing
+    lookups = [
+        hashes[lookup_id // 2].hex() if lookup_id % 2 else hashlib.sha256(b"missing" + str(lookup_id).encode()).hexdigest()
+        for lookup_id in range(lookup_count) ]
+
+    print("hash set memory usage ({} hashes):".format(hash_count))
+
+    containers = []
+
+    for variant, build in (
+        ( "set",               lambda: set(digest.hex() for digest in hashes) ),
+        ( "HashSet",           lambda: HashSet(digest.hex() for digest in hashes) ),
+        ( "HashSet + Bloom",   lambda: HashSet((digest.hex() for digest in hashes), bloom_filter = True) ),
+    ):
+        tracemalloc.start()
+
+        try:
+            container = build()
+            memory_usage = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+
+        print("  {:<15} {:8.1f} MiB ({:.0f} bytes per hash)".format(
+            variant, memory_usage / 1024 / 1024, memory_usage / hash_count))
+
+        containers.append(( variant, container ))
+
+    _report("hash set lookups ({} hashes, {} lookups)".format(hash_count, lookup_count), [
+        ( variant, lambda container = container: [ file_hash in container for file_hash in lookups ] )
+        for variant, container in containers
+    ], operations = lookup_count)
+
+
+def benchmark_restore_paths(path_count = 100000, restore_path_count = 2000):
+    """Compares path matching methods of selective restore."""
+
+    rand = random.Random(0)
+
+    def name():
+        return "".join(rand.choice("abcdefghijklmnopqrstuvwxyz._-") for i in range(rand.randint(3, 10)))
+
+    directories = [ "/" + name() + "/" + name() for i in range(5000) ]
+
+    paths = [
+        rand.choice(directories) + "".join("/" + name() for level in range(rand.randint(1, 4)))
+        for i in range(path_count) ]
+
+    paths_to_restore = rand.sample(directories, restore_path_count // 2) + rand.sample(paths, restore_path_count // 2)
+
+    def loop():
+        return set(
+            path for path in paths
+                if any(path == other or path.startswith(other + "/") for other in paths_to_restore))
+
+    matcher = PathMatcher(paths_to_restore)
+
+    def match():
+        return set(path for path in paths if matcher.match(path))
+
+    def select():
+        return matcher.select(sorted(paths))
+
+    _report("restore paths ({} paths, {} paths to restore)".format(path_count, restore_path_count), [
+        ( "one by one", loop ),
+        ( "trie",       match ),
+        ( "index",      select ),
+    ])
+
+
+def _report(name, variants, operations = None):
+    """Runs the benchmark variants and reports their results.
+
+    If operations is specified, also reports the number of operations per
+    second.
+    """
+
+    print("{}:".format(name))
+
+    results = None
+
+    for variant, func in variants:
+        start_time = time.time()
+        result = func()
+        duration = time.time() - start_time
+
+        if operations is None:
+            print("  {:<15} {:8.2f}s".format(variant, duration))
+        else:
+            print("  {:<15} {:8.2f}s ({:.0f} ops/s)".format(variant, duration, operations / duration))
+
+        if results is None:
+            results = result
+        elif result != results:
+            raise Exception("{} variant returned a different result.".format(variant))
+
+
+_BENCHMARKS = {
+    name[len("benchmark_"):]: func
+    for name, func in list(globals().items())
+        if name.startswith("benchmark_")
+}
+"""Available benchmarks."""
+
+
+def main():
+    names = sys.argv[1:] or sorted(_BENCHMARKS)
+
+    for name in names:
+        if name not in _BENCHMARKS:
+            sys.exit("Unknown benchmark: {}. Available benchmarks: {}.".format(
+                name, ", ".join(sorted(_BENCHMARKS))))
+
+    for name in names:
+        _BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    main()
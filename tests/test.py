@@ -3,20 +3,33 @@
 #from pyvsb.main import setup_logging
 #setup_logging(debug_mode = True)
 
+import bz2
+import fnmatch
 import hashlib
+import logging
+import multiprocessing
 import os
 import re
 import shutil
 import socket
 import stat
+import subprocess
+import tarfile
 import tempfile
 import time
 
 import pytest
 
+import pyvsb.backup
+import pyvsb.index
+import pyvsb.metadata
 import pyvsb.storage
+import pyvsb.utils
 from pyvsb.backup import Restore
 from pyvsb.backuper import Backuper
+from pyvsb.core import Error
+from pyvsb.filters import Filter, PathMatcher
+from pyvsb.journal import Watcher
 
 # Tweak backup group name to be able to create a few backup groups in one
 # minute.
@@ -43,24 +56,51 @@ def env(request):
     os.mkdir(env["backup_path"])
 
     env["config"] = {
-        "backup_root":         env["backup_path"],
-        "max_backups":         1,
-        "max_backup_groups":   1000,
-        "preserve_hard_links": True,
-        "trust_modify_time":   True,
-        "compression":         "none",
-        "backup_items":        { env["data_path"]: {} }
+        "backup_root":               env["backup_path"],
+        "max_backups":               1,
+        "max_backup_groups":         1000,
+        "preserve_hard_links":       True,
+        "trust_modify_time":         True,
+        "compression":               "none",
+        "compression_threads":       1,
+        "compression_level":         0,
+        "max_volume_size":           0,
+        "incompressible_extensions": set(),
+        "detect_incompressible":     False,
+        "walker_threads":            4,
+        "reader_threads":            4,
+        "read_ahead_size":           1024 * 1024,
+        "pipeline_depth":            64,
+        "single_pass_dedup":         True,
+        "spool_size":                32 * 1024 * 1024,
+        "chunking_threshold":        0,
+        "chunk_size":                1024 * 1024,
+        "delta_threshold":           0,
+        "delta_block_size":          64 * 1024,
+        "max_delta_chain":           10,
+        "memory_limit":              0,
+        "backup_items":              { env["data_path"]: {} }
     }
 
     return env
 
 
-def test_simple(env):
+@pytest.mark.parametrize(( "walker_threads", "reader_threads" ), (
+    ( 1, 0 ), ( 4, 4 ),
+))
+def test_simple(env, caplog, walker_threads, reader_threads):
+    caplog.set_level(logging.INFO, logger = "pyvsb")
     source_tree = _hash_tree(env["data_path"])
 
+    env["config"]["walker_threads"] = walker_threads
+    env["config"]["reader_threads"] = reader_threads
+
     with Backuper(env["config"]) as backuper:
         assert backuper.backup()
 
+    assert any(message.startswith("Read pipeline queue depth (average/maximum): read ")
+        for message in caplog.messages) == bool(reader_threads)
+
     with Restore(_get_backups(env)[-1], env["restore_path"]) as restorer:
         assert restorer.restore()
 
@@ -68,6 +108,726 @@ def test_simple(env):
     assert _hash_tree(env["restore_path"] + env["data_path"]) == source_tree
 
 
+@pytest.mark.parametrize(( "single_pass_dedup", "spool_size", "compression" ), (
+    ( False, 0, "none" ), ( True, 1024 * 1024, "none" ),
+    ( True, 0, "none" ), ( True, 0, "gz" ),
+))
+def test_deduplication(env, single_pass_dedup, spool_size, compression):
+    data = os.urandom(100 * 1024)
+
+    for name in ( "original", "copy" ):
+        with open(os.path.join(env["data_path"], name), "wb") as data_file:
+            data_file.write(data)
+
+    source_tree = _hash_tree(env["data_path"])
+
+    env["config"].update({
+        "single_pass_dedup": single_pass_dedup,
+        "spool_size":        spool_size,
+        "compression":       compression,
+        "read_ahead_size":   0,
+    })
+
+    with Backuper(env["config"]) as backuper:
+        assert backuper.backup()
+
+    data_path = os.path.join(_get_backups(env)[-1],
+        "data.tar" + ( "" if compression == "none" else "." + compression ))
+
+    with tarfile.open(data_path) as data_file:
+        sizes = sorted(
+            tar_info.size for tar_info in data_file
+                if os.path.basename(tar_info.name) in ( "original", "copy" ))
+
+    assert sizes == [ 0, len(data) ]
+
+    with Restore(_get_backups(env)[-1], env["restore_path"]) as restorer:
+        assert restorer.restore()
+
+    assert _hash_tree(env["restore_path"] + env["data_path"]) == source_tree
+
+
+@pytest.mark.parametrize("compression", ( "none", "bz2" ))
+def test_single_read(env, monkeypatch, compression):
+    data = b"compressible data " * 64 * 1024
+    sparse_data = b"sparse data " * 1024
+
+    for name in ( "original", "copy", "other" ):
+        with open(os.path.join(env["data_path"], name), "wb") as data_file:
+            data_file.write(data if name != "other" else data[::-1])
+
+    with open(os.path.join(env["data_path"], "sparse"), "wb") as sparse_file:
+        sparse_file.seek(len(data))
+        sparse_file.write(sparse_data)
+
+    source_tree = _hash_tree(env["data_path"])
+
+    env["config"].update({
+        "compression":           compression,
+        "spool_size":            0,
+        "read_ahead_size":       0,
+        "detect_incompressible": False,
+    })
+
+    read_sizes = {}
+    open_file = Backuper._Backuper__open_file
+
+    class CountingFile:
+        def __init__(self, path, file_obj):
+            self.__path = path
+            self.__file = file_obj
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc_val, exc_tb):
+            self.__file.close()
+
+        def __getattr__(self, name):
+            return getattr(self.__file, name)
+
+        def read(self, *args):
+            data = self.__file.read(*args)
+            read_sizes[self.__path] = read_sizes.get(self.__path, 0) + len(data)
+            return data
+
+    def open_file_wrapper(self, path):
+        file_obj, stat_info = open_file(self, path)
+        return CountingFile(path, file_obj), stat_info
+
+    monkeypatch.setattr(Backuper, "_Backuper__open_file", open_file_wrapper)
+
+    with Backuper(env["config"]) as backuper:
+        assert backuper.backup()
+
+    # Each file (only data regions of the sparse one) is read once
+    assert read_sizes.pop(os.path.join(env["data_path"], "sparse")) == len(sparse_data)
+    assert read_sizes[os.path.join(env["data_path"], "copy")] == len(data)
+    assert all(size == os.path.getsize(path) for path, size in read_sizes.items())
+
+    with Restore(_get_backups(env)[-1], env["restore_path"]) as restorer:
+        assert restorer.restore()
+
+    assert _hash_tree(env["restore_path"] + env["data_path"]) == source_tree
+
+
+@pytest.mark.parametrize(( "single_pass_dedup", "compression" ), (
+    ( False, "none" ), ( True, "none" ), ( True, "gz" ),
+))
+def test_sparse_files(env, single_pass_dedup, compression):
+    sparse_path = os.path.join(env["data_path"], "sparse")
+    size = 10 * 1024 * 1024
+
+    with open(sparse_path, "wb") as sparse_file:
+        sparse_file.truncate(size)
+        sparse_file.seek(1024 * 1024)
+        sparse_file.write(os.urandom(100 * 1024))
+
+    with open(sparse_path, "rb") as sparse_file:
+        data = sparse_file.read()
+
+    if os.stat(sparse_path).st_blocks * 512 >= size:
+        pytest.skip("The filesystem doesn't support sparse files")
+
+    # A copy of the file without holes must be deduplicated with it
+    with open(os.path.join(env["data_path"], "sparse.copy"), "wb") as copy_file:
+        copy_file.write(data)
+
+    source_tree = _hash_tree(env["data_path"])
+
+    env["config"].update({
+        "single_pass_dedup": single_pass_dedup,
+        "compression":       compression,
+        "read_ahead_size":   0,
+    })
+
+    with Backuper(env["config"]) as backuper:
+        assert backuper.backup()
+
+    data_path = os.path.join(_get_backups(env)[-1],
+        "data.tar" + ( "" if compression == "none" else "." + compression ))
+
+    with tarfile.open(data_path) as data_file:
+        members = {
+            os.path.basename(tar_info.name): tar_info
+            for tar_info in data_file
+                if os.path.basename(tar_info.name).startswith("sparse") }
+
+    assert members["sparse"].sparse is not None
+    assert members["sparse"].size == size
+    assert members["sparse.copy"].size == 0
+
+    with Restore(_get_backups(env)[-1], env["restore_path"]) as restorer:
+        assert restorer.restore()
+
+    assert _hash_tree(env["restore_path"] + env["data_path"]) == source_tree
+
+    restored_path = env["restore_path"] + sparse_path
+    assert os.stat(restored_path).st_blocks * 512 < size
+
+    with open(restored_path, "rb") as restored_file:
+        assert restored_file.read() == data
+
+
+def test_metadata_memory_limit(env, caplog):
+    caplog.set_level(logging.DEBUG, logger = "pyvsb")
+
+    metadata_path = os.path.join(env["test_path"], "metadata.bin")
+    memory_limit = pyvsb.utils.MemoryLimit(10 * 1024, directory = env["test_path"])
+
+    records = [
+        ( hashlib.sha256(str(file_id).encode()).hexdigest(), "unique" if file_id % 3 else "extern",
+          file_id, "1:{}:{}".format(file_id, file_id * 7), "/data/file-{}".format(file_id * 7919 % 1000),
+          file_id * 512 if file_id % 2 else None )
+        for file_id in range(1000) ]
+
+    writer = pyvsb.metadata.Writer(metadata_path, memory_limit)
+
+    try:
+        for record in records:
+            writer.add(*record[:-1], offset = record[-1])
+    finally:
+        writer.close()
+        memory_limit.close()
+
+    assert len([ message for message in caplog.messages if message.startswith("Spilling ") ]) > 1
+    assert not [ name for name in os.listdir(env["test_path"]) if name.startswith(".spill-") ]
+
+    with pyvsb.metadata.Reader(metadata_path) as reader:
+        assert list(reader.records(offsets = True)) == sorted(records, key = lambda record: record[4].encode())
+
+        for record in records:
+            assert reader.find(record[4]) == record[:-1]
+
+
+@pytest.mark.parametrize("compression", ( "none", "gz" ))
+def test_chunking(env, compression):
+    big_path = os.path.join(env["data_path"], "big")
+    data = os.urandom(4 * 1024 * 1024)
+
+    env["config"].update({
+        "max_backups":        10,
+        "compression":        compression,
+        "chunking_threshold": 1024 * 1024,
+        "chunk_size":         64 * 1024,
+    })
+
+    source_trees = []
+    chunk_data_sizes = []
+
+    for revision in range(2):
+        if revision:
+            time.sleep(1)
+            data = data[:len(data) // 2] + b"inserted data" + data[len(data) // 2:]
+
+        with open(big_path, "wb") as big_file:
+            big_file.write(data)
+
+        # Chunked files are deduplicated as a whole too
+        shutil.copy(big_path, big_path + ".copy")
+
+        source_trees.append(_hash_tree(env["data_path"]))
+
+        with Backuper(env["config"]) as backuper:
+            assert backuper.backup()
+
+        chunk_data_path = os.path.join(_get_backups(env)[-1],
+            "chunks.tar" + ( "" if compression == "none" else "." + compression ))
+
+        with tarfile.open(chunk_data_path) as chunk_data:
+            chunk_data_sizes.append(sum(tar_info.size for tar_info in chunk_data))
+
+    assert chunk_data_sizes[0] == len(data) - len(b"inserted data")
+    assert chunk_data_sizes[1] < len(data) / 4
+
+    for backup, source_tree in zip(_get_backups(env), source_trees):
+        with Restore(backup, env["restore_path"]) as restorer:
+            assert restorer.restore()
+
+        assert _hash_tree(env["restore_path"] + env["data_path"]) == source_tree
+        shutil.rmtree(env["restore_path"])
+
+
+def test_moved_files(env, caplog):
+    caplog.set_level(logging.DEBUG, logger = "pyvsb")
+
+    env["config"]["max_backups"] = 10
+
+    old_path = os.path.join(env["data_path"], "old")
+    new_path = os.path.join(env["data_path"], "new")
+
+    os.mkdir(old_path)
+    with open(os.path.join(old_path, "file"), "wb") as moved_file:
+        moved_file.write(os.urandom(1000))
+
+    with Backuper(env["config"]) as backuper:
+        assert backuper.backup()
+
+    time.sleep(1)
+    os.rename(old_path, new_path)
+    source_tree = _hash_tree(env["data_path"])
+    caplog.clear()
+
+    with Backuper(env["config"]) as backuper:
+        assert backuper.backup()
+
+    assert any(message.startswith("File '{}' hasn't been changed.".format(os.path.join(new_path, "file")))
+        for message in caplog.messages)
+
+    with Restore(_get_backups(env)[-1], env["restore_path"]) as restorer:
+        assert restorer.restore()
+
+    assert _hash_tree(env["restore_path"] + env["data_path"]) == source_tree
+
+
+def test_moved_file_with_reused_fingerprint(env):
+    env["config"]["max_backups"] = 10
+
+    old_path = os.path.join(env["data_path"], "old-file")
+    new_path = os.path.join(env["data_path"], "new-file")
+    mtime = int(time.time()) - 60
+
+    with open(old_path, "wb") as data_file:
+        data_file.write(os.urandom(1000))
+
+    os.utime(old_path, ns = ( mtime * 10 ** 9, mtime * 10 ** 9 + 100 ))
+
+    with Backuper(env["config"]) as backuper:
+        assert backuper.backup()
+
+    # The same inode, size and modify time second, but other data
+    time.sleep(1)
+
+    with open(old_path, "r+b") as data_file:
+        data_file.write(os.urandom(1000))
+
+    os.utime(old_path, ns = ( mtime * 10 ** 9, mtime * 10 ** 9 + 200 ))
+    os.rename(old_path, new_path)
+    source_tree = _hash_tree(env["data_path"])
+
+    with Backuper(env["config"]) as backuper:
+        assert backuper.backup()
+
+    with Restore(_get_backups(env)[-1], env["restore_path"]) as restorer:
+        assert restorer.restore()
+
+    assert _hash_tree(env["restore_path"] + env["data_path"]) == source_tree
+
+
+def test_memory_limit(env, caplog):
+    caplog.set_level(logging.DEBUG, logger = "pyvsb")
+
+    env["config"]["max_backups"] = 10
+    env["config"]["memory_limit"] = 10 * 1024
+
+    for file_id in range(100):
+        with open(os.path.join(env["data_path"], "file-{}".format(file_id)), "w") as data_file:
+            data_file.write(str(file_id))
+
+    os.link(os.path.join(env["data_path"], "file-0"), os.path.join(env["data_path"], "hard-link"))
+    source_trees = []
+
+    for backup_id in range(2):
+        if backup_id:
+            time.sleep(1)
+            os.rename(os.path.join(env["data_path"], "file-2"), os.path.join(env["data_path"], "file-moved-2"))
+
+        source_trees.append(_hash_tree(env["data_path"]))
+        caplog.clear()
+
+        with Backuper(env["config"]) as backuper:
+            assert backuper.backup()
+
+        assert any(message.startswith("Spilling ") for message in caplog.messages)
+
+    assert any(message.startswith("File '{}' hasn't been changed.".format(
+        os.path.join(env["data_path"], "file-moved-2"))) for message in caplog.messages)
+
+    for backup, source_tree in zip(_get_backups(env), source_trees):
+        with Restore(backup, env["restore_path"]) as restorer:
+            assert restorer.restore()
+
+        assert _hash_tree(env["restore_path"] + env["data_path"]) == source_tree
+        shutil.rmtree(env["restore_path"])
+
+    assert not [ name for name in os.listdir(_get_backups(env)[-1]) if name.startswith(".spill-") ]
+
+
+def test_temporarily_missing_files(env, caplog):
+    caplog.set_level(logging.DEBUG, logger = "pyvsb")
+
+    env["config"]["max_backups"] = 10
+
+    file_path = os.path.join(env["data_path"], "file")
+    temp_path = os.path.join(env["test_path"], "file")
+
+    with open(file_path, "wb") as data_file:
+        data_file.write(os.urandom(1000))
+
+    for revision in range(3):
+        if revision:
+            time.sleep(1)
+
+        if revision == 1:
+            os.rename(file_path, temp_path)
+        elif revision == 2:
+            os.rename(temp_path, file_path)
+
+        source_tree = _hash_tree(env["data_path"])
+        caplog.clear()
+
+        with Backuper(env["config"]) as backuper:
+            assert backuper.backup()
+
+    assert any(message.startswith("File '{}' hasn't been changed.".format(file_path))
+        for message in caplog.messages)
+
+    with Restore(_get_backups(env)[-1], env["restore_path"]) as restorer:
+        assert restorer.restore()
+
+    assert _hash_tree(env["restore_path"] + env["data_path"]) == source_tree
+
+
+def test_delta_encoding(env):
+    big_path = os.path.join(env["data_path"], "big")
+    block_size = 64 * 1024
+    data = os.urandom(16 * block_size + 100)
+
+    env["config"].update({
+        "max_backups":      10,
+        "delta_threshold":  block_size,
+        "delta_block_size": block_size,
+        "max_delta_chain":  2,
+    })
+
+    source_trees = []
+    data_sizes = []
+
+    for revision in range(4):
+        if revision:
+            time.sleep(1)
+            offset = revision * 3 * block_size + 10
+            data = data[:offset] + b"changed" + data[offset + len(b"changed"):]
+
+        if revision == 2:
+            data = data[:-1000]
+
+        with open(big_path, "wb") as big_file:
+            big_file.write(data)
+
+        source_trees.append(_hash_tree(env["data_path"]))
+
+        with Backuper(env["config"]) as backuper:
+            assert backuper.backup()
+
+        with tarfile.open(os.path.join(_get_backups(env)[-1], "data.tar")) as backup_data:
+            data_sizes.append(backup_data.getmember(big_path.lstrip("/")).size)
+
+    # The last revision exceeds the maximum delta chain length
+    assert data_sizes[0] == len(data) + 1000
+    assert data_sizes[3] == len(data)
+    assert data_sizes[1] < 2 * block_size
+    assert data_sizes[2] < 3 * block_size
+
+    for backup, source_tree in zip(_get_backups(env), source_trees):
+        with Restore(backup, env["restore_path"]) as restorer:
+            assert restorer.restore()
+
+        assert _hash_tree(env["restore_path"] + env["data_path"]) == source_tree
+        shutil.rmtree(env["restore_path"])
+
+
+def test_legacy_metadata(env):
+    source_tree = _hash_tree(env["data_path"])
+    env["config"]["max_backups"] = 2
+
+    with Backuper(env["config"]) as backuper:
+        assert backuper.backup()
+
+    # Convert the metadata to the text format which doesn't contain file sizes
+    metadata = _write_text_metadata(_get_backups(env)[-1], with_sizes = False)
+    assert metadata
+
+    time.sleep(1)
+
+    with Backuper(env["config"]) as backuper:
+        assert backuper.backup()
+
+    for backup in _get_backups(env):
+        with Restore(backup, env["restore_path"]) as restorer:
+            assert restorer.restore()
+
+        assert _hash_tree(env["restore_path"] + env["data_path"]) == source_tree
+        shutil.rmtree(env["restore_path"])
+
+
+def test_metadata_conversion(env):
+    source_tree = _hash_tree(env["data_path"])
+
+    with Backuper(env["config"]) as backuper:
+        assert backuper.backup()
+
+    backup_path = _get_backups(env)[-1]
+    metadata = _write_text_metadata(backup_path)
+
+    assert metadata
+    assert not os.path.exists(os.path.join(backup_path, "metadata.bin"))
+
+    assert pyvsb.metadata.convert(backup_path)
+    assert not pyvsb.metadata.convert(backup_path)
+    assert not os.path.exists(os.path.join(backup_path, "metadata.bz2"))
+
+    with pyvsb.metadata.Reader(os.path.join(backup_path, "metadata.bin")) as reader:
+        assert len(reader) == len(metadata)
+        assert sorted(reader) == sorted(metadata)
+
+        for record in metadata:
+            assert reader.find(record[-1]) == record
+
+        assert reader.find(env["data_path"]) is None
+
+    with Restore(backup_path, env["restore_path"]) as restorer:
+        assert restorer.restore()
+
+    assert _hash_tree(env["restore_path"] + env["data_path"]) == source_tree
+
+
+@pytest.mark.parametrize("compression", ( "none", "gz" ))
+def test_metadata_offsets(env, monkeypatch, compression):
+    env["config"].update({
+        "max_backups":               2,
+        "compression":               compression,
+        "max_volume_size":           10 * 1024,
+        "incompressible_extensions": { "jpg" },
+    })
+
+    for file_id in range(10):
+        extension = "jpg" if file_id % 3 else "txt"
+
+        with open(os.path.join(env["data_path"], "file-{}.{}".format(file_id, extension)), "wb") as data_file:
+            data_file.write(os.urandom(5 * 1024))
+
+    with Backuper(env["config"]) as backuper:
+        assert backuper.backup()
+
+    backup_path = _get_backups(env)[-1]
+
+    with pyvsb.metadata.Reader(os.path.join(backup_path, "metadata.bin")) as reader:
+        records = list(reader.records(offsets = True))
+
+    assert records and all(record[-1] is not None for record in records)
+
+    for file_hash, status, size, fingerprint, path, offset in records:
+        data_class = pyvsb.utils.MultiVolumeTarFile if status == "unique" else pyvsb.utils.CompressedTarFile
+        data_name = "data.tar" if status == "unique" else "raw.tar"
+
+        data = data_class(os.path.join(backup_path, data_name))
+
+        try:
+            assert data.member(offset).name == path[1:]
+        finally:
+            data.close()
+
+    # Make all files extern
+    time.sleep(1)
+    os.utime(env["data_path"])
+    source_tree = _hash_tree(env["data_path"])
+
+    with Backuper(env["config"]) as backuper:
+        assert backuper.backup()
+
+    # The other backups' data must be accessed only by the offsets
+    iterated = []
+    init = pyvsb.utils.CompressedTarFile.__init__
+    iterate = pyvsb.utils.CompressedTarFile.__iter__
+
+    def init_wrapper(self, path, *args, **kwargs):
+        self.test_path = path
+        init(self, path, *args, **kwargs)
+
+    def iter_wrapper(self):
+        iterated.append(self.test_path)
+        return iterate(self)
+
+    monkeypatch.setattr(pyvsb.utils.CompressedTarFile, "__init__", init_wrapper)
+    monkeypatch.setattr(pyvsb.utils.CompressedTarFile, "__iter__", iter_wrapper)
+
+    with Restore(_get_backups(env)[-1], env["restore_path"]) as restorer:
+        assert restorer.restore()
+
+    assert _hash_tree(env["restore_path"] + env["data_path"]) == source_tree
+    assert iterated and all(path.startswith(_get_backups(env)[-1] + os.sep) for path in iterated)
+
+
+def test_group_index(env, monkeypatch):
+    env["config"]["max_backups"] = 3
+    source_tree = _hash_tree(env["data_path"])
+
+    loaded_metadata = []
+    load_metadata = pyvsb.backup._load_metadata
+
+    def counting_load_metadata(backup_path, handle_metadata, **kwargs):
+        loaded_metadata.append(backup_path)
+        return load_metadata(backup_path, handle_metadata, **kwargs)
+
+    monkeypatch.setattr(pyvsb.backup, "_load_metadata", counting_load_metadata)
+
+    def load_index():
+        backups = [ os.path.basename(backup) for backup in _get_backups(env) ]
+        files = {}
+        group_index = pyvsb.index.load(os.path.join(os.path.dirname(_get_backups(env)[0]), ".index"), backups, files)
+        return None if group_index is None else group_index + ( files, )
+
+    with Backuper(env["config"]) as backuper:
+        assert backuper.backup()
+
+    index_path = os.path.join(os.path.dirname(_get_backups(env)[0]), ".index")
+    stale_index_path = os.path.join(env["test_path"], "stale-index")
+    shutil.copy(index_path, stale_index_path)
+
+    assert load_index() is not None
+
+    # The next backup loads the index instead of the metadata
+    time.sleep(1)
+    del loaded_metadata[:]
+
+    with Backuper(env["config"]) as backuper:
+        assert backuper.backup()
+
+    assert not loaded_metadata
+
+    hashes, sizes, chunks, files = updated_index = load_index()
+    assert hashes and sizes and files
+    assert files[os.path.join(env["data_path"], "etc/fstab")][0] in hashes
+
+    # A stale index is rebuilt from the metadata
+    shutil.copy(stale_index_path, index_path)
+    time.sleep(1)
+
+    with Backuper(env["config"]) as backuper:
+        assert backuper.backup()
+
+    assert len(loaded_metadata) == 2
+    assert load_index() == updated_index
+
+    for backup in _get_backups(env):
+        with Restore(backup, env["restore_path"]) as restorer:
+            assert restorer.restore()
+
+        assert _hash_tree(env["restore_path"] + env["data_path"]) == source_tree
+        shutil.rmtree(env["restore_path"])
+
+
+def test_journal(env, caplog):
+    caplog.set_level(logging.DEBUG, logger = "pyvsb")
+
+    env["config"]["max_backups"] = 10
+    journal_path = os.path.join(env["backup_path"], ".journal")
+    changed_path = os.path.join(env["data_path"], "etc", "changing_file")
+
+    watcher = multiprocessing.Process(
+        target = Watcher(journal_path, env["config"]).run, daemon = True)
+    watcher.start()
+
+    try:
+        for attempt in range(100):
+            if os.path.exists(journal_path) and os.path.getsize(journal_path):
+                break
+
+            time.sleep(0.1)
+        else:
+            assert False, "The watcher hasn't started"
+
+        for revision in range(3):
+            if revision:
+                time.sleep(1)
+
+            if revision == 2:
+                watcher.terminate()
+                watcher.join()
+
+            with open(changed_path, "w") as changing_file:
+                changing_file.write("revision {}".format(revision))
+
+            source_tree = _hash_tree(env["data_path"])
+            caplog.clear()
+
+            with Backuper(env["config"]) as backuper:
+                assert backuper.backup()
+
+            copied = "Copying '{}' from the previous backup...".format(
+                os.path.join(env["data_path"], "home"))
+            assert ( copied in caplog.messages ) == ( revision == 1 )
+
+            with Restore(_get_backups(env)[-1], env["restore_path"]) as restorer:
+                assert restorer.restore()
+
+            assert _hash_tree(env["restore_path"] + env["data_path"]) == source_tree
+            shutil.rmtree(env["restore_path"])
+    finally:
+        if watcher.is_alive():
+            watcher.terminate()
+            watcher.join()
+
+
+def test_journal_compaction(env, caplog):
+    caplog.set_level(logging.DEBUG, logger = "pyvsb")
+
+    env["config"]["max_backups"] = 10
+    journal_path = os.path.join(env["backup_path"], ".journal")
+    changed_path = os.path.join(env["data_path"], "etc", "changing_file")
+
+    watcher = multiprocessing.Process(
+        target = Watcher(journal_path, env["config"]).run, daemon = True)
+    watcher.start()
+
+    try:
+        for attempt in range(100):
+            if os.path.exists(journal_path) and os.path.getsize(journal_path):
+                break
+
+            time.sleep(0.1)
+        else:
+            assert False, "The watcher hasn't started"
+
+        sizes = []
+
+        for revision in range(5):
+            if revision:
+                time.sleep(1)
+
+            with open(changed_path, "w") as changing_file:
+                changing_file.write("revision {}".format(revision))
+
+            caplog.clear()
+
+            with Backuper(env["config"]) as backuper:
+                assert backuper.backup()
+
+            copied = "Copying '{}' from the previous backup...".format(
+                os.path.join(env["data_path"], "home"))
+            assert ( copied in caplog.messages ) == bool(revision)
+
+            sizes.append(os.path.getsize(journal_path))
+
+        # Only the changes since the previous backup are kept
+        assert max(sizes) < 2 * min(sizes[1:])
+
+        with open(journal_path) as journal_file:
+            records = journal_file.read().splitlines()[1:]
+
+        assert [ record[:1] for record in records ] == [ "D", "D", "S" ]
+
+        with Restore(_get_backups(env)[-1], env["restore_path"]) as restorer:
+            assert restorer.restore()
+
+        assert _hash_tree(env["restore_path"] + env["data_path"]) == _hash_tree(env["data_path"])
+    finally:
+        if watcher.is_alive():
+            watcher.terminate()
+            watcher.join()
+
+
 def test_topdirs_permissions(env):
     source_tree = _hash_tree(env["data_path"], prefix = "/")
 
@@ -335,12 +1095,18 @@ def test_complex(env, config):
         shutil.rmtree(env["restore_path"])
 
 
-@pytest.mark.parametrize("in_place", ( True, False ))
-def test_compression(env, in_place):
+@pytest.mark.parametrize(( "in_place", "compression_level" ), (
+    ( True, 0 ), ( False, 0 ), ( False, 1 ),
+))
+def test_compression(env, in_place, compression_level):
     source_trees = []
-    formats = ( "bz2", "gz", "none" )
+    formats = ( "bz2", "gz", "xz" ) + ( ( "zstd", ) if pyvsb.utils.zstd is not None else () ) + ( "none", )
+    extensions = { "none": "", "zstd": ".zst" }
 
-    env["config"]["max_backups"] = len(formats)
+    env["config"].update({
+        "max_backups":       len(formats),
+        "compression_level": compression_level,
+    })
 
     for id, format in enumerate(formats):
         if(id): time.sleep(1)
@@ -358,7 +1124,7 @@ def test_compression(env, in_place):
 
         assert len(_get_groups(env)) == 1
         assert os.path.exists(os.path.join(_get_backups(env)[-1],
-            "data.tar" + ( "" if format == "none" else "." + format )))
+            "data.tar" + extensions.get(format, "." + format)))
 
     backups = _get_backups(env)
     assert len(backups) == len(formats)
@@ -372,6 +1138,469 @@ def test_compression(env, in_place):
         shutil.rmtree(env["restore_path"])
 
 
+@pytest.mark.parametrize("compression", ( "bz2", "gz", "xz" ))
+def test_parallel_compression(env, compression):
+    with open(os.path.join(env["data_path"], "big"), "wb") as big_file:
+        big_file.write(os.urandom(10 * 1024 * 1024))
+
+    source_tree = _hash_tree(env["data_path"])
+
+    env["config"].update({
+        "compression":         compression,
+        "compression_threads": 4,
+    })
+
+    with Backuper(env["config"]) as backuper:
+        assert backuper.backup()
+
+    # The data is compressed in independent blocks which are readable by the
+    # standard tools
+    data_path = os.path.join(_get_backups(env)[-1], "data.tar." + compression)
+    subprocess.check_call([ { "bz2": "bzip2", "gz": "gzip" }.get(compression, compression), "-t", data_path ])
+
+    with Restore(_get_backups(env)[-1], env["restore_path"]) as restorer:
+        assert restorer.restore()
+
+    assert _hash_tree(env["restore_path"] + env["data_path"]) == source_tree
+
+
+@pytest.mark.parametrize("detect_incompressible", ( True, False ))
+def test_incompressible_files(env, detect_incompressible):
+    files = {
+        "photo.JPG":  os.urandom(100 * 1024),
+        "photo.copy": None,
+        "random":     os.urandom(100 * 1024),
+        "text":       b"Some text. " * 10000,
+        "small.jpg":  os.urandom(1024),
+    }
+    files["photo.copy"] = files["photo.JPG"]
+
+    for name, data in files.items():
+        with open(os.path.join(env["data_path"], name), "wb") as data_file:
+            data_file.write(data)
+
+    source_tree = _hash_tree(env["data_path"])
+
+    env["config"].update({
+        "max_backups":               2,
+        "compression":               "gz",
+        "incompressible_extensions": { "jpg" },
+        "detect_incompressible":     detect_incompressible,
+    })
+
+    for backup_id in range(2):
+        if backup_id:
+            time.sleep(1)
+            env["config"]["trust_modify_time"] = False
+
+        with Backuper(env["config"]) as backuper:
+            assert backuper.backup()
+
+    with tarfile.open(os.path.join(_get_backups(env)[0], "raw.tar")) as raw_data:
+        raw_files = set(os.path.basename(tar_info.name) for tar_info in raw_data)
+
+    assert raw_files == ( { "photo.JPG", "random" } if detect_incompressible else { "photo.JPG" } )
+    assert not os.path.exists(os.path.join(_get_backups(env)[1], "raw.tar"))
+
+    for backup in _get_backups(env):
+        with Restore(backup, env["restore_path"]) as restorer:
+            assert restorer.restore()
+
+        assert _hash_tree(env["restore_path"] + env["data_path"]) == source_tree
+        shutil.rmtree(env["restore_path"])
+
+
+def test_compressed_frames_index(env, monkeypatch):
+    big_path = os.path.join(env["data_path"], "big")
+    small_path = os.path.join(env["data_path"], "small")
+
+    with open(big_path, "wb") as big_file:
+        big_file.write(os.urandom(20 * 1024 * 1024))
+
+    with open(small_path, "w") as small_file:
+        small_file.write("small")
+
+    env["config"]["compression"] = "gz"
+
+    with Backuper(env["config"]) as backuper:
+        assert backuper.backup()
+
+    data_path = os.path.join(_get_backups(env)[-1], "data.tar.gz")
+    assert os.path.exists(data_path + ".index")
+
+    read_frames = set()
+    read_frame = pyvsb.utils.FramedFile._FramedFile__read_frame
+
+    def read_frame_wrapper(self, frame_id):
+        read_frames.add(frame_id)
+        return read_frame(self, frame_id)
+
+    monkeypatch.setattr(pyvsb.utils.FramedFile, "_FramedFile__read_frame", read_frame_wrapper)
+
+    with Restore(_get_backups(env)[-1], env["restore_path"]) as restorer:
+        assert restorer.restore([ small_path ])
+
+    with open(env["restore_path"] + small_path) as small_file:
+        assert small_file.read() == "small"
+
+    assert not os.path.exists(env["restore_path"] + big_path)
+    assert len(read_frames) <= 2
+
+    shutil.rmtree(env["restore_path"])
+    source_tree = _hash_tree(env["data_path"])
+
+    with Restore(_get_backups(env)[-1], env["restore_path"]) as restorer:
+        assert restorer.restore()
+
+    assert _hash_tree(env["restore_path"] + env["data_path"]) == source_tree
+
+
+def test_sequential_extern_restore(env, monkeypatch):
+    env["config"].update({
+        "max_backups": 2,
+        "compression": "bz2",
+    })
+
+    names = [ "file-{}".format(file_id) for file_id in range(20) ]
+
+    for name in names:
+        with open(os.path.join(env["data_path"], name), "wb") as data_file:
+            data_file.write(os.urandom(1000))
+
+    with Backuper(env["config"]) as backuper:
+        assert backuper.backup()
+
+    # Make the files extern and change their order in the next backup
+    time.sleep(1)
+    source_data_path = os.path.join(env["test_path"], "source")
+    os.rename(env["data_path"], source_data_path)
+    os.mkdir(env["data_path"])
+
+    for name in reversed(names):
+        shutil.copy2(os.path.join(source_data_path, name), os.path.join(env["data_path"], name[::-1]))
+
+    source_tree = _hash_tree(env["data_path"])
+
+    with Backuper(env["config"]) as backuper:
+        assert backuper.backup()
+
+    extracted = []
+    extract = Restore._Restore__extract
+
+    def extract_wrapper(self, name, data, member):
+        extracted.append(( id(data), member.offset ))
+        return extract(self, name, data, member)
+
+    monkeypatch.setattr(Restore, "_Restore__extract", extract_wrapper)
+
+    with Restore(_get_backups(env)[-1], env["restore_path"]) as restorer:
+        # Extern files are looked up in the binary metadata instead of a map
+        assert isinstance(restorer._Restore__extern_files, pyvsb.metadata.Reader)
+        assert restorer.restore()
+
+    assert _hash_tree(env["restore_path"] + env["data_path"]) == source_tree
+    assert len(extracted) == len(names)
+    assert extracted == sorted(extracted)
+
+
+@pytest.mark.parametrize("compression", ( "none", "gz" ))
+def test_parallel_restore(env, monkeypatch, compression):
+    env["config"].update({
+        "max_backups":               2,
+        "compression":               compression,
+        "incompressible_extensions": { "jpg" },
+        "chunking_threshold":        64 * 1024,
+        "chunk_size":                16 * 1024,
+    })
+
+    for directory_id in range(5):
+        directory = os.path.join(env["data_path"], "dir-{}".format(directory_id), "subdir")
+        os.makedirs(directory)
+
+        for file_id in range(10):
+            extension = "jpg" if file_id % 4 == 1 else "txt"
+
+            with open(os.path.join(directory, "file-{}.{}".format(file_id, extension)), "wb") as data_file:
+                data_file.write(os.urandom(( 100 if file_id == 9 else 1 ) * 1024))
+
+        os.link(os.path.join(directory, "file-0.txt"), os.path.join(directory, "link"))
+        os.chmod(directory, 0o500)
+
+    with Backuper(env["config"]) as backuper:
+        assert backuper.backup()
+
+    # Make the files extern and add duplicates to the next backup
+    time.sleep(1)
+
+    for directory_id in range(5):
+        directory = os.path.join(env["data_path"], "dir-{}".format(directory_id))
+        shutil.copy2(os.path.join(directory, "subdir", "file-2.txt"), os.path.join(directory, "copy"))
+
+    source_tree = _hash_tree(env["data_path"])
+
+    with Backuper(env["config"]) as backuper:
+        assert backuper.backup()
+
+    parts = []
+    restore_members_part = Restore._Restore__restore_members_part
+
+    def restore_members_part_wrapper(self, members, *args):
+        parts.append(len(members))
+        return restore_members_part(self, members, *args)
+
+    monkeypatch.setattr(Restore, "_Restore__restore_members_part", restore_members_part_wrapper)
+
+    for paths_to_restore in ( None, [ os.path.join(env["data_path"], "dir-1"), os.path.join(env["data_path"], "dir-3") ] ):
+        with Restore(_get_backups(env)[-1], env["restore_path"], jobs = 4) as restorer:
+            assert restorer.restore(paths_to_restore)
+
+        # Only indexed data is split between the threads
+        assert len(parts) == ( 4 if compression == "gz" else 0 )
+        del parts[:]
+
+        if paths_to_restore is None:
+            assert _hash_tree(env["restore_path"] + env["data_path"]) == source_tree
+        else:
+            assert sorted(os.listdir(env["restore_path"] + env["data_path"])) == [ "dir-1", "dir-3" ]
+
+            for path in paths_to_restore:
+                assert _hash_tree(env["restore_path"] + path, root = False) == _hash_tree(path, root = False)
+
+        for directory_id in range(5):
+            directory = os.path.join(env["restore_path"] + env["data_path"], "dir-{}".format(directory_id), "subdir")
+            if os.path.exists(directory):
+                os.chmod(directory, 0o700)
+
+        shutil.rmtree(env["restore_path"])
+
+    for directory_id in range(5):
+        os.chmod(os.path.join(env["data_path"], "dir-{}".format(directory_id), "subdir"), 0o700)
+
+
+@pytest.mark.parametrize("compression", ( "none", "gz" ))
+def test_volumes(env, monkeypatch, compression):
+    env["config"].update({
+        "max_backups":     2,
+        "compression":     compression,
+        "max_volume_size": 100 * 1024,
+    })
+
+    for file_id in range(10):
+        with open(os.path.join(env["data_path"], "file-{}".format(file_id)), "wb") as data_file:
+            data_file.write(os.urandom(30 * 1024))
+
+    source_trees = []
+
+    for backup_id in range(2):
+        if backup_id:
+            time.sleep(1)
+
+            with open(os.path.join(env["data_path"], "new"), "w") as new_file:
+                new_file.write("new")
+
+        source_trees.append(_hash_tree(env["data_path"]))
+
+        with Backuper(env["config"]) as backuper:
+            assert backuper.backup()
+
+    backup_files = os.listdir(_get_backups(env)[0])
+    extension = "" if compression == "none" else "." + compression
+
+    assert "data.tar.volumes" in backup_files
+    assert "data.tar" + extension not in backup_files
+    assert set("data.{:03d}.tar{}".format(volume_id, extension) for volume_id in range(4)) <= set(backup_files)
+
+    for backup, source_tree in zip(_get_backups(env), source_trees):
+        with Restore(backup, env["restore_path"], in_place = True) as restorer:
+            assert restorer.restore()
+
+        assert _hash_tree(env["restore_path"] + env["data_path"]) == source_tree
+        shutil.rmtree(env["restore_path"])
+
+    # Only the volume that holds the file must be opened
+    opened_volumes = []
+    init = pyvsb.utils.CompressedTarFile.__init__
+
+    def init_wrapper(self, path, *args, **kwargs):
+        opened_volumes.append(os.path.basename(path))
+        init(self, path, *args, **kwargs)
+
+    monkeypatch.setattr(pyvsb.utils.CompressedTarFile, "__init__", init_wrapper)
+
+    with Restore(_get_backups(env)[0], env["restore_path"]) as restorer:
+        assert restorer.restore([ os.path.join(env["data_path"], "file-9") ])
+
+    assert len(opened_volumes) == 1
+
+    with open(os.path.join(env["restore_path"] + env["data_path"], "file-9"), "rb") as restored_file, \
+         open(os.path.join(env["data_path"], "file-9"), "rb") as source_file:
+        assert restored_file.read() == source_file.read()
+
+    shutil.rmtree(env["restore_path"])
+
+    with Restore(_get_backups(env)[-1], env["restore_path"]) as restorer:
+        assert restorer.restore(globs = [ os.path.join(env["data_path"], "file-[12]") ])
+
+    assert sorted(os.listdir(env["restore_path"] + env["data_path"])) == [ "file-1", "file-2" ]
+
+
+@pytest.mark.parametrize("compression", ( "gz", "bz2" ))
+def test_raw_and_chunk_volumes(env, compression):
+    env["config"].update({
+        "max_backups":               2,
+        "compression":               compression,
+        "max_volume_size":           100 * 1024,
+        "incompressible_extensions": { "jpg" },
+        "chunking_threshold":        200 * 1024,
+        "chunk_size":                16 * 1024,
+    })
+
+    for file_id in range(6):
+        with open(os.path.join(env["data_path"], "photo-{}.jpg".format(file_id)), "wb") as data_file:
+            data_file.write(os.urandom(70 * 1024))
+
+    for file_id in range(2):
+        with open(os.path.join(env["data_path"], "big-{}".format(file_id)), "wb") as data_file:
+            data_file.write(os.urandom(300 * 1024))
+
+    source_tree = _hash_tree(env["data_path"])
+
+    with Backuper(env["config"]) as backuper:
+        assert backuper.backup()
+
+    backup_files = set(os.listdir(_get_backups(env)[0]))
+    extension = "." + compression
+
+    assert { "raw.tar.volumes", "chunks.tar.volumes" } <= backup_files
+    assert "raw.tar" not in backup_files and "chunks.tar" + extension not in backup_files
+    assert set("raw.{:03d}.tar".format(volume_id) for volume_id in range(3)) <= backup_files
+    assert set("chunks.{:03d}.tar{}".format(volume_id, extension) for volume_id in range(3)) <= backup_files
+
+    # Make all files extern
+    time.sleep(1)
+    os.utime(env["data_path"])
+    source_trees = [ source_tree, _hash_tree(env["data_path"]) ]
+
+    with Backuper(env["config"]) as backuper:
+        assert backuper.backup()
+
+    for backup, source_tree in zip(_get_backups(env), source_trees):
+        with Restore(backup, env["restore_path"]) as restorer:
+            assert restorer.restore()
+
+        assert _hash_tree(env["restore_path"] + env["data_path"]) == source_tree
+        shutil.rmtree(env["restore_path"])
+
+
+def test_filters():
+    filters = [
+        ( False, re.compile(r"^Downloads$") ),
+        ( True,  re.compile(r"^\.ssh/config$") ),
+        ( False, re.compile(r"^\.ssh/") ),
+        ( False, re.compile(r"^\.cache") ),
+        ( True,  re.compile(r"^temp/keep") ),
+        ( False, re.compile(r"^te?mp") ),
+        ( False, re.compile(r"\.tmp$") ),
+        ( True,  re.compile(r"(?i)\.KEEP$") ),
+        ( False, re.compile(r"^docs|^music") ),
+        ( False, re.compile(r"(a)\1") ),
+    ]
+
+    paths = [
+        "Downloads", "Downloads/file", ".ssh/config", ".ssh/id_rsa", ".cache",
+        ".cache2/file", "temp/keep", "temp/other", "tmp", "tp", "file.tmp",
+        "file.keep.tmp", "file.tmp.keep", "docs", "music/file", "aa", "a",
+        "other/.ssh/config",
+    ]
+
+    compiled = Filter(filters)
+
+    for path in paths:
+        for allow, regex in filters:
+            if regex.search(path):
+                break
+        else:
+            allow = None
+
+        assert compiled.match(path) == allow
+
+    assert compiled.matches_under(".ssh")
+    assert Filter(filters[:6]).matches_under("temp")
+    assert not Filter(filters[:6]).matches_under("Documents")
+
+
+def test_path_matcher():
+    paths = [ "/etc/hosts", "/home/user", "/home/user/.ssh" ]
+    globs = [ "/var/log/*.log", "*.conf" ]
+    regexes = [ r"^/opt/[a-z]+/bin$", r"\.bak$" ]
+
+    all_paths = sorted([
+        "/etc", "/etc/hosts", "/etc/hosts.allow", "/etc/hosts/file", "/etc/nginx.conf",
+        "/home", "/home/user", "/home/user/.ssh/config", "/home/user-old", "/home/user-old/file",
+        "/home/user0", "/home/userx/file", "/var/log/syslog.log", "/var/log/old/kern.log",
+        "/var/log/syslog", "/opt/app/bin", "/opt/app/bin/tool", "/opt/app2/bin", "/file.bak",
+    ])
+
+    def brute_force(path):
+        return (
+            any(path == other or path.startswith(other + "/") for other in paths) or
+            any(fnmatch.fnmatchcase(path, glob) for glob in globs) or
+            any(re.search(regex, path) for regex in regexes))
+
+    matcher = PathMatcher(paths, globs, regexes)
+    expected = set(path for path in all_paths if brute_force(path))
+
+    assert set(path for path in all_paths if matcher.match(path)) == expected
+    assert matcher.select(all_paths) == expected
+
+    assert PathMatcher([ "/" ]).select(all_paths) == set(all_paths)
+    assert PathMatcher([ "/home/user/.ssh", "/home" ]).select(all_paths) == set(
+        path for path in all_paths if path.startswith("/home"))
+    assert not PathMatcher()
+
+    with pytest.raises(Error):
+        PathMatcher(regexes = [ "(" ])
+
+
+@pytest.mark.parametrize("bloom_filter", ( False, True ))
+def test_hash_set(bloom_filter):
+    hashes = set(hashlib.sha256(str(hash_id).encode()).hexdigest() for hash_id in range(5000))
+    hashes.add("0" * 64)
+
+    hash_set = pyvsb.utils.HashSet(bloom_filter = bloom_filter)
+
+    for file_hash in hashes:
+        hash_set.add(file_hash)
+        hash_set.add(file_hash)
+
+    assert len(hash_set) == len(hashes)
+    assert set(hash_set) == hashes
+    assert hash_set == hashes
+    assert all(file_hash in hash_set for file_hash in hashes)
+
+    for hash_id in range(5000):
+        assert hashlib.sha256(b"missing" + str(hash_id).encode()).hexdigest() not in hash_set
+
+    assert "invalid" not in hash_set
+    assert hash_set.memory_usage() < 5000 * 64 * 2
+
+
+def _write_text_metadata(backup_path, with_sizes = True):
+    """Replaces binary metadata of the backup with the legacy text metadata."""
+
+    metadata_path = os.path.join(backup_path, "metadata.bin")
+    metadata = list(pyvsb.metadata.read(backup_path))
+
+    with bz2.BZ2File(os.path.join(backup_path, "metadata.bz2"), "w") as metadata_file:
+        for hash, status, size, fingerprint, path in metadata:
+            values = ( hash, status, str(size), fingerprint, path ) if with_sizes else ( hash, status, fingerprint, path )
+            metadata_file.write(" ".join(values).encode("utf-8") + b"\n")
+
+    os.unlink(metadata_path)
+
+    return metadata
+
+
 def _get_backups(env, group = None):
     """Returns backups in the specified backup group (last by default)."""
 
@@ -380,7 +1609,8 @@ def _get_backups(env, group = None):
 
     return [
         os.path.join(backup_group_path, backup_name)
-        for backup_name in sorted(os.listdir(backup_group_path)) ]
+        for backup_name in sorted(os.listdir(backup_group_path))
+            if not backup_name.startswith(".") ]
 
 
 def _get_groups(env):